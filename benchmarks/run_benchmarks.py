@@ -0,0 +1,405 @@
+"""Offline end-to-end benchmarks of Courier.
+
+Courier is run in-process against local stand-ins: synthetic git repositories, a fake Armada API listing fake Armada
+agents, and one sshd per fake ship receiving configs. Nothing leaves the machine. It has to be run inside Courier's
+container, as root, because pushes use the same SSH user, key and sudo as in production.
+
+Every benchmark point sets up a fresh world and runs all scenarios on it. The first value of --repositories, --files
+and --ships is the base point; scaling curves vary one of them at a time.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARKS_DIR), 'src'))
+
+import stand_ins
+
+DEFAULT_WORKSPACE = '/tmp/courier-benchmarks'
+SSH_KEY_NAME = 'keys/docker@armada.key'
+DESTINATION_ALIAS = 'benchmark-ships'
+SHIP_IP = '127.0.0.1'
+SCENARIOS = ('source_update_cold', 'update_all_unchanged', 'update_all_changed', 'webhook', 'update_hermes',
+             'ssh_tunnel')
+AXES = ('repositories', 'files', 'ships')
+LABEL_RESULT_PATTERN = re.compile(r'result="(\w+)"')
+
+
+def _parse_int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def _configure_courier(workspace_dir):
+    """Keeps all Courier's working files inside the benchmark workspace and points it at the fake ships."""
+    import common.docker_client
+    import delivery_state
+    import git_cache
+    import git_source
+    import remote
+    import workspace
+
+    delivery_state.COURIER_STATE_DIR = os.path.join(workspace_dir, 'courier-state')
+    git_cache.GIT_CACHE_DIR = os.path.join(workspace_dir, 'courier-git-cache')
+    git_source.GIT_SSH_SCRIPTS_DIR = os.path.join(workspace_dir, 'courier-git-ssh-scripts')
+    remote.SSH_CONTROL_DIR = os.path.join(workspace_dir, 'courier-ssh-control')
+    workspace.WORKSPACES_DIR = os.path.join(workspace_dir, 'courier-temp')
+    common.docker_client.get_ship_ip = lambda: SHIP_IP
+
+
+def _read_metric_totals():
+    """Returns sums and counts of all histograms and values of all counters, summed over their labels."""
+    import metrics
+
+    totals = collections.defaultdict(float)
+    for line in metrics.render().splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name_and_labels, value = line.rsplit(' ', 1)
+        name = name_and_labels.split('{', 1)[0]
+        if name.endswith('_bucket'):
+            continue
+        if name == 'courier_pushes_total':
+            name += ':' + LABEL_RESULT_PATTERN.search(name_and_labels).group(1)
+        totals[name] += float(value)
+    return totals
+
+
+def _get_phases(totals_before, totals_after):
+    phases = {}
+    for name in sorted(totals_after):
+        if not name.endswith('_seconds_count'):
+            continue
+        base_name = name[:-len('_count')]
+        count = totals_after[name] - totals_before.get(name, 0)
+        if not count:
+            continue
+        total_seconds = totals_after[base_name + '_sum'] - totals_before.get(base_name + '_sum', 0)
+        phase = base_name[len('courier_'):-len('_seconds')]
+        phases[phase] = {
+            'count': int(count),
+            'total_seconds': total_seconds,
+            'mean_seconds': total_seconds / count,
+        }
+    return phases
+
+
+class World(object):
+    """Repositories, ships and Courier configs for one benchmark point."""
+
+    def __init__(self, workspace, repository_count, file_count, file_size, ship_count, use_git_daemon=False,
+                 destination_options=None, courier_config=None):
+        self.workspace = workspace
+        self.repository_count = repository_count
+        self.file_count = file_count
+        self.file_size = file_size
+        self.ship_count = ship_count
+        self.use_git_daemon = use_git_daemon
+        self.destination_options = destination_options or {}
+        self.courier_config = courier_config or {}
+        self.root_dir = None
+        self.config_dir = None
+        self.repositories = []
+        self.repository_urls = {}
+        self.ships = []
+        self.armada_api = None
+        self.git_daemon = None
+
+    @property
+    def tree_size(self):
+        return self.file_count * self.file_size
+
+    def __write_json(self, relative_path, data):
+        path = os.path.join(self.config_dir, relative_path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=4)
+
+    def __install_ssh_key(self, relative_path):
+        path = os.path.join(self.config_dir, relative_path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        shutil.copy(os.path.join(self.workspace, 'client_key'), path)
+
+    def __write_configs(self):
+        self.__install_ssh_key(SSH_KEY_NAME)
+        self.__install_ssh_key(os.path.join('sources', SSH_KEY_NAME))
+        self.__write_json('config.json', self.courier_config)
+        destination_dict = {'type': 'armada-local'}
+        destination_dict.update(self.destination_options)
+        self.__write_json('destinations.json', {DESTINATION_ALIAS: destination_dict})
+        self.__write_json(os.path.join('sources', 'benchmark.json'), [{
+            'type': 'git',
+            'repositories': [self.repository_urls[repository.name] for repository in self.repositories],
+            'branch': 'master',
+            'ssh_key': SSH_KEY_NAME,
+            'destinations': [DESTINATION_ALIAS],
+        }])
+
+    def start(self):
+        import discovery
+
+        self.root_dir = tempfile.mkdtemp(prefix='world-', dir=self.workspace)
+        self.config_dir = os.path.join(self.root_dir, 'config')
+        repositories_dir = os.path.join(self.root_dir, 'repositories')
+        os.makedirs(repositories_dir)
+        for i in range(self.repository_count):
+            repository = stand_ins.GitRepository(repositories_dir, 'repository-{}'.format(i), self.file_count,
+                                                 self.file_size)
+            repository.create()
+            self.repositories.append(repository)
+        if self.use_git_daemon:
+            self.git_daemon = stand_ins.GitDaemon(repositories_dir)
+            self.git_daemon.start()
+        for repository in self.repositories:
+            self.repository_urls[repository.name] = (self.git_daemon.get_url(repository) if self.git_daemon
+                                                     else repository.url)
+
+        ships_dir = os.path.join(self.root_dir, 'ships')
+        for i in range(self.ship_count):
+            ship = stand_ins.FakeShip(ships_dir, 'ship-{}'.format(i), os.path.join(self.workspace, 'host_key'),
+                                      os.path.join(self.workspace, 'authorized_keys'))
+            self.ships.append(ship)
+            ship.start()
+        self.armada_api = stand_ins.FakeArmadaApi(self.ships)
+        self.armada_api.start()
+
+        self.__write_configs()
+        os.environ['CONFIG_PATH'] = self.config_dir
+        discovery.ARMADA_API_PORT = self.armada_api.port
+        discovery.invalidate(ship_ip=SHIP_IP)
+
+    def stop(self):
+        for server in [self.armada_api, self.git_daemon] + self.ships:
+            if server is not None:
+                try:
+                    server.stop()
+                except Exception as e:
+                    logging.exception('Could not stop {}.'.format(server))
+        if self.root_dir is not None:
+            shutil.rmtree(self.root_dir, ignore_errors=True)
+
+
+class Benchmark(object):
+    def __init__(self, world, changed_files):
+        import courier
+        import web
+
+        self.world = world
+        self.changed_files = changed_files
+        self.courier = courier
+        self.app = web.application(courier.URLS, vars(courier))
+
+    def __post(self, path, data=None):
+        response = self.app.request(path, method='POST', data=json.dumps(data) if data is not None else '')
+        if not response.status.startswith('200'):
+            logging.error('POST {} returned {}: {}'.format(path, response.status, response.data))
+            return True
+        return False
+
+    def scenario_source_update_cold(self):
+        sources, were_errors = self.courier._get_all_sources()
+        for source_instance in sources:
+            source_instance.update()
+            were_errors |= source_instance.were_errors
+        return were_errors
+
+    def scenario_update_all_unchanged(self):
+        return self.__post('/update_all?wait=true')
+
+    def scenario_update_all_changed(self):
+        for repository in self.world.repositories:
+            repository.change_files(self.changed_files)
+        return self.__post('/update_all?wait=true')
+
+    def scenario_webhook(self):
+        repository = self.world.repositories[0]
+        repository.change_files(self.changed_files)
+        return self.__post('/gitlab_web_hook?wait=true', {
+            'ref': 'refs/heads/master',
+            'repository': {'url': self.world.repository_urls[repository.name]},
+        })
+
+    def scenario_update_hermes(self):
+        ship = self.world.ships[0]
+        ship.clear()
+        return self.__post('/update_hermes?wait=true', {
+            'ssh': '{}:{}'.format(SHIP_IP, ship.ssh_port),
+            'path': ship.hermes_path,
+        })
+
+    def scenario_ssh_tunnel(self):
+        """Pushes one directory to all ships through SSH tunnels opened via the sshd of the first ship."""
+        import destination
+
+        gateway = self.world.ships[0]
+        tunnel_destination = destination.Destination({
+            'type': 'armada-local',
+            'ssh-tunnel': {'host': SHIP_IP, 'port': gateway.ssh_port, 'user': 'docker', 'key': SSH_KEY_NAME},
+        }, self.world.config_dir)
+        repository = self.world.repositories[0]
+        tunnel_destination.push(os.path.join(repository.work_tree, 'dir-0000'), source_name='ssh-tunnel')
+        return tunnel_destination.were_errors or not all(push_result['success']
+                                                         for push_result in tunnel_destination.push_results)
+
+    def run_scenario(self, scenario):
+        function = getattr(self, 'scenario_' + scenario)
+        totals_before = _read_metric_totals()
+        start = time.time()
+        try:
+            were_errors = function()
+        except Exception as e:
+            logging.exception('Scenario {} failed.'.format(scenario))
+            were_errors = True
+        seconds = time.time() - start
+        totals_after = _read_metric_totals()
+
+        def delta(name):
+            return totals_after.get(name, 0) - totals_before.get(name, 0)
+
+        successful_pushes = int(delta('courier_pushes_total:success'))
+        sent_bytes = int(delta('courier_transferred_bytes_total'))
+        delivered_bytes = successful_pushes * self.world.tree_size
+        return {
+            'scenario': scenario,
+            'seconds': seconds,
+            'were_errors': bool(were_errors),
+            'pushes': successful_pushes,
+            'skipped_pushes': int(delta('courier_pushes_total:skipped')),
+            'failed_pushes': int(delta('courier_pushes_total:failure')),
+            'sent_bytes': sent_bytes,
+            'delivered_bytes': delivered_bytes,
+            'sent_mb_per_second': sent_bytes / seconds / 2 ** 20,
+            'delivered_mb_per_second': delivered_bytes / seconds / 2 ** 20,
+            'phases': _get_phases(totals_before, totals_after),
+        }
+
+    def run(self, scenarios):
+        return [self.run_scenario(scenario) for scenario in scenarios]
+
+
+def _prepare_workspace(workspace):
+    """Creates SSH keys shared by all worlds. The host key is kept between runs, so ports reused by later runs do
+    not look like hosts that have changed their identity."""
+    if not os.path.exists(workspace):
+        os.makedirs(workspace)
+    stand_ins.generate_ssh_key(os.path.join(workspace, 'host_key'))
+    client_key_path = stand_ins.generate_ssh_key(os.path.join(workspace, 'client_key'))
+    shutil.copy(client_key_path + '.pub', os.path.join(workspace, 'authorized_keys'))
+
+
+def _get_points(args):
+    """Returns benchmark points: the base one and the ones varying one axis at a time."""
+    values = {'repositories': args.repositories, 'files': args.files, 'ships': args.ships}
+    base = dict((axis, axis_values[0]) for axis, axis_values in values.items())
+    points = []
+    for axis in AXES:
+        for value in values[axis]:
+            point = dict(base)
+            point[axis] = value
+            if point not in points:
+                points.append(point)
+    return points
+
+
+def _run_point(args, point):
+    world = World(args.workspace, point['repositories'], point['files'], args.file_size, point['ships'],
+                  use_git_daemon=args.git_daemon, destination_options=args.destination_options,
+                  courier_config=args.courier_config)
+    try:
+        world.start()
+        return Benchmark(world, args.changed_files).run(args.scenarios)
+    finally:
+        world.stop()
+
+
+def _print_point(point, measurements, file_size):
+    print('\nrepositories={repositories} files={files} ships={ships} file_size={file_size}'.format(
+        file_size=file_size, **point))
+    print('{:<22}{:>10}{:>8}{:>9}{:>10}{:>12}{:>12}  {}'.format(
+        'scenario', 'seconds', 'pushes', 'skipped', 'sent MB', 'sent MB/s', 'deliv. MB/s', 'errors'))
+    for measurement in measurements:
+        print('{scenario:<22}{seconds:>10.3f}{pushes:>8}{skipped_pushes:>9}{sent_mb:>10.2f}'
+              '{sent_mb_per_second:>12.2f}{delivered_mb_per_second:>12.2f}  {were_errors}'.format(
+                  sent_mb=measurement['sent_bytes'] / 2.0 ** 20, **measurement))
+        for phase, phase_measurement in sorted(measurement['phases'].items()):
+            print('    {:<22}count={count:<6} mean={mean_seconds:.3f}s total={total_seconds:.3f}s'.format(
+                phase, **phase_measurement))
+
+
+def _print_curves(results, args):
+    base = _get_points(args)[0]
+    for axis in AXES:
+        rows = [result for result in results
+                if all(result['point'][other] == base[other] for other in AXES if other != axis)]
+        if len(rows) < 2:
+            continue
+        print('\nScaling over {} (seconds):'.format(axis))
+        print('{:>14}'.format(axis) + ''.join('{:>22}'.format(scenario) for scenario in args.scenarios))
+        for row in sorted(rows, key=lambda result: result['point'][axis]):
+            seconds = dict((measurement['scenario'], measurement['seconds']) for measurement in row['measurements'])
+            print('{:>14}'.format(row['point'][axis]) +
+                  ''.join('{:>22.3f}'.format(seconds[scenario]) for scenario in args.scenarios))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repositories', type=_parse_int_list, default=[1, 4, 16],
+                        help='Comma separated numbers of git repositories.')
+    parser.add_argument('--files', type=_parse_int_list, default=[100, 1000, 10000],
+                        help='Comma separated numbers of files in every repository.')
+    parser.add_argument('--ships', type=_parse_int_list, default=[1, 4, 16],
+                        help='Comma separated numbers of ships receiving configs.')
+    parser.add_argument('--file-size', type=int, default=1024, help='Size of every file in bytes.')
+    parser.add_argument('--changed-files', type=int, default=1,
+                        help='Number of files changed in every repository between updates.')
+    parser.add_argument('--scenarios', type=lambda value: value.split(','), default=list(SCENARIOS),
+                        help='Comma separated scenarios to run: {}.'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--git-daemon', action='store_true',
+                        help='Serve repositories with git daemon instead of file:// URLs.')
+    parser.add_argument('--destination-options', type=json.loads, default={},
+                        help='JSON merged into the destination definition, e.g. \'{"transfer_mode": "tar"}\'.')
+    parser.add_argument('--courier-config', type=json.loads, default={},
+                        help='JSON used as Courier\'s config.json, e.g. \'{"update_concurrency": 8}\'.')
+    parser.add_argument('--workspace', default=DEFAULT_WORKSPACE, help='Directory for all benchmark files.')
+    parser.add_argument('--output', help='Write results as JSON to this file.')
+    parser.add_argument('--verbose', action='store_true', help='Show Courier logs.')
+    args = parser.parse_args()
+    unknown_scenarios = set(args.scenarios) - set(SCENARIOS)
+    if unknown_scenarios:
+        parser.error('Unknown scenarios: {}.'.format(', '.join(sorted(unknown_scenarios))))
+    return args
+
+
+def main():
+    args = _parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(name)s [%(levelname)s] - %(message)s')
+    _prepare_workspace(args.workspace)
+    _configure_courier(args.workspace)
+
+    results = []
+    for point in _get_points(args):
+        measurements = _run_point(args, point)
+        _print_point(point, measurements, args.file_size)
+        results.append({'point': point, 'file_size': args.file_size, 'measurements': measurements})
+    _print_curves(results, args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'host': socket.gethostname(), 'created_at': time.time(), 'results': results}, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
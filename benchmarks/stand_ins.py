@@ -0,0 +1,255 @@
+"""Local stand-ins for everything Courier talks to: git servers, Armada API, Armada agents and their sshd."""
+from __future__ import print_function
+
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import random
+import shutil
+import socket
+import string
+import subprocess
+import threading
+import time
+import urlparse
+
+SSHD_PATH = '/usr/sbin/sshd'
+PORT_READY_TIMEOUT = 10
+FILES_PER_DIRECTORY = 100
+
+
+class StandInException(Exception):
+    pass
+
+
+def reserve_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def wait_for_port(port, process=None, timeout=PORT_READY_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise StandInException('Process listening on port {} has exited with code {}.'.format(
+                port, process.returncode))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect(('127.0.0.1', port))
+            return
+        except socket.error:
+            time.sleep(0.05)
+        finally:
+            sock.close()
+    raise StandInException('Nothing is listening on port {} after {} seconds.'.format(port, timeout))
+
+
+def _run(command, cwd=None):
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise StandInException('Command {} failed with code {}:\n{}'.format(command, process.returncode, output))
+    return output
+
+
+def _random_text(size):
+    line = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(79)) + '\n'
+    return (line * (size // len(line) + 1))[:size]
+
+
+def generate_ssh_key(path):
+    if not os.path.exists(path):
+        _run(['ssh-keygen', '-q', '-t', 'rsa', '-b', '2048', '-N', '', '-f', path])
+    os.chmod(path, 0o600)
+    return path
+
+
+class GitRepository(object):
+    """Bare git repository with a synthetic tree of file_count files of file_size bytes each."""
+
+    def __init__(self, root_dir, name, file_count, file_size):
+        self.name = name
+        self.file_count = file_count
+        self.file_size = file_size
+        self.bare_path = os.path.join(root_dir, name + '.git')
+        self.work_tree = os.path.join(root_dir, name + '.work')
+        self.url = 'file://' + self.bare_path
+        self.__revision = 0
+
+    def __git(self, *arguments):
+        return _run(['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost'] + list(arguments),
+                    cwd=self.work_tree)
+
+    def __get_file_path(self, index):
+        return os.path.join(self.work_tree, 'dir-{:04d}'.format(index // FILES_PER_DIRECTORY),
+                            'file-{:06d}.txt'.format(index))
+
+    def create(self):
+        _run(['git', 'init', '--quiet', '--bare', self.bare_path])
+        _run(['git', 'init', '--quiet', self.work_tree])
+        for index in range(self.file_count):
+            file_path = self.__get_file_path(index)
+            if not os.path.exists(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            with open(file_path, 'w') as f:
+                f.write(_random_text(self.file_size))
+        self.__commit('Initial tree.')
+
+    def change_files(self, count=1):
+        """Rewrites count files and pushes the change."""
+        self.__revision += 1
+        for index in random.sample(range(self.file_count), min(count, self.file_count)):
+            with open(self.__get_file_path(index), 'w') as f:
+                f.write('revision {}\n'.format(self.__revision))
+                f.write(_random_text(max(0, self.file_size - 16)))
+        self.__commit('Revision {}.'.format(self.__revision))
+
+    def __commit(self, message):
+        self.__git('add', '--all', '.')
+        self.__git('commit', '--quiet', '-m', message)
+        self.__git('push', '--quiet', '--force', self.bare_path, 'HEAD:refs/heads/master')
+
+
+class GitDaemon(object):
+    """Serves all bare repositories from base_path over git:// protocol."""
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.port = None
+        self.process = None
+
+    def start(self):
+        self.port = reserve_port()
+        self.process = subprocess.Popen(['git', 'daemon', '--reuseaddr', '--export-all', '--listen=127.0.0.1',
+                                         '--port={}'.format(self.port), '--base-path={}'.format(self.base_path),
+                                         self.base_path], stderr=open(os.devnull, 'w'))
+        wait_for_port(self.port, self.process)
+
+    def get_url(self, repository):
+        return 'git://127.0.0.1:{}/{}.git'.format(self.port, repository.name)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class JsonHTTPServer(object):
+    """Serves JSON documents returned by get_routes() under their paths."""
+
+    def __init__(self):
+        self.port = None
+        self.__server = None
+
+    def get_routes(self):
+        raise NotImplementedError()
+
+    def start(self):
+        routes_owner = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = urlparse.urlparse(self.path).path
+                routes = routes_owner.get_routes()
+                if path not in routes:
+                    self.send_error(404)
+                    return
+                body = json.dumps(routes[path])
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.__server.server_address[1]
+        thread = threading.Thread(target=self.__server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def address(self):
+        return '127.0.0.1:{}'.format(self.port)
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+
+
+class FakeShip(JsonHTTPServer):
+    """Armada agent of one ship: /hermes_address endpoint and sshd receiving configs into hermes_path."""
+
+    def __init__(self, root_dir, name, host_key_path, authorized_keys_path):
+        super(FakeShip, self).__init__()
+        self.ship_dir = os.path.join(root_dir, name)
+        self.hermes_path = os.path.join(self.ship_dir, 'hermes')
+        self.host_key_path = host_key_path
+        self.authorized_keys_path = authorized_keys_path
+        self.ssh_port = None
+        self.__sshd = None
+
+    def get_routes(self):
+        return {'/hermes_address': {'ssh': '127.0.0.1:{}'.format(self.ssh_port), 'path': self.hermes_path}}
+
+    def __write_sshd_config(self):
+        sshd_config_path = os.path.join(self.ship_dir, 'sshd_config')
+        with open(sshd_config_path, 'w') as f:
+            f.write('\n'.join([
+                'Port {}'.format(self.ssh_port),
+                'ListenAddress 127.0.0.1',
+                'HostKey {}'.format(self.host_key_path),
+                'PidFile {}'.format(os.path.join(self.ship_dir, 'sshd.pid')),
+                'AuthorizedKeysFile {}'.format(self.authorized_keys_path),
+                'PasswordAuthentication no',
+                'UsePAM no',
+                'StrictModes no',
+                'MaxStartups 100',
+                'MaxSessions 100',
+            ]) + '\n')
+        return sshd_config_path
+
+    def start(self):
+        os.makedirs(self.hermes_path)
+        os.chmod(self.ship_dir, 0o755)
+        os.chmod(self.hermes_path, 0o777)
+        self.ssh_port = reserve_port()
+        self.__sshd = subprocess.Popen([SSHD_PATH, '-D', '-e', '-f', self.__write_sshd_config()],
+                                       stderr=open(os.path.join(self.ship_dir, 'sshd.log'), 'w'))
+        wait_for_port(self.ssh_port, self.__sshd)
+        super(FakeShip, self).start()
+
+    def stop(self):
+        super(FakeShip, self).stop()
+        if self.__sshd is not None and self.__sshd.poll() is None:
+            self.__sshd.terminate()
+            self.__sshd.wait()
+
+    def clear(self):
+        """Removes delivered configs, so the ship looks like a freshly started one."""
+        shutil.rmtree(self.hermes_path)
+        os.makedirs(self.hermes_path)
+        os.chmod(self.hermes_path, 0o777)
+
+
+class FakeArmadaApi(JsonHTTPServer):
+    """Armada API of the local ship, listing Armada agents of all ships."""
+
+    def __init__(self, ships):
+        super(FakeArmadaApi, self).__init__()
+        self.ships = ships
+
+    def get_routes(self):
+        return {'/list': {'status': 'ok', 'result': [{'address': ship.address} for ship in self.ships]}}
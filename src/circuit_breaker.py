@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+
+import metrics
+from courier_common import get_courier_config
+from util import register_after_fork
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_OPEN_SECONDS = 30
+MAX_OPEN_SECONDS = 600
+PROBE_INTERVAL = 5
+
+
+class _Circuit(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, address):
+        self.address = address
+        self.state = self.CLOSED
+        self.failures = 0
+        self.open_seconds = 0
+        self.opened_at = None
+        self.retry_at = None
+        self.probe = None
+        self.trial_running = False
+
+    def to_dict(self):
+        return {
+            'address': self.address,
+            'state': self.state,
+            'failures': self.failures,
+            'opened_at': self.opened_at,
+            'retry_at': self.retry_at,
+        }
+
+
+class CircuitBreakers(object):
+    """Suspends pushes to addresses that fail repeatedly, so they do not hold updates of healthy ones.
+
+    After circuit_breaker_failures consecutive failures the circuit of an address opens, and pushes to it fail right
+    away. Once it has been open for circuit_breaker_open_seconds, or as soon as its probe succeeds, one push is let
+    through. If it succeeds, the circuit closes. Otherwise it opens again for twice as long, up to MAX_OPEN_SECONDS.
+    Probes of open circuits run in a background thread every PROBE_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.__circuits = {}
+        self.__lock = threading.Lock()
+        self.__prober = None
+        register_after_fork(self.__after_fork)
+
+    def __after_fork(self):
+        self.__lock = threading.Lock()
+        # Threads are not forked.
+        self.__prober = None
+
+    @property
+    def failure_threshold(self):
+        return int(get_courier_config().get('circuit_breaker_failures', DEFAULT_FAILURE_THRESHOLD))
+
+    @property
+    def base_open_seconds(self):
+        return float(get_courier_config().get('circuit_breaker_open_seconds', DEFAULT_OPEN_SECONDS))
+
+    def allow(self, address):
+        """Returns True if a push to address should be attempted."""
+        with self.__lock:
+            circuit = self.__circuits.get(address)
+            if circuit is None or circuit.state == _Circuit.CLOSED:
+                return True
+            if circuit.trial_running or time.time() < circuit.retry_at:
+                return False
+            circuit.state = _Circuit.HALF_OPEN
+            circuit.trial_running = True
+        logging.info('Trying to push to {} again after repeated failures.'.format(address))
+        return True
+
+    def record_success(self, address):
+        with self.__lock:
+            circuit = self.__circuits.pop(address, None)
+        if circuit is not None and circuit.state != _Circuit.CLOSED:
+            logging.info('Pushes to {} have recovered.'.format(address))
+            metrics.CIRCUIT_OPEN.set(0, address=address)
+
+    def release(self, address):
+        """Ends a push to address let through by allow() without its outcome, e.g. one cut short by the deadline of
+        the update. A trial push leaves the circuit open, so the next push is let through again."""
+        with self.__lock:
+            circuit = self.__circuits.get(address)
+            if circuit is not None and circuit.trial_running:
+                circuit.state = _Circuit.OPEN
+                circuit.trial_running = False
+
+    def record_failure(self, address, probe=None):
+        """Counts a failed push to address. probe() is called in background to tell if the address is back."""
+        threshold = self.failure_threshold
+        with self.__lock:
+            circuit = self.__circuits.setdefault(address, _Circuit(address))
+            circuit.failures += 1
+            circuit.trial_running = False
+            if circuit.state == _Circuit.CLOSED and circuit.failures < threshold:
+                return
+            circuit.open_seconds = min(max(circuit.open_seconds * 2, self.base_open_seconds), MAX_OPEN_SECONDS)
+            circuit.state = _Circuit.OPEN
+            circuit.opened_at = time.time()
+            circuit.retry_at = circuit.opened_at + circuit.open_seconds
+            circuit.probe = probe
+            open_seconds = circuit.open_seconds
+        logging.warning('Pushes to {} have failed {} times in a row. Suspending them for {} seconds.'.format(
+            address, circuit.failures, open_seconds))
+        metrics.CIRCUIT_OPEN.set(1, address=address)
+        self.__start_prober()
+
+    def get_states(self):
+        with self.__lock:
+            return [circuit.to_dict() for _, circuit in sorted(self.__circuits.items())]
+
+    def __start_prober(self):
+        with self.__lock:
+            if self.__prober is not None:
+                return
+            self.__prober = threading.Thread(target=self.__probe, name='circuit-breaker-prober')
+            self.__prober.daemon = True
+            self.__prober.start()
+
+    def __probe(self):
+        while True:
+            time.sleep(PROBE_INTERVAL)
+            now = time.time()
+            with self.__lock:
+                probed = [circuit for circuit in self.__circuits.values()
+                          if circuit.state == _Circuit.OPEN and circuit.probe is not None and now < circuit.retry_at]
+            for circuit in probed:
+                try:
+                    healthy = circuit.probe()
+                except Exception as e:
+                    healthy = False
+                if healthy:
+                    logging.info('Probe of {} has succeeded.'.format(circuit.address))
+                    with self.__lock:
+                        if circuit.state == _Circuit.OPEN:
+                            circuit.retry_at = time.time()
+
+
+_circuit_breakers = CircuitBreakers()
+
+
+def get_circuit_breakers():
+    return _circuit_breakers
@@ -1,11 +1,14 @@
 from __future__ import print_function
 
+import collections
 import json
 import logging
 import os
+import random
 import socket
 import sys
 import threading
+import time
 
 import web
 from armada import hermes
@@ -15,16 +18,34 @@ from raven import Client, setup_logging
 from raven.handlers.logging import SentryHandler
 
 
+import circuit_breaker
+import delivery_state
+import git_cache
 import git_source
 import gitlab
 import hermes_directory_source
-from courier_common import get_ssh_key_path, HERMES_DIRECTORY
+import jobs
+import metrics
+import routing
+import scheduler
+import update_engine
+import workspace
+from courier_common import get_courier_config, get_ssh_key_path, HERMES_DIRECTORY
+from util import map_concurrently, register_before_fork
 
 sys.path.append('/opt/microservice/src')
 import common.consul
 import common.docker_client
 
 
+DEFAULT_WARM_UP_WINDOW = 60
+WARM_UP_SLICES = 10
+DEFAULT_RECONCILE_INTERVAL = 300
+DEFAULT_RECONCILE_JITTER = 0.1
+# How often to check if reconciliation has been enabled in config.json, while it is disabled.
+RECONCILE_DISABLED_CHECK_INTERVAL = 60
+
+
 class CourierException(Exception):
     pass
 
@@ -80,28 +101,32 @@ def _create_all_sources():
     return result, were_errors
 
 
+def _get_routing_table():
+    return routing.get_routing_table(_create_all_sources)
+
+
+# Job processes inherit the routing table compiled in Courier, so it is not compiled again by every job.
+register_before_fork(_get_routing_table)
+
+
 def _create_sources_from_git_repo(repo_url, repo_branch):
-    result = []
-    sources, were_errors = _create_all_sources()
-    for source_instance in sources:
-        logging.debug('source_instance: {}'.format(source_instance))
-        if isinstance(source_instance, git_source.GitSource):
-            logging.debug('recognized GitSource ({} {})'.format(source_instance.repo_url, source_instance.branch))
-            if source_instance.repo_url == repo_url and source_instance.branch == repo_branch:
-                result.append(source_instance)
-    return result, were_errors
+    routing_table = _get_routing_table()
+    return routing_table.get_sources_for_git_repo(repo_url, repo_branch), routing_table.were_errors
 
 
 def _create_sources_from_hermes_directory(subdirectory=None):
-    result = []
-    sources, were_errors = _create_all_sources()
-    for source_instance in sources:
-        logging.debug('source_instance: {}'.format(source_instance))
-        if isinstance(source_instance, hermes_directory_source.HermesDirectorySource):
-            logging.debug('recognized HermesDirectorySource (subdirectory={})'.format(source_instance.subdirectory))
-            if source_instance.subdirectory == subdirectory:
-                result.append(source_instance)
-    return result, were_errors
+    routing_table = _get_routing_table()
+    return routing_table.get_sources_for_hermes_directory(subdirectory), routing_table.were_errors
+
+
+def _create_sources_from_hermes_directory_paths(paths):
+    routing_table = _get_routing_table()
+    return routing_table.get_sources_for_hermes_directory_paths(paths), routing_table.were_errors
+
+
+def _get_all_sources():
+    routing_table = _get_routing_table()
+    return routing_table.get_all_sources(), routing_table.were_errors
 
 
 def _get_local_ssh_address():
@@ -112,34 +137,192 @@ def _get_local_ssh_address():
     return '{ip}:{ssh_port}'.format(**locals())
 
 
-def _update_hermes_client(ssh_address, hermes_path):
-    sources, were_errors = _create_all_sources()
+def _create_update_engine(job=None):
+    config = get_courier_config()
+    return update_engine.UpdateEngine(
+        concurrency=int(config.get('update_concurrency', update_engine.DEFAULT_CONCURRENCY)),
+        destination_concurrency=int(config.get('destination_concurrency',
+                                               update_engine.DEFAULT_DESTINATION_CONCURRENCY)),
+        push_batch_size=int(config.get('push_batch_size', update_engine.DEFAULT_PUSH_BATCH_SIZE)),
+        update_timeout=float(config.get('update_timeout', update_engine.DEFAULT_UPDATE_TIMEOUT)),
+        priority=job.priority if job is not None else scheduler.PRIORITY_HIGH,
+        owner=job.description if job is not None else None,
+    )
+
+
+def _get_update_results(sources):
+    return [{
+        'source': str(source_instance),
+        'were_errors': source_instance.were_errors,
+        'destinations': source_instance.destination_results,
+    } for source_instance in sources]
+
+
+def _record_source_revisions(sources):
+    revisions = {}
     for source_instance in sources:
+        # Ad hoc destinations, as in /update_hermes, are not what the source is configured to be delivered to.
+        if source_instance.were_errors or source_instance.override_destinations:
+            continue
         try:
-            source_instance.update_by_ssh(ssh_address, hermes_path)
+            revision = source_instance.get_revision()
+            if revision is not None:
+                revisions[source_instance.get_state_key()] = revision
         except Exception as e:
-            logging.exception('Update of source {source_instance} failed.'.format(**locals()))
-            were_errors = True
-        were_errors |= source_instance.were_errors
+            logging.exception('Could not get revision of source {source_instance}.'.format(**locals()))
+    try:
+        delivery_state.get_source_revisions().record_many(revisions)
+    except Exception as e:
+        logging.exception('Could not record revisions of sources.')
+
+
+def _update_list_of_sources(sources, job=None):
+    git_source.share_fetches(sources)
+    were_errors = _create_update_engine(job).run(sources)
+    _record_source_revisions(sources)
+    if job is not None:
+        job.results.extend(_get_update_results(sources))
     return were_errors
 
 
-def _update_list_of_sources(sources):
-    were_errors = False
+def _update_hermes_client(ssh_address, hermes_path, job=None):
+    sources, were_errors = _get_all_sources()
+    for source_instance in sources:
+        source_instance.set_ssh_destination(ssh_address, hermes_path)
+    were_errors |= _update_list_of_sources(sources, job)
+    return were_errors
+
+
+def _update_from_git_repo(repo_url, repo_branch, job=None):
+    sources, were_errors = _create_sources_from_git_repo(repo_url, repo_branch)
+    logging.info('sources: {sources}'.format(**locals()))
+    were_errors |= _update_list_of_sources(sources, job)
+    return were_errors
+
+
+def _update_from_hermes_directory(subdirectory, job=None):
+    sources, were_errors = _create_sources_from_hermes_directory(subdirectory)
+    logging.info('sources: {sources}'.format(**locals()))
+    were_errors |= _update_list_of_sources(sources, job)
+    return were_errors
+
+
+def _update_from_hermes_directory_paths(paths, job=None):
+    sources, were_errors = _create_sources_from_hermes_directory_paths(paths)
+    logging.info('sources: {sources}'.format(**locals()))
+    were_errors |= _update_list_of_sources(sources, job)
+    return were_errors
+
+
+def _evict_git_mirrors(sources):
+    referenced_repo_urls = set(source_instance.repo_url for source_instance in sources
+                               if isinstance(source_instance, git_source.GitSource))
+    max_size_mb = get_courier_config().get('git_cache_max_size_mb', git_cache.DEFAULT_MAX_SIZE_MB)
+    try:
+        git_cache.get_git_mirror_cache().evict(referenced_repo_urls, max_size_mb * 1024 * 1024)
+    except Exception as e:
+        logging.exception('Could not evict git mirrors.')
+
+
+def _update_all(job=None):
+    sources, config_errors = _get_all_sources()
+    were_errors = config_errors | _update_list_of_sources(sources, job)
+    if not config_errors:
+        # With a broken sources config we cannot tell which mirrors are still referenced.
+        _evict_git_mirrors(sources)
+    return were_errors
+
+
+def _get_changed_sources(sources):
+    """Returns sources whose current revision differs from the one last delivered to all their destinations.
+
+    Sources with the same probe key, e.g. the same git repository and branch, are probed once.
+    """
+    source_revisions = delivery_state.get_source_revisions()
+    delivered_revisions = []
+    probed_sources = collections.OrderedDict()
     for source_instance in sources:
         try:
-            source_instance.update()
+            delivered_revision = source_revisions.get_revision(source_instance.get_state_key())
         except Exception as e:
-            logging.exception('Update of source {source_instance} failed.'.format(**locals()))
-            were_errors = True
-        were_errors |= source_instance.were_errors
+            logging.exception('Could not get delivered revision of source {source_instance}.'.format(**locals()))
+            delivered_revision = None
+        delivered_revisions.append(delivered_revision)
+        if delivered_revision is not None:
+            probe_key = source_instance.get_probe_key() or id(source_instance)
+            probed_sources.setdefault(probe_key, source_instance)
+
+    def probe(source_instance):
+        try:
+            return source_instance.probe_revision()
+        except Exception as e:
+            logging.exception('Could not tell if source {source_instance} has changed.'.format(**locals()))
+            return None
+
+    concurrency = int(get_courier_config().get('update_concurrency', update_engine.DEFAULT_CONCURRENCY))
+    probed_revisions = dict(zip(probed_sources, map_concurrently(probe, list(probed_sources.values()), concurrency)))
+    changed_sources = []
+    for source_instance, delivered_revision in zip(sources, delivered_revisions):
+        if delivered_revision is not None:
+            current_revision = probed_revisions[source_instance.get_probe_key() or id(source_instance)]
+            if current_revision is not None and current_revision == delivered_revision:
+                continue
+        changed_sources.append(source_instance)
+    return changed_sources
+
+
+def _update_changed_sources(window, job=None):
+    """Updates sources that have changed since they were last delivered, spread over window seconds."""
+    sources, config_errors = _get_all_sources()
+    changed_sources = _get_changed_sources(sources)
+    logging.info('{} of {} sources have changed since they were last delivered.'.format(len(changed_sources),
+                                                                                       len(sources)))
+    slice_count = min(WARM_UP_SLICES if window > 0 else 1, len(changed_sources))
+    were_errors = config_errors
+    started_at = time.time()
+    for i in range(slice_count):
+        # Random offset within the slice's time slot, so Couriers restarted together do not update in lockstep.
+        delay = started_at + (i + random.random()) * window / slice_count - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        were_errors |= _update_list_of_sources(
+            changed_sources[i * len(changed_sources) // slice_count:(i + 1) * len(changed_sources) // slice_count], job)
+    if changed_sources and not config_errors:
+        _evict_git_mirrors(sources)
     return were_errors
 
 
-def _update_all():
-    sources, were_errors = _create_all_sources()
-    were_errors |= _update_list_of_sources(sources)
-    return were_errors
+def _warm_up(job=None):
+    """Updates changed sources spread over warm_up_window seconds, so restarted Couriers do not update everything at
+    once."""
+    return _update_changed_sources(float(get_courier_config().get('warm_up_window', DEFAULT_WARM_UP_WINDOW)), job)
+
+
+def _reconcile(job=None):
+    """Updates sources that have changed without Courier being told, e.g. because a web hook was lost."""
+    return _update_changed_sources(0, job)
+
+
+def _reconcile_periodically():
+    """Queues a reconciliation job every reconcile_interval seconds, give or take reconcile_jitter of it."""
+    while True:
+        config = get_courier_config()
+        interval = float(config.get('reconcile_interval', DEFAULT_RECONCILE_INTERVAL))
+        if interval <= 0:
+            time.sleep(RECONCILE_DISABLED_CHECK_INTERVAL)
+            continue
+        jitter = float(config.get('reconcile_jitter', DEFAULT_RECONCILE_JITTER))
+        time.sleep(interval * (1 + jitter * random.uniform(-1, 1)))
+        try:
+            _get_job_queue().submit(('reconcile',), 'reconcile', _reconcile, scheduler.PRIORITY_LOW)
+        except Exception as e:
+            logging.exception('Could not queue reconciliation.')
+
+
+def _start_reconciliation():
+    thread = threading.Thread(target=_reconcile_periodically, name='reconciliation')
+    thread.daemon = True
+    thread.start()
 
 
 def _handle_errors(were_errors):
@@ -149,20 +332,39 @@ def _handle_errors(were_errors):
     return 'ok'
 
 
+def _get_job_queue():
+    return jobs.get_job_queue(int(get_courier_config().get('job_workers', jobs.DEFAULT_WORKERS)))
+
+
+def _should_wait_for_job():
+    # Update endpoints wait for the update by default, as they always did. ?wait=false opts into the queued response.
+    wait = web.input(_method='get', wait=None).wait
+    if wait is None:
+        return bool(get_courier_config().get('blocking_updates', True))
+    return wait.lower() in ('1', 'true', 'yes')
+
+
+def _submit_job(key, description, function, priority=scheduler.PRIORITY_HIGH):
+    job = _get_job_queue().submit(key, description, function, priority)
+    if _should_wait_for_job():
+        job.wait()
+        return _handle_errors(job.were_errors)
+    web.ctx.status = '202 Accepted'
+    return json.dumps({'job_id': job.id, 'status': job.status, 'status_url': '/jobs/{}'.format(job.id)})
+
+
 class GitLabWebHook(object):
     def POST(self):
-        were_errors = False
         json_data = json.loads(web.data())
         try:
             repo_url, repo_branch = gitlab.get_repo(json_data)
-            logging.info('Gitlab web hook has triggered. Repository: {}. Branch: {}.'.format(repo_url, repo_branch))
-            sources, were_errors = _create_sources_from_git_repo(repo_url, repo_branch)
-            logging.info('sources: {sources}'.format(**locals()))
-            were_errors |= _update_list_of_sources(sources)
         except gitlab.GitlabException as e:
             logging.exception('Unable to update from gitlab: {e}'.format(**locals()))
-            were_errors = True
-        return _handle_errors(were_errors)
+            return _handle_errors(True)
+        logging.info('Gitlab web hook has triggered. Repository: {}. Branch: {}.'.format(repo_url, repo_branch))
+        return _submit_job(('git', repo_url, repo_branch),
+                           'update from git {} {}'.format(repo_url, repo_branch),
+                           lambda job: _update_from_git_repo(repo_url, repo_branch, job))
 
 
 class Health(object):
@@ -176,10 +378,9 @@ class UpdateFromGit(object):
         url = json_data['url']
         branch = json_data['branch']
         logging.info('Update from git. Repository: {}. Branch: {}.'.format(url, branch))
-        sources, were_errors = _create_sources_from_git_repo(url, branch)
-        logging.info('sources: {sources}'.format(**locals()))
-        were_errors |= _update_list_of_sources(sources)
-        return _handle_errors(were_errors)
+        return _submit_job(('git', url, branch),
+                           'update from git {} {}'.format(url, branch),
+                           lambda job: _update_from_git_repo(url, branch, job))
 
 
 class UpdateFromHermesDirectory(object):
@@ -187,17 +388,29 @@ class UpdateFromHermesDirectory(object):
         json_data = json.loads(web.data() or '{}')
         subdirectory = json_data.get('subdirectory')
         logging.info('Update from hermes-directory. Subdirectory: {}'.format(subdirectory))
-        sources, were_errors = _create_sources_from_hermes_directory(subdirectory)
-        logging.info('sources: {sources}'.format(**locals()))
-        were_errors |= _update_list_of_sources(sources)
-        return _handle_errors(were_errors)
+        return _submit_job(('hermes-directory', subdirectory),
+                           'update from hermes-directory {}'.format(subdirectory),
+                           lambda job: _update_from_hermes_directory(subdirectory, job))
+
+
+class UpdateFromHermesDirectoryPaths(object):
+    def POST(self):
+        json_data = json.loads(web.data() or '{}')
+        paths = json_data.get('paths')
+        if not isinstance(paths, list) or not paths or not all(isinstance(path, basestring) for path in paths):
+            web.ctx.status = '400 Bad Request'
+            return 'Field "paths" has to be a non-empty list of paths.'
+        paths = sorted(set(paths))
+        logging.info('Update from hermes-directory paths: {}'.format(paths))
+        return _submit_job(('hermes-directory-paths', tuple(paths)),
+                           'update from hermes-directory paths {}'.format(', '.join(paths)),
+                           lambda job: _update_from_hermes_directory_paths(paths, job))
 
 
 class UpdateAll(object):
     def POST(self):
         logging.info('Update all.')
-        were_errors = _update_all()
-        return _handle_errors(were_errors)
+        return _submit_job(('all',), 'update all', _update_all, scheduler.PRIORITY_LOW)
 
 
 class HermesAddress(object):
@@ -208,18 +421,49 @@ class HermesAddress(object):
 
 class UpdateHermes(object):
     def POST(self):
-        were_errors = False
         try:
             post_data = json.loads(web.data())
             hermes_ssh = post_data.get('ssh')
             hermes_path = post_data.get('path')
-            logging.info('Update hermes client: ssh={} path={}.'.format(hermes_ssh, hermes_path))
-            were_errors |= _update_hermes_client(hermes_ssh, hermes_path)
         except Exception as e:
             logging.exception('Unable to update hermes')
+            return _handle_errors(True)
+        logging.info('Update hermes client: ssh={} path={}.'.format(hermes_ssh, hermes_path))
+        return _submit_job(('hermes', hermes_ssh, hermes_path),
+                           'update hermes client {} {}'.format(hermes_ssh, hermes_path),
+                           lambda job: _update_hermes_client(hermes_ssh, hermes_path, job),
+                           scheduler.PRIORITY_LOW)
+
+
+class Jobs(object):
+    def GET(self, job_id):
+        job = _get_job_queue().get(job_id)
+        if job is None:
+            web.ctx.status = '404 Not Found'
+            return 'Job {} not found.'.format(job_id)
+        web.header('Content-Type', 'application/json')
+        return json.dumps(job.to_dict())
+
+
+class CircuitBreakers(object):
+    def GET(self):
+        web.header('Content-Type', 'application/json')
+        return json.dumps(circuit_breaker.get_circuit_breakers().get_states())
+
+
+class Scheduler(object):
+    def GET(self):
+        web.header('Content-Type', 'application/json')
+        return json.dumps({
+            'jobs': _get_job_queue().get_state(),
+            'update_slots': scheduler.get_update_scheduler().get_state(),
+        })
 
-            were_errors = True
-        return _handle_errors(were_errors)
+
+class Metrics(object):
+    def GET(self):
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return metrics.render()
 
 
 class Index(object):
@@ -244,6 +488,22 @@ def _set_up_logger(sentry_client):
 
 web.config.debug = False
 
+URLS = (
+    '/gitlab_web_hook', GitLabWebHook.__name__,
+    '/health', Health.__name__,
+    '/update_from_git', UpdateFromGit.__name__,
+    '/update_from_hermes_directory', UpdateFromHermesDirectory.__name__,
+    '/update_from_hermes_directory_paths', UpdateFromHermesDirectoryPaths.__name__,
+    '/update_all', UpdateAll.__name__,
+    '/hermes_address', HermesAddress.__name__,
+    '/update_hermes', UpdateHermes.__name__,
+    '/jobs/(.+)', Jobs.__name__,
+    '/circuit_breakers', CircuitBreakers.__name__,
+    '/scheduler', Scheduler.__name__,
+    '/metrics', Metrics.__name__,
+    '/', Index.__name__,
+)
+
 
 def main():
     tags = {
@@ -252,20 +512,11 @@ def main():
     client = Client(hermes.get_config('config.json', {}).get('sentry-url', ''), auto_log_stacks=True, tags=tags)
     _set_up_logger(client)
 
-    thread = threading.Thread(target=_update_all)
-    thread.start()
+    workspace.get_workspace_manager().remove_stale()
+    _get_job_queue().submit(('warm-up',), 'warm up', _warm_up, scheduler.PRIORITY_LOW)
+    _start_reconciliation()
 
-    urls = (
-        '/gitlab_web_hook', GitLabWebHook.__name__,
-        '/health', Health.__name__,
-        '/update_from_git', UpdateFromGit.__name__,
-        '/update_from_hermes_directory', UpdateFromHermesDirectory.__name__,
-        '/update_all', UpdateAll.__name__,
-        '/hermes_address', HermesAddress.__name__,
-        '/update_hermes', UpdateHermes.__name__,
-        '/', Index.__name__,
-    )
-    app = SentryApplication(client, logging=True, mapping=urls, fvars=globals())
+    app = SentryApplication(client, logging=True, mapping=URLS, fvars=globals())
 
     app.run()
 
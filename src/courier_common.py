@@ -12,3 +12,7 @@ def get_ssh_key_path(filename, config_dir):
         ssh_key_path = hermes.get_config_file_path(filename)
     os.chmod(ssh_key_path, 0o600)
     return ssh_key_path
+
+
+def get_courier_config():
+    return hermes.get_config('config.json', {}) or {}
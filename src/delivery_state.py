@@ -0,0 +1,217 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from util import FileLock, register_after_fork
+
+COURIER_STATE_DIR = '/tmp/courier-state'
+DELIVERIES_FILE_NAME = 'deliveries.json'
+SOURCE_REVISIONS_FILE_NAME = 'sources.json'
+
+
+def _is_excluded(name):
+    # Mirrors rsync's --exclude=".git*" used when pushing.
+    return name.startswith('.git')
+
+
+def _to_bytes(text):
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def _update_digest_with_file(digest, path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+
+
+def get_file_digest(path):
+    digest = hashlib.sha1()
+    _update_digest_with_file(digest, path)
+    return digest.hexdigest()
+
+
+def iterate_pushed_tree(local_path):
+    """Yields ('d', relative_path, path) for directories and ('f', relative_path, path) for regular files that are
+    pushed from local_path, in a deterministic order."""
+    local_path = local_path.rstrip(os.path.sep) or os.path.sep
+    for dirpath, dirnames, filenames in os.walk(local_path):
+        dirnames[:] = sorted(dirname for dirname in dirnames if not _is_excluded(dirname))
+        relative_dirpath = os.path.relpath(dirpath, local_path)
+        yield 'd', relative_dirpath, dirpath
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if _is_excluded(filename) or os.path.islink(path) or not os.path.isfile(path):
+                continue
+            yield 'f', os.path.normpath(os.path.join(relative_dirpath, filename)), path
+
+
+def compute_tree_digest(local_path):
+    """Returns a digest of names and content of directories and regular files that are pushed from local_path."""
+    digest = hashlib.sha1()
+    for entry_type, relative_path, path in iterate_pushed_tree(local_path):
+        digest.update(_to_bytes('{} {}\0'.format(entry_type, relative_path)))
+        if entry_type == 'f':
+            _update_digest_with_file(digest, path)
+    return digest.hexdigest()
+
+
+def compute_tree_fingerprint(local_path):
+    """Returns a digest of names, sizes, modification times and inodes of directories and regular files that are pushed
+    from local_path. It changes whenever the content changes, and is much cheaper to compute than compute_tree_digest,
+    as no file is read."""
+    digest = hashlib.sha1()
+    for entry_type, relative_path, path in iterate_pushed_tree(local_path):
+        stat = os.stat(path)
+        digest.update(_to_bytes('{} {} {} {!r} {}\0'.format(entry_type, relative_path, stat.st_size, stat.st_mtime,
+                                                           stat.st_ino)))
+    return digest.hexdigest()
+
+
+def make_delivery_key(destination_key, hermes_ssh_address, remote_path):
+    return '{} {} {}'.format(destination_key, hermes_ssh_address, os.path.normpath(remote_path))
+
+
+class _StateFile(object):
+    """JSON object persisted in a file in the state directory, loaded on first use.
+
+    The file can be changed by other processes, e.g. job processes. It is loaded again whenever it has changed, and
+    changes are made under a lock on the file, so changes of other processes are not overwritten.
+    """
+
+    def __init__(self, file_name, state_dir=None):
+        self.file_name = file_name
+        self.state_dir = state_dir
+        self.__lock = threading.Lock()
+        self.__entries = None
+        self.__loaded_signature = None
+        register_after_fork(self.__after_fork)
+
+    def __after_fork(self):
+        self.__lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(self.state_dir or COURIER_STATE_DIR, self.file_name)
+
+    def __get_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime, stat.st_size
+
+    def __load(self):
+        signature = self.__get_signature()
+        if self.__entries is not None and signature == self.__loaded_signature:
+            return
+        self.__entries = {}
+        self.__loaded_signature = signature
+        if signature is not None:
+            try:
+                with open(self.path) as f:
+                    self.__entries = json.load(f)
+            except Exception as e:
+                logging.exception('Could not read state from {}.'.format(self.path))
+
+    def __save(self):
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            temp_path = '{}.{}.{}.tmp'.format(self.path, os.getpid(), threading.current_thread().ident)
+            with open(temp_path, 'w') as f:
+                json.dump(self.__entries, f)
+            os.rename(temp_path, self.path)
+            self.__loaded_signature = self.__get_signature()
+        except Exception as e:
+            logging.exception('Could not save state to {}.'.format(self.path))
+
+    def _get(self, key):
+        with self.__lock:
+            self.__load()
+            return self.__entries.get(key)
+
+    def _set(self, key, value):
+        self._set_many({key: value})
+
+    def _set_many(self, values):
+        """Sets values of all keys of values dict, saving the file once."""
+        if not values:
+            return
+        with self.__lock, FileLock(self.path + '.lock'):
+            self.__load()
+            self.__entries.update(values)
+            self.__save()
+
+    def _pop(self, key):
+        self._pop_many([key])
+
+    def _pop_many(self, keys):
+        with self.__lock, FileLock(self.path + '.lock'):
+            self.__load()
+            popped = [key for key in keys if self.__entries.pop(key, None) is not None]
+            if popped:
+                self.__save()
+
+
+class DeliveryState(_StateFile):
+    """Persistent record of content digests last delivered successfully to every destination."""
+
+    def __init__(self, state_dir=None):
+        super(DeliveryState, self).__init__(DELIVERIES_FILE_NAME, state_dir)
+
+    def get_digest(self, delivery_key):
+        delivery = self._get(delivery_key)
+        return delivery and delivery['digest']
+
+    def record(self, delivery_key, digest):
+        self.record_many({delivery_key: digest})
+
+    def record_many(self, digests):
+        """Records deliveries of digests dict values to its delivery keys at once."""
+        delivered_at = time.time()
+        self._set_many(dict((delivery_key, {'digest': digest, 'delivered_at': delivered_at})
+                            for delivery_key, digest in digests.items()))
+
+    def forget(self, delivery_key):
+        self.forget_many([delivery_key])
+
+    def forget_many(self, delivery_keys):
+        self._pop_many(delivery_keys)
+
+
+class SourceRevisions(_StateFile):
+    """Persistent record of revisions of sources, e.g. git commit SHAs, last delivered to all their destinations."""
+
+    def __init__(self, state_dir=None):
+        super(SourceRevisions, self).__init__(SOURCE_REVISIONS_FILE_NAME, state_dir)
+
+    def get_revision(self, source_key):
+        entry = self._get(source_key)
+        return entry and entry['revision']
+
+    def record(self, source_key, revision):
+        self.record_many({source_key: revision})
+
+    def record_many(self, revisions):
+        """Records revisions dict values as delivered revisions of its source keys at once."""
+        delivered_at = time.time()
+        self._set_many(dict((source_key, {'revision': revision, 'delivered_at': delivered_at})
+                            for source_key, revision in revisions.items()))
+
+
+_delivery_state = DeliveryState()
+
+
+def get_delivery_state():
+    return _delivery_state
+
+
+_source_revisions = SourceRevisions()
+
+
+def get_source_revisions():
+    return _source_revisions
@@ -1,72 +1,168 @@
 from __future__ import print_function
 
+import functools
 import json
 import logging
 import os
 import sys
+import threading
+import time
 
 import requests
-from armada import hermes
 
+import circuit_breaker
+import delivery_state
+import discovery
+import manifest
+import metrics
 import remote
+import routing
+import transfer_profile
 from courier_common import get_ssh_key_path
+from util import map_concurrently
 
 sys.path.append('/opt/microservice/src')
 import common.docker_client
 
 
-class DestinationException(Exception):
-    pass
+BATCH_SOURCE_NAME = 'batch'
 
 
-def _get_remote_hermes_address(service_address, override_host_in_header=None):
-    headers = None
-    if override_host_in_header is not None:
-        headers = {'Host': override_host_in_header}
-    url = 'http://{}/hermes_address'.format(service_address)
-    response = requests.get(url, headers=headers)
-    if response.status_code == requests.codes.ok:
-        return json.loads(response.text)
-    raise DestinationException('Could not get ssh address from: {url}. '
-                               'HTTP code: {response.status_code}\n'
-                               'Response:\n{response.text}'.format(**locals()))
+class DestinationException(Exception):
+    pass
 
 
 def get_destinations_for_alias(destination_alias):
-    destination_dicts = hermes.get_config('destinations.json')
+    destinations_config = routing.get_destinations_config()
+    destination_dicts = destinations_config.destination_dicts
     if destination_dicts is None:
         raise DestinationException('Could not find destinations.json.')
     if destination_alias not in destination_dicts:
         logging.error('Destination alias {0} is not defined in destinations.json.'.format(destination_alias))
         return []
-    destination_config_dir = os.path.dirname(hermes.get_config_file_path('destinations.json'))
+    destination_config_dir = destinations_config.destination_config_dir
     if isinstance(destination_dicts[destination_alias], dict):
-        return [Destination(destination_dicts[destination_alias], destination_config_dir)]
+        return [Destination(destination_dicts[destination_alias], destination_config_dir, destination_alias)]
     elif isinstance(destination_dicts[destination_alias], list):
         result = []
         for destination_dict in destination_dicts[destination_alias]:
-            result.append(Destination(destination_dict, destination_config_dir))
+            result.append(Destination(destination_dict, destination_config_dir, destination_alias))
         return result
     else:
         logging.error('Destination definition for alias {0} is neither list nor dict.'.format(destination_alias))
     return []
 
 
+class _PushContent(object):
+    """Content of one push, shared by pushes to all Hermes-addresses of a destination.
+
+    Its manifest or archive is prepared by the first push that needs it, so nothing is prepared when pushes to all
+    Hermes-addresses are skipped.
+    """
+
+    def __init__(self, local_path, digest=None, source_name=None, remote_name=None, with_manifest=False,
+                 with_archive=False):
+        self.local_path = local_path
+        self.digest = digest
+        self.source_name = source_name or os.path.basename(local_path.rstrip(os.path.sep))
+        # Name of the directory in Hermes-address path into which the content is pushed.
+        self.remote_name = remote_name or os.path.basename(local_path.rstrip(os.path.sep))
+        self.with_manifest = with_manifest
+        self.with_archive = with_archive
+        self.local_manifest = None
+        self.archive = None
+        self.__prepared = False
+        self.__lock = threading.Lock()
+
+    def prepare(self):
+        with self.__lock:
+            if self.__prepared:
+                return
+            if self.with_manifest:
+                self.local_manifest = manifest.compute_manifest(self.local_path)
+            if self.with_archive:
+                self.archive = remote.create_tree_archive(self.local_path)
+            self.__prepared = True
+
+    @property
+    def is_renamed(self):
+        """True if the content is pushed into a directory named differently than local_path."""
+        return self.remote_name != os.path.basename(self.local_path.rstrip(os.path.sep))
+
+
 class Destination(object):
     DEFAULT_COURIER_SSH_CONFIG = {
         'user': 'docker',
         'key': 'keys/docker@armada.key',
         'sudo': True,
     }
+    DEFAULT_CONCURRENCY = 8
+    TRANSFER_MODE_RSYNC = 'rsync'
+    TRANSFER_MODE_MANIFEST = 'manifest'
+    TRANSFER_MODE_TAR = 'tar'
+    TRANSFER_MODES = (TRANSFER_MODE_RSYNC, TRANSFER_MODE_MANIFEST, TRANSFER_MODE_TAR)
+    DEFAULT_FULL_VERIFY_INTERVAL = 24 * 60 * 60
+    DEFAULT_TRANSFER_TIMEOUT = 600
 
-    def __init__(self, destination_dict, destination_config_dir=''):
+    def __init__(self, destination_dict, destination_config_dir='', alias=None):
         self.destination_dict = dict(destination_dict)
+        self.alias = alias
         if self.destination_dict['type'] in ('armada-local', 'courier-remote', 'ssh'):
             temp = dict(self.DEFAULT_COURIER_SSH_CONFIG)
             temp.update(self.destination_dict.get('ssh') or {})
             self.destination_dict['ssh'] = temp
         self.destination_config_dir = destination_config_dir
+        self.concurrency = int(self.destination_dict.get('concurrency', self.DEFAULT_CONCURRENCY))
+        self.transfer_mode = self.destination_dict.get('transfer_mode', self.TRANSFER_MODE_RSYNC)
+        if self.transfer_mode not in self.TRANSFER_MODES:
+            raise DestinationException('Unsupported transfer mode: {}'.format(self.transfer_mode))
+        self.discovery_ttl = float(self.destination_dict.get('discovery_ttl', discovery.DEFAULT_TTL))
+        self.discovery_timeout = float(self.destination_dict.get('discovery_timeout', discovery.DEFAULT_TIMEOUT))
+        self.discovery_concurrency = int(self.destination_dict.get('discovery_concurrency',
+                                                                   discovery.DEFAULT_CONCURRENCY))
+        self.full_verify_interval = float(
+            self.destination_dict.get('full_verify_interval', self.DEFAULT_FULL_VERIFY_INTERVAL))
+        self.transfer_timeout = float(self.destination_dict.get('transfer_timeout', self.DEFAULT_TRANSFER_TIMEOUT))
+        try:
+            self.transfer_profile = transfer_profile.TransferProfile(self.destination_dict.get('transfer_profile'))
+        except transfer_profile.TransferProfileException as e:
+            raise DestinationException('Invalid transfer profile: {}'.format(e))
+        # Time by which the update pushing to this destination should finish. Timeouts of all remote operations are
+        # cut down to it.
+        self.deadline = None
+        # Pushes of unchanged content are skipped only for destinations defined in destinations.json. Ad hoc
+        # destinations, as in /update_hermes, usually ask for configs because they have lost them.
+        self.skip_unchanged = bool(self.alias) and self.destination_dict.get('skip_unchanged', True)
         self.were_errors = False
+        self.push_results = []
+
+    def get_key(self):
+        return self.alias or self.destination_dict.get('address')
+
+    def get_batch_key(self):
+        """Destinations with equal batch keys are the same, so sources pushed to them can be pushed together."""
+        return json.dumps([self.alias, self.destination_config_dir, self.destination_dict], sort_keys=True)
+
+    def __is_past_deadline(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def __get_timeout(self, timeout):
+        """Returns timeout cut down to the time left until the deadline."""
+        if self.deadline is None:
+            return timeout
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise DestinationException('Deadline of the update has passed.')
+        return min(timeout, remaining)
+
+    def __get_probe(self, address, default_port):
+        """Returns function telling if address accepts connections, or None if it is only reachable through SSH
+        tunnel."""
+        if 'ssh-tunnel' in self.destination_dict:
+            return None
+        host, port = (address.split(':', 1) + [default_port])[:2]
+        # Not a lambda, so it can be passed to Courier from a job process.
+        return functools.partial(remote.is_port_open, host, int(port))
 
     def __set_ssh_key_path(self, remote_address):
         remote_address['ssh_key_path'] = get_ssh_key_path(remote_address['key'], self.destination_config_dir)
@@ -79,37 +175,54 @@ class Destination(object):
         return result
 
     def __get_hermes_address_from_remote_courier(self):
+        address = self.destination_dict['address']
+        if not circuit_breaker.get_circuit_breakers().allow(address):
+            raise DestinationException('Remote Courier {} has failed repeatedly. Skipping it.'.format(address))
         remote_connection = remote.create_remote_connection_to_http(
-            self.destination_dict['address'],
+            address,
             self.__get_ssh_tunnel(),
             health_check_url='/health',
+            deadline=self.deadline,
         )
+        recorded = False
         try:
             remote_connection.start()
             courier_address = remote_connection.get_address()
-            return _get_remote_hermes_address(courier_address, override_host_in_header=self.destination_dict['address'])
+            hermes_address = discovery.fetch_hermes_address(courier_address, override_host_in_header=address,
+                                                            timeout=self.__get_timeout(self.discovery_timeout))
+            circuit_breaker.get_circuit_breakers().record_success(address)
+            recorded = True
+            return hermes_address
+        except Exception:
+            if not self.__is_past_deadline():
+                circuit_breaker.get_circuit_breakers().record_failure(address, self.__get_probe(address, 80))
+                recorded = True
+            raise
         finally:
+            if not recorded:
+                circuit_breaker.get_circuit_breakers().release(address)
             remote_connection.terminate()
 
-    @staticmethod
-    def __get_armada_addresses():
+    def __get_armada_hermes_addresses(self):
         ship_ip = common.docker_client.get_ship_ip()
-        url = 'http://{}:8900/list?microservice_name=armada'.format(ship_ip)
-        armada_services = requests.get(url, timeout=7).json()
-        addresses = [service['address'] for service in armada_services['result']]
-        return addresses
+        service_addresses = discovery.get_armada_addresses(ship_ip, self.discovery_ttl,
+                                                           self.__get_timeout(self.discovery_timeout))
+        resolved = discovery.resolve_hermes_addresses(
+            service_addresses, self.discovery_ttl, self.__get_timeout(self.discovery_timeout),
+            self.discovery_concurrency)
+        for service_address, hermes_address in resolved:
+            if hermes_address is None:
+                discovery.invalidate(ship_ip=ship_ip)
+                self.were_errors = True
+                continue
+            hermes_address['service_address'] = service_address
+            yield hermes_address
 
     def __get_destination_addresses(self):
         destination_type = self.destination_dict['type']
         if destination_type == 'armada-local':
-            service_addresses = self.__get_armada_addresses()
-            for service_address in service_addresses:
-                try:
-                    hermes_address = _get_remote_hermes_address(service_address)
-                    yield hermes_address
-                except Exception as e:
-                    logging.exception('Could not get hermes address.')
-                    self.were_errors = True
+            for hermes_address in self.__get_armada_hermes_addresses():
+                yield hermes_address
         elif destination_type == 'courier-remote':
             try:
                 yield self.__get_hermes_address_from_remote_courier()
@@ -121,72 +234,363 @@ class Destination(object):
         else:
             raise DestinationException('Unsupported destination type: {destination_type}'.format(**locals()))
 
-    def __push_to_one_hermes_address(self, local_path, hermes_address):
-        self.destination_dict['ssh']['path'] = hermes_address['path']
-        logging.info('Rsyncing path: {} to: {}.'.format(local_path, self.destination_dict))
+    def __get_changed_paths(self, local_manifest, delivery_key):
+        """Returns paths changed since the last push to delivery_key, or None if the whole tree should be verified,
+        and the time of the last full verification."""
+        if local_manifest is None:
+            return None, None
+        remote_manifest, verified_at = manifest.get_manifest_store().get(delivery_key)
+        if remote_manifest is None or manifest.is_full_verify_due(verified_at, self.full_verify_interval):
+            return None, verified_at
+        return manifest.diff_manifests(remote_manifest, local_manifest), verified_at
+
+    def __transfer(self, contents, rsync_ssh_dict, address, changed_paths=None):
+        """Transfers contents to the connected host of Hermes-address address: one content as archive or as rsync
+        delta if changed_paths is given, otherwise all contents in one rsync session. Returns True on success."""
+        source_name = contents[0].source_name if len(contents) == 1 else BATCH_SOURCE_NAME
+        stats = None
+        with metrics.TRANSFER_SECONDS.time(source=source_name, destination=self.get_key()) as timer:
+            if len(contents) == 1 and contents[0].archive is not None:
+                return_code, return_out, return_err = remote.push_archive_to_remote(
+                    contents[0].archive,
+                    contents[0].remote_name,
+                    dict(rsync_ssh_dict),
+                    timeout=self.__get_timeout(self.transfer_timeout),
+                )
+                output = return_out + return_err
+                sent_bytes = len(contents[0].archive)
+            else:
+                compress_level = self.transfer_profile.get_compress_level(address)
+                # Deltas list the files to transfer, so they are never compared by checksum.
+                rsync_options = self.transfer_profile.get_rsync_options(compress_level,
+                                                                        checksum=changed_paths is None)
+                if changed_paths is not None:
+                    return_code, stats, output = remote.push_local_path_to_remote(
+                        contents[0].local_path,
+                        dict(rsync_ssh_dict),
+                        changed_paths=changed_paths,
+                        remote_name=contents[0].remote_name,
+                        timeout=self.__get_timeout(self.transfer_timeout),
+                        rsync_options=rsync_options,
+                    )
+                elif len(contents) == 1:
+                    return_code, stats, output = remote.push_local_path_to_remote(
+                        contents[0].local_path,
+                        dict(rsync_ssh_dict),
+                        remote_name=contents[0].remote_name,
+                        timeout=self.__get_timeout(self.transfer_timeout),
+                        rsync_options=rsync_options,
+                    )
+                else:
+                    return_code, stats, output = remote.push_local_paths_to_remote(
+                        [content.local_path for content in contents],
+                        dict(rsync_ssh_dict),
+                        timeout=self.__get_timeout(self.transfer_timeout),
+                        rsync_options=rsync_options,
+                    )
+                if return_code == 0:
+                    self.transfer_profile.record(address, compress_level, stats)
+                sent_bytes = stats.sent_bytes
+                metrics.TRANSFERRED_FILES.inc(stats.changed_files, source=source_name, destination=self.get_key())
+            if return_code != 0:
+                timer.result = 'failure'
+        metrics.TRANSFERRED_BYTES.inc(sent_bytes, source=source_name, destination=self.get_key())
+        if return_code != 0:
+            logging.error('Push of {source_name} to {address} failed with exit code {return_code}. '
+                          'Last lines of output:\n{output}'.format(**locals()))
+            return False
+        if stats is not None:
+            logging.info('Pushed {source_name} to {address}: {stats.changed_files} files changed, '
+                         '{stats.deleted_files} deleted, {stats.sent_bytes} bytes sent, '
+                         'speedup {stats.speedup}.'.format(**locals()))
+        else:
+            logging.info('Pushed {source_name} to {address}: {sent_bytes} bytes sent.'.format(**locals()))
+        return True
+
+    def __replace_archive_links(self, contents, rsync_ssh_dict, address):
+        """Targets of contents pushed by rsync could be links left by archive pushes, e.g. after the transfer mode of
+        the destination has changed from "tar". They are turned back into directories first."""
+        remote_names = [content.remote_name for content in contents
+                        if content.archive is None and content.remote_name != '.']
+        if not remote_names:
+            return
+        return_code, return_out, return_err = remote.replace_archive_links(
+            remote_names, rsync_ssh_dict, timeout=self.__get_timeout(remote.SSH_COMMAND_TIMEOUT))
+        if return_code != 0:
+            logging.warning('Could not replace links left by archive pushes to {address}:\n'
+                            '{return_out}{return_err}'.format(**locals()))
+
+    def __push_to_one_hermes_address(self, pending, hermes_address):
+        """Pushes pending, list of (content, delivery_key) pairs, to hermes_address over one connection.
+
+        Contents transferred whole by rsync are sent in one rsync session. Archives, deltas and contents that would
+        overlap on the remote host are sent one by one. Returns list of successes in order of pending.
+        """
+        successes = [None] * len(pending)
+        changes = []
+        for i, (content, delivery_key) in enumerate(pending):
+            changed_paths, verified_at = self.__get_changed_paths(content.local_manifest, delivery_key)
+            changes.append((changed_paths, verified_at))
+            if changed_paths == []:
+                logging.info('No files of {} have changed since last push to {}.'.format(content.local_path,
+                                                                                       hermes_address))
+                successes[i] = True
+        if None not in successes:
+            return successes
+
+        batched = []
+        separate = []
+        batched_remote_names = set()
+        for i, (content, delivery_key) in enumerate(pending):
+            if successes[i] is not None:
+                continue
+            # Pushing the whole Hermes directory with --delete would remove other sources pushed in the same session.
+            # Renamed contents need a target directory of their own.
+            if (content.archive is None and changes[i][0] is None and content.remote_name != '.' and
+                    not content.is_renamed and content.remote_name not in batched_remote_names):
+                batched.append(i)
+                batched_remote_names.add(content.remote_name)
+            else:
+                separate.append(i)
+
         rsync_ssh_dict = dict(self.destination_dict['ssh'])
+        rsync_ssh_dict['path'] = hermes_address['path']
+        logging.info('Pushing paths: {} to: {}.'.format(
+            [pending[i][0].local_path for i in batched + separate], rsync_ssh_dict))
         self.__set_ssh_key_path(rsync_ssh_dict)
         remote_connection = remote.create_remote_connection_to_ssh(
             hermes_address['ssh'],
             self.__get_ssh_tunnel(),
             target_ssh_connection_dict=rsync_ssh_dict,
+            deadline=self.deadline,
         )
-        return_code = None
         try:
             remote_connection.start()
             rsync_address = remote_connection.get_address()
             rsync_host, rsync_port = rsync_address.split(':', 1)
             rsync_ssh_dict['host'] = rsync_host
             rsync_ssh_dict['port'] = rsync_port
-            return_code, return_out, return_err = remote.push_local_path_to_remote(
-                local_path,
-                rsync_ssh_dict,
-            )
-            logging.info(
-                'Rsync result:\n'
-                'exit_code={return_code}\n'
-                'stdout:\n{return_out}\n'
-                'stderr:\n{return_err}\n'.format(**locals()))
+            if not remote.open_ssh_connection(rsync_ssh_dict, self.__get_timeout(remote.SSH_COMMAND_TIMEOUT)):
+                logging.warning('Could not open SSH connection to {}.'.format(rsync_address))
+            self.__replace_archive_links([pending[i][0] for i in batched + separate], rsync_ssh_dict,
+                                         hermes_address['ssh'])
+            if batched:
+                success = self.__transfer([pending[i][0] for i in batched], rsync_ssh_dict, hermes_address['ssh'])
+                for i in batched:
+                    successes[i] = success
+            for i in separate:
+                successes[i] = self.__transfer([pending[i][0]], rsync_ssh_dict, hermes_address['ssh'], changes[i][0])
         finally:
             remote_connection.terminate()
 
-        if return_code == 0:
-            logging.info('Rsync successful.')
-        else:
-            logging.error('Rsync failed.')
-            self.were_errors = True
+        for i, (content, delivery_key) in enumerate(pending):
+            if successes[i] and content.local_manifest is not None:
+                changed_paths, verified_at = changes[i]
+                if changed_paths is None:
+                    verified_at = time.time()
+                manifest.get_manifest_store().save(delivery_key, content.local_manifest, verified_at)
+        return successes
+
+    def __get_delivery_key(self, content, hermes_address):
+        remote_path = os.path.join(hermes_address['path'], content.remote_name)
+        return delivery_state.make_delivery_key(self.get_key(), hermes_address['ssh'], remote_path)
+
+    def __push_to_one_hermes_address_safely(self, contents, hermes_address):
+        """Returns push results for every content in order of contents."""
+        push_results = []
+        pending = []
+        for content in contents:
+            push_result = {'address': hermes_address['ssh'], 'path': hermes_address['path'], 'skipped': False,
+                           'suspended': False}
+            push_results.append(push_result)
+            delivery_key = self.__get_delivery_key(content, hermes_address)
+            if (self.skip_unchanged and content.digest and
+                    delivery_state.get_delivery_state().get_digest(delivery_key) == content.digest):
+                logging.info('Content of {} has not changed since last push to {}. Skipping.'.format(
+                    content.local_path, hermes_address))
+                metrics.PUSHES.inc(source=content.source_name, destination=self.get_key(), result='skipped')
+                push_result.update(success=True, skipped=True)
+                continue
+            push_result['delivery_key'] = delivery_key
+            pending.append((content, push_result))
+        if not pending:
+            return push_results
+
+        circuit_breakers = circuit_breaker.get_circuit_breakers()
+        if not circuit_breakers.allow(hermes_address['ssh']):
+            logging.warning('Pushes to {} have failed repeatedly. Skipping it.'.format(hermes_address))
+            for content, push_result in pending:
+                push_result.update(success=False, suspended=True)
+                metrics.PUSHES.inc(source=content.source_name, destination=self.get_key(), result='suspended')
+            return push_results
+        try:
+            for content, push_result in pending:
+                content.prepare()
+        except Exception as e:
+            logging.exception('Could not prepare push to hermes address: {}.'.format(hermes_address))
+            circuit_breakers.release(hermes_address['ssh'])
+            for content, push_result in pending:
+                push_result['success'] = False
+                metrics.PUSHES.inc(source=content.source_name, destination=self.get_key(), result='failure')
+            return push_results
+        recorded = False
+        try:
+            try:
+                successes = self.__push_to_one_hermes_address(
+                    [(content, push_result['delivery_key']) for content, push_result in pending], hermes_address)
+            except Exception as e:
+                logging.exception('Could not push to hermes address: {}.'.format(hermes_address))
+                successes = [False] * len(pending)
+            if all(successes):
+                circuit_breakers.record_success(hermes_address['ssh'])
+                recorded = True
+            elif not self.__is_past_deadline():
+                circuit_breakers.record_failure(hermes_address['ssh'], self.__get_probe(hermes_address['ssh'], 22))
+                recorded = True
+        finally:
+            if not recorded:
+                circuit_breakers.release(hermes_address['ssh'])
+        for (content, push_result), success in zip(pending, successes):
+            push_result['success'] = success
+            metrics.PUSHES.inc(source=content.source_name, destination=self.get_key(),
+                               result='success' if success else 'failure')
+            if not success:
+                # Remote content is unknown now, so the next push must not be skipped nor be a delta.
+                manifest.get_manifest_store().forget(push_result['delivery_key'])
+        if not all(successes) and 'service_address' in hermes_address:
+            discovery.invalidate(ship_ip=common.docker_client.get_ship_ip(),
+                                 service_address=hermes_address['service_address'])
+        return push_results
+
+    @staticmethod
+    def __forget_failed_deliveries(items_push_results):
+        """Forgets digests delivered to Hermes-addresses whose pushes have failed, so their next pushes are not
+        skipped."""
+        delivery_keys = []
+        for push_results in items_push_results:
+            for push_result in push_results:
+                if not push_result['success'] and not push_result['suspended'] and 'delivery_key' in push_result:
+                    delivery_keys.append(push_result['delivery_key'])
+        if delivery_keys:
+            delivery_state.get_delivery_state().forget_many(delivery_keys)
+
+    def __record_deliveries(self, items, items_push_results):
+        """Records digests of items delivered by successful pushes, all at once."""
+        if not self.skip_unchanged:
+            return
+        digests = {}
+        for item, push_results in zip(items, items_push_results):
+            digest = item[1]
+            if not digest:
+                continue
+            for push_result in push_results:
+                if push_result['success'] and not push_result['skipped']:
+                    digests[push_result.pop('delivery_key')] = digest
+        delivery_state.get_delivery_state().record_many(digests)
+
+    @staticmethod
+    def __get_changed_remote_names(contents, items_push_results):
+        """Returns sorted names of directories in Hermes-address path changed by the push, or None if the whole
+        Hermes-directory might have changed."""
+        remote_names = set()
+        for content, push_results in zip(contents, items_push_results):
+            if not all(push_result['skipped'] for push_result in push_results):
+                remote_names.add(content.remote_name)
+        if not remote_names or '.' in remote_names:
+            return None
+        return sorted(remote_names)
 
-    def __update_remote_courier(self):
+    def __update_remote_courier(self, changed_paths=None):
+        """Makes the remote Courier update its sources covering changed_paths, or all its sources if changed_paths
+        is None or it does not support targeted updates."""
         remote_connection = remote.create_remote_connection_to_http(
             self.destination_dict['address'],
             self.__get_ssh_tunnel(),
             health_check_url='/health',
+            deadline=self.deadline,
         )
         try:
             remote_connection.start()
             courier_address = remote_connection.get_address()
             logging.info('Remote Courier address for update: {}'.format(courier_address))
-            url = 'http://{}/update_all'.format(courier_address)
             headers = {'Host': self.destination_dict['address']}
-            response = requests.post(url, headers=headers)
+            # Wait for the remote update to finish so its errors are reported here.
+            if changed_paths is not None:
+                url = 'http://{}/update_from_hermes_directory_paths?wait=true'.format(courier_address)
+                response = remote.get_http_session().post(url, headers=headers,
+                                                          data=json.dumps({'paths': changed_paths}),
+                                                          timeout=self.__get_timeout(self.transfer_timeout))
+                if response.status_code == requests.codes.not_found:
+                    logging.info('Remote Courier {} does not support targeted updates. Updating all its sources.'
+                                 .format(self.destination_dict['address']))
+                    changed_paths = None
+            if changed_paths is None:
+                url = 'http://{}/update_all?wait=true'.format(courier_address)
+                response = remote.get_http_session().post(url, headers=headers,
+                                                          timeout=self.__get_timeout(self.transfer_timeout))
             if response.status_code != requests.codes.ok:
-                logging.error('Could not execute /update_all on remote Courier: {url}.\n'
+                logging.error('Could not update sources on remote Courier: {url}.\n'
                               'HTTP code: {response.status_code}\n'
                               'Response:\n{response.text}'.format(**locals()))
                 self.were_errors = True
+                return False
+            return True
         finally:
             remote_connection.terminate()
 
-    def push(self, local_path):
+    def __create_push_content(self, local_path, digest, source_name, remote_name=None):
+        content = _PushContent(local_path, digest, source_name, remote_name,
+                               with_manifest=self.transfer_mode == self.TRANSFER_MODE_MANIFEST)
+        if self.transfer_mode == self.TRANSFER_MODE_TAR:
+            if content.remote_name == '.':
+                logging.warning('Whole Hermes directory cannot be replaced with an archive. Using rsync.')
+            else:
+                content.with_archive = True
+        return content
+
+    def push_many(self, items):
+        """Pushes items, (local_path, digest, source_name, remote_name) tuples, to every Hermes-address of the
+        destination. remote_name can be omitted, and defaults to the name of local_path.
+
+        Addresses are discovered once, and all items are pushed to one Hermes-address over one connection, so per-host
+        overhead is paid once for all of them. Returns list of (were_errors, push_results) in order of items.
+        """
+        items_push_results = [[] for _ in items]
+        items_errors = [False] * len(items)
         try:
-            for hermes_address in self.__get_destination_addresses():
-                try:
-                    self.__push_to_one_hermes_address(local_path, hermes_address)
-                except Exception as e:
-                    logging.exception('Could not push to hermes address: {}.'.format(hermes_address))
-                    self.were_errors = True
+            with metrics.ADDRESS_DISCOVERY_SECONDS.time(destination=self.get_key()) as timer:
+                hermes_addresses = list(self.__get_destination_addresses())
+                if self.were_errors:
+                    timer.result = 'failure'
+            contents = [self.__create_push_content(*item) for item in items] if hermes_addresses else []
+            addresses_push_results = map_concurrently(
+                lambda hermes_address: self.__push_to_one_hermes_address_safely(contents, hermes_address),
+                hermes_addresses,
+                self.concurrency,
+            )
+            if addresses_push_results:
+                items_push_results = [list(push_results) for push_results in zip(*addresses_push_results)]
+            self.__forget_failed_deliveries(items_push_results)
+            for i, push_results in enumerate(items_push_results):
+                items_errors[i] = not all(push_result['success'] for push_result in push_results)
+            all_push_results = [push_result for push_results in items_push_results for push_result in push_results]
             if self.destination_dict['type'] == 'courier-remote':
-                self.__update_remote_courier()
+                if all_push_results and all(push_result['skipped'] for push_result in all_push_results):
+                    logging.info('Nothing has changed on remote Courier {}. Skipping its update.'.format(
+                        self.destination_dict['address']))
+                elif self.__update_remote_courier(self.__get_changed_remote_names(contents, items_push_results)):
+                    self.__record_deliveries(items, items_push_results)
+            else:
+                self.__record_deliveries(items, items_push_results)
         except Exception as e:
             logging.exception('Could not push.')
             self.were_errors = True
+        for push_results in items_push_results:
+            for push_result in push_results:
+                push_result.pop('delivery_key', None)
+        return [(self.were_errors or item_errors, push_results)
+                for item_errors, push_results in zip(items_errors, items_push_results)]
+
+    def push(self, local_path, digest=None, source_name=None, remote_name=None):
+        [(were_errors, self.push_results)] = self.push_many([(local_path, digest, source_name, remote_name)])
+        self.were_errors |= were_errors
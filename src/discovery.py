@@ -0,0 +1,106 @@
+import json
+import logging
+import threading
+import time
+
+import requests
+
+import remote
+from util import map_concurrently, register_after_fork
+
+ARMADA_API_PORT = 8900
+DEFAULT_TTL = 60
+DEFAULT_TIMEOUT = 3
+DEFAULT_CONCURRENCY = 16
+
+
+class DiscoveryException(Exception):
+    pass
+
+
+class TTLCache(object):
+    def __init__(self):
+        self.__entries = {}
+        self.__lock = threading.Lock()
+        register_after_fork(self.__after_fork)
+
+    def __after_fork(self):
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.time() >= expires_at:
+                del self.__entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self.__lock:
+            self.__entries[key] = (time.time() + ttl, value)
+
+    def invalidate(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+
+_armada_addresses_cache = TTLCache()
+_hermes_addresses_cache = TTLCache()
+
+
+def fetch_hermes_address(service_address, override_host_in_header=None, timeout=DEFAULT_TIMEOUT):
+    headers = None
+    if override_host_in_header is not None:
+        headers = {'Host': override_host_in_header}
+    url = 'http://{}/hermes_address'.format(service_address)
+    response = remote.get_http_session().get(url, headers=headers, timeout=timeout)
+    if response.status_code == requests.codes.ok:
+        return json.loads(response.text)
+    raise DiscoveryException('Could not get ssh address from: {url}. '
+                             'HTTP code: {response.status_code}\n'
+                             'Response:\n{response.text}'.format(**locals()))
+
+
+def get_armada_addresses(ship_ip, ttl=DEFAULT_TTL, timeout=DEFAULT_TIMEOUT):
+    addresses = _armada_addresses_cache.get(ship_ip)
+    if addresses is None:
+        url = 'http://{}:{}/list?microservice_name=armada'.format(ship_ip, ARMADA_API_PORT)
+        armada_services = remote.get_http_session().get(url, timeout=timeout).json()
+        addresses = [service['address'] for service in armada_services['result']]
+        _armada_addresses_cache.set(ship_ip, addresses, ttl)
+    return addresses
+
+
+def get_hermes_address(service_address, ttl=DEFAULT_TTL, timeout=DEFAULT_TIMEOUT):
+    hermes_address = _hermes_addresses_cache.get(service_address)
+    if hermes_address is None:
+        hermes_address = fetch_hermes_address(service_address, timeout=timeout)
+        _hermes_addresses_cache.set(service_address, hermes_address, ttl)
+    return dict(hermes_address)
+
+
+def resolve_hermes_addresses(service_addresses, ttl=DEFAULT_TTL, timeout=DEFAULT_TIMEOUT,
+                             concurrency=DEFAULT_CONCURRENCY):
+    """Resolves Hermes-addresses of all service_addresses concurrently.
+
+    Returns list of (service_address, hermes_address) pairs. hermes_address is None if it could not be resolved.
+    """
+    def resolve(service_address):
+        try:
+            return service_address, get_hermes_address(service_address, ttl, timeout)
+        except Exception as e:
+            logging.exception('Could not get hermes address of {}.'.format(service_address))
+            return service_address, None
+
+    return map_concurrently(resolve, service_addresses, concurrency)
+
+
+def invalidate(ship_ip=None, service_address=None):
+    """Forgets cached addresses, e.g. after a failed push, so they are discovered again next time."""
+    if ship_ip is not None:
+        _armada_addresses_cache.invalidate(ship_ip)
+    if service_address is not None:
+        _hermes_addresses_cache.invalidate(service_address)
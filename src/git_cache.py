@@ -0,0 +1,286 @@
+import logging
+import os
+import pipes
+import re
+import shutil
+import subprocess
+import threading
+import time
+import urllib
+
+import remote
+from courier_common import get_courier_config
+from util import FileLock, get_directory_size, register_after_fork
+
+GIT_CACHE_DIR = '/tmp/courier-git-cache'
+DEFAULT_MAX_SIZE_MB = 2048
+# git fetch --stdin, used to fetch missing blobs in one batch, appeared in git 2.29.
+PARTIAL_CLONE_MIN_GIT_VERSION = (2, 29)
+GIT_VERSION_PATTERN = re.compile(r'(\d+)\.(\d+)')
+PARTIAL_CLONE_FILTER = 'blob:none'
+LS_REMOTE_TIMEOUT = 60
+DEFAULT_GIT_TIMEOUT = 600
+MIRROR_LOCK_SUFFIX = '.lock'
+MIRROR_USE_LOCK_SUFFIX = '.use' + MIRROR_LOCK_SUFFIX
+
+
+class GitCacheException(Exception):
+    pass
+
+
+_git_version = None
+
+
+def get_git_version():
+    global _git_version
+    if _git_version is None:
+        match = GIT_VERSION_PATTERN.search(subprocess.check_output(['git', '--version']))
+        _git_version = tuple(int(number) for number in match.groups()) if match else (0, 0)
+    return _git_version
+
+
+def get_remote_revision(repo_url, branch, git_ssh_script_path):
+    """Returns SHA of the newest commit of branch in repo_url, asking the remote without fetching anything."""
+    command = 'GIT_SSH={} git ls-remote {} refs/heads/{}'.format(git_ssh_script_path, pipes.quote(repo_url),
+                                                                 pipes.quote(branch))
+    return_code, return_out, return_err = remote.execute_local_command(command, LS_REMOTE_TIMEOUT)
+    if return_code != 0:
+        raise GitCacheException('Command failed: {command}\n{return_err}'.format(**locals()))
+    for line in return_out.splitlines():
+        sha, ref = line.split('\t', 1)
+        if ref == 'refs/heads/{}'.format(branch):
+            return sha
+    raise GitCacheException('Branch {branch} not found in {repo_url}.'.format(**locals()))
+
+
+def get_git_timeout():
+    return float(get_courier_config().get('git_timeout', DEFAULT_GIT_TIMEOUT))
+
+
+def _get_timeout(deadline):
+    """Returns seconds left until deadline, or None if there is no deadline."""
+    if deadline is None:
+        return None
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise GitCacheException('Deadline of the git operation has passed.')
+    return remaining
+
+
+def _normalize_subdirectory(subdirectory):
+    return subdirectory.strip('/') if subdirectory else None
+
+
+def _get_attributes_paths(subdirectories):
+    """Returns paths of .gitattributes files in the root and all directories above subdirectories. git archive reads
+    them even when it exports only a subdirectory."""
+    paths = set()
+    for subdirectory in subdirectories:
+        directory = ''
+        for name in [''] + _normalize_subdirectory(subdirectory).split('/')[:-1]:
+            directory = os.path.join(directory, name)
+            paths.add(os.path.join(directory, '.gitattributes'))
+    return sorted(paths)
+
+
+def _get_pathspec(subdirectories):
+    if subdirectories is None:
+        return ''
+    paths = [_normalize_subdirectory(subdirectory) for subdirectory in subdirectories]
+    paths.extend(_get_attributes_paths(subdirectories))
+    return ' -- ' + ' '.join(pipes.quote(path) for path in paths)
+
+
+class GitMirrorCache(object):
+    """Keeps one bare, shallow mirror per repository URL and exports checkouts from it.
+
+    Mirrors are updated with incremental fetches, so only new objects are transferred over the network. If git
+    supports it, mirrors are blobless partial clones: a fetch brings commits and trees, and then only the blobs of the
+    exported subdirectory, so sources shipping a config directory of a big repository do not download the rest of it.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.__cache_dir = cache_dir
+        self.__locks = {}
+        self.__locks_lock = threading.Lock()
+        register_after_fork(self.__after_fork)
+
+    def __after_fork(self):
+        self.__locks = {}
+        self.__locks_lock = threading.Lock()
+
+    @property
+    def cache_dir(self):
+        return self.__cache_dir or GIT_CACHE_DIR
+
+    def get_mirror_path(self, repo_url):
+        return os.path.join(self.cache_dir, urllib.quote(repo_url, '') + '.git')
+
+    def __get_lock(self, mirror_path):
+        with self.__locks_lock:
+            if mirror_path not in self.__locks:
+                self.__locks[mirror_path] = threading.RLock()
+            return self.__locks[mirror_path]
+
+    @staticmethod
+    def __get_file_lock(mirror_path):
+        """Returns lock of the mirror excluding other processes, e.g. job processes."""
+        return FileLock(mirror_path + MIRROR_LOCK_SUFFIX)
+
+    def use(self, repo_url):
+        """Returns context manager keeping the mirror of repo_url from being evicted while in it, e.g. from fetch
+        through checkout. It is shared with other users of the mirror, also in other processes."""
+        return FileLock(self.get_mirror_path(repo_url) + MIRROR_USE_LOCK_SUFFIX, shared=True)
+
+    @staticmethod
+    def __execute(command, deadline=None):
+        return_code, return_out, return_err = remote.execute_local_command(command, _get_timeout(deadline))
+        if return_code != 0:
+            raise GitCacheException('Command failed: {command}\n{return_err}'.format(**locals()))
+        return return_out
+
+    def __init_mirror(self, repo_url, mirror_path):
+        logging.info('Creating git mirror of {} in {}.'.format(repo_url, mirror_path))
+        self.__execute('mkdir -p {mirror_path} && git init --bare --quiet {mirror_path} && '
+                       'git --git-dir={mirror_path} remote add origin {repo_url}'.format(**locals()))
+
+    def __enable_partial_clone(self, mirror_path):
+        """Marks origin as promisor remote, so git accepts blobless fetches into the mirror. Mirrors created by
+        older versions of Courier are converted too."""
+        self.__execute('git --git-dir={mirror_path} config core.repositoryformatversion 1 && '
+                       'git --git-dir={mirror_path} config extensions.partialClone origin && '
+                       'git --git-dir={mirror_path} config remote.origin.promisor true && '
+                       'git --git-dir={mirror_path} config remote.origin.partialCloneFilter {filter}'.format(
+                           filter=PARTIAL_CLONE_FILTER, **locals()))
+
+    def __get_missing_blobs(self, mirror_path, revision, subdirectories, deadline):
+        pathspec = _get_pathspec(subdirectories)
+        tree = self.__execute('git --git-dir={mirror_path} ls-tree -r {revision}{pathspec}'.format(**locals()),
+                              deadline)
+        wanted_blobs = set()
+        for line in tree.splitlines():
+            mode, object_type, sha = line.split('\t', 1)[0].split()
+            if object_type == 'blob':
+                wanted_blobs.add(sha)
+        objects = self.__execute('git --git-dir={mirror_path} rev-list --objects --missing=print {revision}'.format(
+            **locals()), deadline)
+        return sorted(line[1:] for line in objects.splitlines() if line.startswith('?') and line[1:] in wanted_blobs)
+
+    def __fetch_missing_blobs(self, mirror_path, revision, subdirectories, git_ssh_script_path, deadline):
+        missing_blobs = self.__get_missing_blobs(mirror_path, revision, subdirectories, deadline)
+        if not missing_blobs:
+            return
+        logging.debug('Fetching {} missing blobs into {}.'.format(len(missing_blobs), mirror_path))
+        # The same command git uses to fetch missing objects from promisor remotes, but with all blobs in one batch.
+        process = subprocess.Popen(['git', '--git-dir={}'.format(mirror_path), '-c', 'fetch.negotiationAlgorithm=noop',
+                                    'fetch', '--quiet', 'origin', '--no-tags', '--no-write-fetch-head',
+                                    '--recurse-submodules=no', '--filter={}'.format(PARTIAL_CLONE_FILTER), '--stdin'],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   env=dict(os.environ, GIT_SSH=git_ssh_script_path), preexec_fn=os.setsid)
+        with remote.KillTimer(process, _get_timeout(deadline)) as kill_timer:
+            return_err = process.communicate('\n'.join(missing_blobs) + '\n')[1] + kill_timer.get_message()
+        if process.returncode != 0:
+            raise GitCacheException('Could not fetch blobs of {revision}:\n{return_err}'.format(**locals()))
+
+    def fetch(self, repo_url, branch, git_ssh_script_path, subdirectories=None, deadline=None):
+        """Updates the mirror of repo_url with the newest commit of branch and returns its SHA. Only blobs needed
+        to check out subdirectories are guaranteed to be fetched, or of the whole tree if subdirectories is None.
+        Git commands still running at deadline are killed."""
+        mirror_path = self.get_mirror_path(repo_url)
+        partial_clone = get_git_version() >= PARTIAL_CLONE_MIN_GIT_VERSION
+        with self.__get_lock(mirror_path), self.__get_file_lock(mirror_path):
+            if not os.path.exists(os.path.join(mirror_path, 'HEAD')):
+                if os.path.exists(mirror_path):
+                    shutil.rmtree(mirror_path)
+                self.__init_mirror(repo_url, mirror_path)
+            filter_option = ''
+            if partial_clone:
+                self.__enable_partial_clone(mirror_path)
+                filter_option = '--filter={} '.format(PARTIAL_CLONE_FILTER)
+            fetch_command = ('GIT_SSH={git_ssh_script_path} git --git-dir={mirror_path} fetch --quiet --depth=1 '
+                             '{filter_option}origin +refs/heads/{branch}:refs/heads/{branch}').format(**locals())
+            try:
+                self.__execute(fetch_command, deadline)
+                revision = self.__execute('git --git-dir={mirror_path} rev-parse refs/heads/{branch}'.format(
+                    **locals()), deadline).strip()
+                if partial_clone:
+                    self.__fetch_missing_blobs(mirror_path, revision, subdirectories, git_ssh_script_path, deadline)
+            except GitCacheException as e:
+                raise GitCacheException('Error on fetching from git: {e}'.format(**locals()))
+            os.utime(mirror_path, None)
+        return revision
+
+    def has_revision(self, repo_url, revision):
+        mirror_path = self.get_mirror_path(repo_url)
+        return_code, _, _ = remote.execute_local_command(
+            'git --git-dir={mirror_path} cat-file -e {revision}^{{commit}}'.format(**locals()))
+        return return_code == 0
+
+    def checkout(self, repo_url, revision, local_path, git_ssh_script_path, subdirectory=None, deadline=None):
+        """Exports the tree of revision, or only its subdirectory, into local_path. The mirror's index and refs are
+        not touched. Blobs missing from a partial clone are fetched with git_ssh_script_path. The export is killed if
+        it is still running at deadline."""
+        mirror_path = self.get_mirror_path(repo_url)
+        subdirectory = _normalize_subdirectory(subdirectory)
+        if not os.path.exists(local_path):
+            os.makedirs(local_path)
+        archive_command = ['git', '--git-dir={}'.format(mirror_path), 'archive', '--format=tar', revision]
+        if subdirectory:
+            archive_command.append(subdirectory)
+        timeout = _get_timeout(deadline)
+        archive_process = subprocess.Popen(archive_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                           env=dict(os.environ, GIT_SSH=git_ssh_script_path), preexec_fn=os.setsid)
+        tar_process = subprocess.Popen(['tar', '-x', '-C', local_path], stdin=archive_process.stdout,
+                                       stderr=subprocess.PIPE, preexec_fn=os.setsid)
+        archive_process.stdout.close()
+        with remote.KillTimer(archive_process, timeout) as kill_timer, remote.KillTimer(tar_process, timeout):
+            tar_err = tar_process.communicate()[1]
+            archive_err = archive_process.stderr.read() + kill_timer.get_message()
+            archive_process.wait()
+        if archive_process.returncode != 0 or tar_process.returncode != 0:
+            raise GitCacheException('Could not check out {revision} of {repo_url}:\n{archive_err}{tar_err}'.format(
+                **locals()))
+
+    def evict(self, referenced_repo_urls, max_size_bytes):
+        """Removes mirrors of repositories no longer referenced in sources, then least recently fetched
+        mirrors until the cache fits into max_size_bytes. Mirrors in use are skipped."""
+        if not os.path.isdir(self.cache_dir):
+            return
+        referenced_mirror_paths = set(self.get_mirror_path(repo_url) for repo_url in referenced_repo_urls)
+        mirrors = []
+        for mirror_name in os.listdir(self.cache_dir):
+            if mirror_name.endswith(MIRROR_LOCK_SUFFIX):
+                continue
+            mirror_path = os.path.join(self.cache_dir, mirror_name)
+            if mirror_path not in referenced_mirror_paths:
+                logging.info('Removing unreferenced git mirror {}.'.format(mirror_path))
+                if self.__remove_mirror(mirror_path):
+                    continue
+            mirrors.append((os.path.getmtime(mirror_path), get_directory_size(mirror_path), mirror_path))
+        total_size = sum(size for _, size, _ in mirrors)
+        for _, size, mirror_path in sorted(mirrors):
+            if total_size <= max_size_bytes:
+                break
+            logging.info('Git mirror cache exceeds its size limit. Removing {}.'.format(mirror_path))
+            if self.__remove_mirror(mirror_path):
+                total_size -= size
+
+    def __remove_mirror(self, mirror_path):
+        """Removes the mirror unless it is in use. Returns True if it has been removed."""
+        use_lock = FileLock(mirror_path + MIRROR_USE_LOCK_SUFFIX)
+        if not use_lock.acquire(blocking=False):
+            logging.info('Git mirror {} is in use. Not removing it.'.format(mirror_path))
+            return False
+        try:
+            with self.__get_lock(mirror_path), self.__get_file_lock(mirror_path):
+                shutil.rmtree(mirror_path, ignore_errors=True)
+        finally:
+            use_lock.release()
+        return True
+
+
+_git_mirror_cache = GitMirrorCache()
+
+
+def get_git_mirror_cache():
+    return _git_mirror_cache
@@ -2,12 +2,14 @@ from __future__ import print_function
 
 import os
 import re
-import shutil
+import threading
+import time
 import urllib
 
-import remote
+import git_cache
+import metrics
 import source
-from util import create_temp_directory
+import workspace
 
 
 class GitException(Exception):
@@ -25,12 +27,13 @@ class GitSource(source.Source):
         self.repo_name = REPO_NAME_PATTERN.search(self.repo_url).group(1)
         self.ssh_key_path = ssh_key_path
         self.branch = branch
+        self.shared_fetches = None
+        self.revision = None
 
-    def update(self, override_destinations=None):
-        super(GitSource, self).update(override_destinations)
-        shutil.rmtree(self.local_path)
+    def __str__(self):
+        return 'GitSource({self.repo_url} {self.branch} subdirectory={self.subdirectory})'.format(**locals())
 
-    def _pull(self):
+    def get_git_ssh_script_path(self):
         git_ssh_script_name = urllib.quote(self.ssh_key_path, '') + '.sh'  # Create unique filename.
         git_ssh_script_path = os.path.join(GIT_SSH_SCRIPTS_DIR, git_ssh_script_name)
         if not os.path.exists(git_ssh_script_path):
@@ -40,12 +43,103 @@ class GitSource(source.Source):
             with open(git_ssh_script_path, 'w') as git_ssh_script_file:
                 git_ssh_script_file.write(git_ssh_command)
             os.chmod(git_ssh_script_path, 0o755)
+        return git_ssh_script_path
+
+    def get_revision(self):
+        return self.revision
+
+    def probe_revision(self):
+        try:
+            return git_cache.get_remote_revision(self.repo_url, self.branch, self.get_git_ssh_script_path())
+        except git_cache.GitCacheException as e:
+            raise GitException(str(e))
+
+    def get_probe_key(self):
+        return 'git', self.repo_url, self.branch, self.ssh_key_path
+
+    def get_git_deadline(self):
+        """Returns time by which a git operation started now has to finish: in git_timeout seconds, and not later than
+        the deadline of the update."""
+        deadline = time.time() + git_cache.get_git_timeout()
+        if self.deadline is not None:
+            deadline = min(deadline, self.deadline)
+        return deadline
+
+    def _pull(self):
+        mirror_cache = git_cache.get_git_mirror_cache()
+        try:
+            # The mirror is not evicted between the fetch and the checkout.
+            with mirror_cache.use(self.repo_url):
+                revision = None
+                if self.shared_fetches is not None:
+                    revision = self.shared_fetches.fetch(self)
+                    # The mirror could have been evicted after the shared fetch, before this source started using it.
+                    if not mirror_cache.has_revision(self.repo_url, revision):
+                        revision = None
+                if revision is None:
+                    revision = _fetch(self.repo_url, self.branch, self.get_git_ssh_script_path(),
+                                      [self.subdirectory] if self.subdirectory else None, self.get_git_deadline())
+                self.revision = revision
+                self.workspace = workspace.get_workspace_manager().create()
+                local_path = os.path.join(self.workspace.path, self.repo_name)
+                with metrics.GIT_CHECKOUT_SECONDS.time(repository=self.repo_url):
+                    mirror_cache.checkout(self.repo_url, revision, local_path, self.get_git_ssh_script_path(),
+                                          self.subdirectory, self.get_git_deadline())
+            self.workspace.measure()
+        except git_cache.GitCacheException as e:
+            raise GitException(str(e))
+        return local_path
+
+
+def _fetch(repo_url, branch, git_ssh_script_path, subdirectories, deadline):
+    with metrics.GIT_FETCH_SECONDS.time(repository=repo_url):
+        return git_cache.get_git_mirror_cache().fetch(repo_url, branch, git_ssh_script_path, subdirectories, deadline)
+
+
+class SharedGitFetches(object):
+    """Fetches every repository and branch at most once for a group of sources updated together.
+
+    The first source of a repository and branch to be pulled fetches blobs needed by all sources of the group, and
+    the others check out their subdirectories from the same revision. Only sources with the same SSH key share a
+    fetch, so a source is never given a revision that its own key could not fetch.
+    """
+
+    def __init__(self, sources):
+        self.__subdirectories = {}
+        for source_instance in sources:
+            key = self.__get_key(source_instance)
+            subdirectories = self.__subdirectories.get(key, [])
+            if subdirectories is None or not source_instance.subdirectory:
+                self.__subdirectories[key] = None
+            else:
+                self.__subdirectories[key] = subdirectories + [source_instance.subdirectory]
+        self.__results = {}
+        self.__locks = dict((key, threading.Lock()) for key in self.__subdirectories)
+
+    @staticmethod
+    def __get_key(source_instance):
+        return source_instance.repo_url, source_instance.branch, source_instance.ssh_key_path
+
+    def fetch(self, source_instance):
+        key = self.__get_key(source_instance)
+        with self.__locks[key]:
+            if key not in self.__results:
+                try:
+                    self.__results[key] = (_fetch(source_instance.repo_url, source_instance.branch,
+                                                  source_instance.get_git_ssh_script_path(),
+                                                  self.__subdirectories[key], source_instance.get_git_deadline()), None)
+                except Exception as e:
+                    self.__results[key] = (None, e)
+            revision, error = self.__results[key]
+        if error is not None:
+            raise error
+        return revision
+
 
-        local_path = create_temp_directory()
-        clone_command = ('mkdir -p {local_path} && cd {local_path} && '
-                         'GIT_SSH={git_ssh_script_path} '
-                         'git clone -b {self.branch} --depth=1 {self.repo_url}').format(**locals())
-        return_code, return_out, return_err = remote.execute_local_command(clone_command)
-        if return_code != 0:
-            raise GitException('Error on fetching from git: {return_err}'.format(**locals()))
-        return os.path.join(local_path, self.repo_name)
+def share_fetches(sources):
+    """Makes git sources among sources that pull the same repository and branch with the same SSH key share one
+    fetch."""
+    git_sources = [source_instance for source_instance in sources if isinstance(source_instance, GitSource)]
+    shared_fetches = SharedGitFetches(git_sources)
+    for source_instance in git_sources:
+        source_instance.shared_fetches = shared_fetches
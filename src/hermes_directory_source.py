@@ -1,10 +1,23 @@
 import os
-import shutil
+import threading
 
 import courier
+import delivery_state
 import source
 from courier_common import HERMES_DIRECTORY
-from util import create_temp_directory
+from util import register_after_fork
+
+# Digests of probed directories, with fingerprints of the directories at the time the digests were computed.
+_probed_digests = {}
+_probed_digests_lock = threading.Lock()
+
+
+def _after_fork():
+    global _probed_digests_lock
+    _probed_digests_lock = threading.Lock()
+
+
+register_after_fork(_after_fork)
 
 
 class HermesDirectorySource(source.Source):
@@ -15,11 +28,15 @@ class HermesDirectorySource(source.Source):
         if not self.destination_path:
             self.destination_path = self.subdirectory
 
+    def __str__(self):
+        return 'HermesDirectorySource(subdirectory={self.subdirectory})'.format(**locals())
+
     def _pull(self):
-        if self.subdirectory and self.destination_path:
-            local_path = create_temp_directory()
-            shutil.copytree(os.path.join(HERMES_DIRECTORY, self.subdirectory),
-                            os.path.join(local_path, self.subdirectory))
+        """Returns path in HERMES_DIRECTORY to push from. Nothing is copied, so there is nothing to clean up."""
+        if self.subdirectory:
+            local_path = os.path.join(HERMES_DIRECTORY, self.subdirectory.strip('/'))
+            if not os.path.isdir(local_path):
+                raise courier.CourierException('Directory {local_path} does not exist.'.format(**locals()))
         else:
             local_path = os.path.join(HERMES_DIRECTORY, '.')
             if not os.path.exists(local_path) or len(os.listdir(local_path)) == 0:
@@ -28,3 +45,25 @@ class HermesDirectorySource(source.Source):
                     Please make sure you run courier with parameter like --volume /etc/opt:{0}
                     """.format(HERMES_DIRECTORY))
         return local_path
+
+    def _get_pushed_path_and_remote_name(self, local_path):
+        """Subdirectory is pushed in place under destination_path name, as renaming it would change HERMES_DIRECTORY."""
+        if self.subdirectory:
+            return local_path, self.destination_path.strip('/')
+        return super(HermesDirectorySource, self)._get_pushed_path_and_remote_name(local_path)
+
+    def get_probe_key(self):
+        return 'hermes-directory', self.subdirectory
+
+    def probe_revision(self):
+        """Returns digest of the directory. It is computed again only if fingerprint of the directory has changed
+        since the last probe."""
+        local_path = self._pull()
+        fingerprint = delivery_state.compute_tree_fingerprint(local_path)
+        with _probed_digests_lock:
+            probed_fingerprint, digest = _probed_digests.get(local_path, (None, None))
+        if fingerprint != probed_fingerprint:
+            digest = delivery_state.compute_tree_digest(local_path)
+            with _probed_digests_lock:
+                _probed_digests[local_path] = (fingerprint, digest)
+        return digest
@@ -0,0 +1,451 @@
+import collections
+import itertools
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import signal
+import threading
+import time
+
+import circuit_breaker
+import discovery
+import metrics
+import remote
+import scheduler
+import transfer_profile
+import workspace
+from util import run_after_fork, run_before_fork
+
+POLL_INTERVAL = 1
+# How long a job process may take to exit after sending its result.
+EXIT_TIMEOUT = 10
+
+
+def _get_descendants(pid):
+    """Returns (pid, start time) of all processes started by process pid that are still its descendants."""
+    children = collections.defaultdict(list)
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # Command name is in parentheses and can contain spaces. Parent PID and start time are the second and the 20th
+        # fields after it.
+        fields = stat.rsplit(')', 1)[1].split()
+        children[int(fields[1])].append((int(name), fields[19]))
+    result = []
+    parents = [pid]
+    while parents:
+        for child, start_time in children.get(parents.pop(), []):
+            result.append((child, start_time))
+            parents.append(child)
+    return result
+
+
+def _get_start_time(pid):
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().rsplit(')', 1)[1].split()[19]
+    except (IOError, OSError):
+        return None
+
+
+def _kill_processes(processes):
+    """Kills processes, (pid, start time) pairs, unless they have ended and their PIDs went to other processes."""
+    for pid, start_time in processes:
+        if _get_start_time(pid) != start_time:
+            continue
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def _kill_process_tree(pid):
+    """Kills process and all processes it has started, including those started in new sessions, like rsync."""
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
+    _kill_processes(_get_descendants(pid))
+
+
+def _reset_logging_locks():
+    # The process is forked from a multi-threaded one, so locks of logging could have been held by other threads.
+    logging._lock = threading.RLock()
+    for handler_reference in logging._handlerList:
+        handler = handler_reference()
+        if handler is not None:
+            handler.createLock()
+
+
+class JobProcessException(Exception):
+    pass
+
+
+class _ParentClient(object):
+    """Calls methods of objects shared by Courier with a job process, through connection. Runs in the job process."""
+
+    def __init__(self, connection):
+        self.__connection = connection
+        self.__calls = {}
+        self.__call_ids = itertools.count()
+        self.__lock = threading.Lock()
+        self.__closed = False
+        receiver = threading.Thread(target=self.__receive, name='parent-client')
+        receiver.daemon = True
+        receiver.start()
+
+    def call(self, name, method, *args):
+        finished = threading.Event()
+        call = [finished, None, None]
+        with self.__lock:
+            if self.__closed:
+                raise JobProcessException('Connection to Courier is closed.')
+            call_id = next(self.__call_ids)
+            self.__calls[call_id] = call
+            self.__connection.send((call_id, name, method, args))
+        finished.wait()
+        result, error = call[1:]
+        if error is not None:
+            raise error
+        return result
+
+    def __receive(self):
+        while True:
+            try:
+                call_id, result, error = self.__connection.recv()
+            except (EOFError, IOError):
+                break
+            with self.__lock:
+                call = self.__calls.pop(call_id)
+            call[1:] = result, error
+            call[0].set()
+        with self.__lock:
+            self.__closed = True
+            calls, self.__calls = self.__calls.values(), {}
+        for call in calls:
+            call[2] = JobProcessException('Connection to Courier is closed.')
+            call[0].set()
+
+
+class _SharedObject(object):
+    """Object of Courier named name, whose methods are called from a job process."""
+
+    def __init__(self, parent, name):
+        self.__parent = parent
+        self.__name = name
+
+    def __getattr__(self, method):
+        return lambda *args: self.__parent.call(self.__name, method, *args)
+
+
+class _SharedSlot(object):
+    def __init__(self, parent, priority, owner, group):
+        self.parent = parent
+        self.priority = priority
+        self.owner = owner
+        self.group = group
+        self.slot_id = None
+
+    def __enter__(self):
+        self.slot_id = self.parent.call('update_slots', 'acquire', self.priority, self.owner, self.group)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.parent.call('update_slots', 'release', self.slot_id)
+        return False
+
+
+class _SharedUpdateScheduler(object):
+    """Update scheduler of a job process. Its slots are granted by the scheduler of Courier, shared by all jobs."""
+
+    def __init__(self, parent):
+        self.__parent = parent
+
+    def slot(self, priority, owner, group):
+        if priority not in scheduler.PRIORITIES:
+            raise ValueError('Unsupported priority: {}'.format(priority))
+        return _SharedSlot(self.__parent, priority, owner, group)
+
+
+class _SharedWorkspaceManager(object):
+    """Workspace manager of a job process. Workspaces are created by the workspace manager of Courier, so they count
+    towards the disk budget shared by all jobs."""
+
+    def __init__(self, parent):
+        self.__parent = parent
+
+    def create(self):
+        return workspace.Workspace(self, self.__parent.call('workspaces', 'create'))
+
+    def _acquire(self, shared_workspace):
+        self.__parent.call('workspaces', 'acquire', shared_workspace.path)
+
+    def _release(self, shared_workspace):
+        self.__parent.call('workspaces', 'release', shared_workspace.path)
+
+    def _measure(self, shared_workspace):
+        self.__parent.call('workspaces', 'measure', shared_workspace.path)
+
+
+def _use_parent_state(parent):
+    """Makes the job process use update slots, workspaces, circuit breakers, cached discovery results and transfer
+    measurements of Courier, so they are shared with other jobs and outlive the job."""
+    scheduler._update_scheduler = _SharedUpdateScheduler(parent)
+    workspace._workspace_manager = _SharedWorkspaceManager(parent)
+    circuit_breaker._circuit_breakers = _SharedObject(parent, 'circuit_breakers')
+    discovery._armada_addresses_cache = _SharedObject(parent, 'armada_addresses_cache')
+    discovery._hermes_addresses_cache = _SharedObject(parent, 'hermes_addresses_cache')
+    transfer_profile._transfer_history = _SharedObject(parent, 'transfer_history')
+
+
+class _SlotService(object):
+    """Holds update slots for a job process. Slots it has not released are released when it ends."""
+
+    def __init__(self):
+        self.__slots = {}
+        self.__slot_ids = itertools.count()
+        self.__lock = threading.Lock()
+        self.__closed = False
+
+    def acquire(self, priority, owner, group):
+        slot = scheduler.get_update_scheduler().slot(priority, owner, group)
+        slot.__enter__()
+        with self.__lock:
+            if not self.__closed:
+                slot_id = next(self.__slot_ids)
+                self.__slots[slot_id] = slot
+                return slot_id
+        slot.__exit__(None, None, None)
+        raise JobProcessException('Job process has ended.')
+
+    def release(self, slot_id):
+        with self.__lock:
+            slot = self.__slots.pop(slot_id, None)
+        if slot is not None:
+            slot.__exit__(None, None, None)
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+            slots, self.__slots = self.__slots.values(), {}
+        for slot in slots:
+            slot.__exit__(None, None, None)
+
+
+class _WorkspaceService(object):
+    """Holds references to workspaces for a job process. References it has not released are released when it ends,
+    so workspaces of a crashed job are removed."""
+
+    def __init__(self):
+        # Path to [workspace, number of references held by the job process].
+        self.__workspaces = {}
+        self.__lock = threading.Lock()
+        self.__closed = False
+
+    def __get(self, path):
+        with self.__lock:
+            if path not in self.__workspaces:
+                raise workspace.WorkspaceException('Workspace {} has already been removed.'.format(path))
+            return self.__workspaces[path][0]
+
+    def create(self):
+        created_workspace = workspace.get_workspace_manager().create()
+        with self.__lock:
+            if not self.__closed:
+                self.__workspaces[created_workspace.path] = [created_workspace, 1]
+                return created_workspace.path
+        created_workspace.release()
+        raise JobProcessException('Job process has ended.')
+
+    def acquire(self, path):
+        with self.__lock:
+            entry = self.__workspaces.get(path)
+            if entry is None:
+                raise workspace.WorkspaceException('Workspace {} has already been removed.'.format(path))
+            entry[0].acquire()
+            entry[1] += 1
+
+    def release(self, path):
+        with self.__lock:
+            entry = self.__workspaces.get(path)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.__workspaces[path]
+        entry[0].release()
+
+    def measure(self, path):
+        self.__get(path).measure()
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+            entries, self.__workspaces = self.__workspaces.values(), {}
+        for held_workspace, references in entries:
+            for _ in range(references):
+                held_workspace.release()
+
+
+class _ParentServer(object):
+    """Serves calls of a job process to objects shared with it, each in a thread of its own, as some of them wait, e.g.
+    for a free update slot. Runs in Courier."""
+
+    def __init__(self, connection):
+        self.__connection = connection
+        self.__send_lock = threading.Lock()
+        self.__connection_closed = False
+        self.__slots = _SlotService()
+        self.__workspaces = _WorkspaceService()
+        self.__objects = {
+            'update_slots': self.__slots,
+            'workspaces': self.__workspaces,
+            'circuit_breakers': circuit_breaker.get_circuit_breakers(),
+            'armada_addresses_cache': discovery._armada_addresses_cache,
+            'hermes_addresses_cache': discovery._hermes_addresses_cache,
+            'transfer_history': transfer_profile.get_transfer_history(),
+        }
+        receiver = threading.Thread(target=self.__receive, name='parent-server')
+        receiver.daemon = True
+        receiver.start()
+
+    def __receive(self):
+        while True:
+            try:
+                request = self.__connection.recv()
+            except (EOFError, IOError):
+                break
+            handler = threading.Thread(target=self.__handle, args=request, name='parent-server-call')
+            handler.daemon = True
+            handler.start()
+        # The connection is closed only here, once the job process and all processes it has started are gone.
+        with self.__send_lock:
+            self.__connection_closed = True
+            self.__connection.close()
+
+    def __handle(self, call_id, name, method, args):
+        try:
+            response = (call_id, getattr(self.__objects[name], method)(*args), None)
+        except Exception as e:
+            response = (call_id, None, e)
+        with self.__send_lock:
+            if self.__connection_closed:
+                return
+            try:
+                self.__connection.send(response)
+            except (IOError, OSError):
+                pass
+            except Exception as e:
+                # E.g. a result or an exception that cannot be pickled.
+                self.__connection.send((call_id, None, JobProcessException(str(response[2] or e))))
+
+    def close(self):
+        """Releases update slots and workspaces the job process has left behind."""
+        self.__slots.close()
+        self.__workspaces.close()
+
+
+def _run_job(function, job, connection, parent_connection, ssh_control_dir, memory_limit_mb):
+    """Runs in the job process. Sends (were_errors, results, changes of metrics) back through connection. Shared
+    objects of Courier are called through parent_connection."""
+    os.setsid()
+    _reset_logging_locks()
+    run_after_fork()
+    if memory_limit_mb:
+        memory_limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    _use_parent_state(_ParentClient(parent_connection))
+    remote.use_own_connections(ssh_control_dir)
+    metrics_values = metrics.get_values()
+    try:
+        were_errors = bool(function(job))
+    except Exception as e:
+        logging.exception('Job {} ({}) failed.'.format(job.id, job.description))
+        were_errors = True
+    finally:
+        # SSH tunnels run in sessions of their own and SSH master connections in background, so they would outlive
+        # the process.
+        remote.close_connections()
+    connection.send((were_errors, job.results, metrics.get_changes(metrics_values)))
+    connection.close()
+
+
+def run_in_process(function, job, timeout=None, memory_limit_mb=None):
+    """Runs function(job) in a new process and returns what it returns, or True if the process has crashed or has
+    not finished in timeout seconds. Then it is killed with all processes it has started.
+
+    Results of the job and changes of metrics are passed back to this process. Update slots, workspaces, circuit
+    breakers, cached discovery results and transfer measurements stay in this process and are shared with the job
+    process, so limits apply to all jobs together. Address space of the job process is limited to memory_limit_mb, so
+    a runaway job fails with MemoryError instead of exhausting memory of Courier.
+    """
+    try:
+        run_before_fork()
+    except Exception as e:
+        logging.exception('Could not prepare process of job {} ({}).'.format(job.id, job.description))
+    ssh_control_dir = os.path.join(remote.SSH_CONTROL_DIR, 'job-{}'.format(job.id))
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_job, name='job-{}'.format(job.id),
+                                      args=(function, job, sender, child_connection, ssh_control_dir,
+                                            memory_limit_mb))
+    process.start()
+    sender.close()
+    child_connection.close()
+    parent_server = _ParentServer(parent_connection)
+    deadline = time.time() + timeout if timeout else None
+    result = None
+    timed_out = False
+    # Processes started by the job process, recorded while it runs. Those started in new sessions would not be found
+    # once it has crashed.
+    descendants = set()
+    try:
+        while True:
+            descendants.update(_get_descendants(process.pid))
+            if deadline is not None and time.time() >= deadline:
+                timed_out = True
+                break
+            wait = POLL_INTERVAL if deadline is None else min(POLL_INTERVAL, max(deadline - time.time(), 0))
+            # Processes started by the job process inherit the pipe and can keep it open after the job process ends.
+            exited = not process.is_alive()
+            if receiver.poll(0 if exited else wait):
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    pass
+                break
+            if exited:
+                break
+    finally:
+        receiver.close()
+        process.join(EXIT_TIMEOUT if result is not None else 0)
+        if process.is_alive():
+            _kill_process_tree(process.pid)
+            process.join()
+        _kill_processes(descendants)
+        parent_server.close()
+        remote.close_ssh_master_connections(ssh_control_dir)
+        shutil.rmtree(ssh_control_dir, ignore_errors=True)
+
+    if timed_out:
+        logging.error('Job {} ({}) has not finished in {} seconds. Its process was killed.'.format(
+            job.id, job.description, timeout))
+        metrics.JOB_PROCESSES.inc(result='timeout')
+        return True
+    if result is None:
+        logging.error('Process of job {} ({}) has crashed with exit code {}.'.format(
+            job.id, job.description, process.exitcode))
+        metrics.JOB_PROCESSES.inc(result='crash')
+        return True
+    were_errors, results, metrics_changes = result
+    job.results.extend(results)
+    metrics.apply_changes(metrics_changes)
+    metrics.JOB_PROCESSES.inc(result='finished')
+    return were_errors
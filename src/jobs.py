@@ -0,0 +1,222 @@
+import collections
+import logging
+import threading
+import time
+import uuid
+
+import job_process
+import metrics
+import scheduler
+from courier_common import get_courier_config
+from util import register_after_fork
+
+DEFAULT_WORKERS = 2
+MAX_FINISHED_JOBS = 1000
+EXECUTION_THREAD = 'thread'
+EXECUTION_PROCESS = 'process'
+DEFAULT_TIMEOUT = 3600
+
+
+class Job(object):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    def __init__(self, key, description, function, priority=scheduler.PRIORITY_HIGH):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.description = description
+        self.function = function
+        self.priority = priority
+        self.status = self.QUEUED
+        self.were_errors = None
+        self.results = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.__finished = threading.Event()
+
+    def is_finished(self):
+        return self.__finished.is_set()
+
+    def wait(self, timeout=None):
+        self.__finished.wait(timeout)
+        return self.is_finished()
+
+    def __call_function(self):
+        """Calls the function in the worker thread, or in a process of its own if job_execution is "process"."""
+        config = get_courier_config()
+        execution = config.get('job_execution', EXECUTION_THREAD)
+        if execution == EXECUTION_PROCESS:
+            return job_process.run_in_process(self.function, self,
+                                              timeout=float(config.get('job_timeout', DEFAULT_TIMEOUT)) or None,
+                                              memory_limit_mb=int(config.get('job_memory_limit_mb', 0)) or None)
+        if execution != EXECUTION_THREAD:
+            raise ValueError('Unsupported job execution: {}'.format(execution))
+        return self.function(self)
+
+    def run(self):
+        self.status = self.RUNNING
+        self.started_at = time.time()
+        try:
+            self.were_errors = bool(self.__call_function())
+        except Exception as e:
+            logging.exception('Job {} ({}) failed.'.format(self.id, self.description))
+            self.were_errors = True
+        self.status = self.FAILED if self.were_errors else self.SUCCEEDED
+        self.finished_at = time.time()
+        metrics.JOB_SECONDS.observe(self.finished_at - self.created_at, trigger=self.key[0],
+                                    result='failure' if self.were_errors else 'success')
+        self.__finished.set()
+
+    def get_summary(self):
+        return {
+            'id': self.id,
+            'description': self.description,
+            'priority': self.priority,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+        }
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'description': self.description,
+            'priority': self.priority,
+            'status': self.status,
+            'were_errors': self.were_errors,
+            'results': self.results,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobQueue(object):
+    """Runs update jobs in background worker threads.
+
+    A job submitted while another job with the same key is still queued is merged into the queued one. Jobs read
+    configs and sources when they start, so the merged job delivers the newest state. Jobs with the same key never
+    run at the same time.
+
+    High priority jobs are started before low priority ones, and low priority jobs never take the last free worker,
+    so urgent updates do not wait for full resyncs to finish.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = max(1, workers)
+        self.__queue = []
+        self.__jobs = collections.OrderedDict()
+        self.__running_jobs = []
+        self.__condition = threading.Condition()
+        self.__threads = []
+
+    def start(self):
+        with self.__condition:
+            if self.__threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.__work, name='job-worker-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self.__threads.append(thread)
+
+    def submit(self, key, description, function, priority=scheduler.PRIORITY_HIGH):
+        with self.__condition:
+            for job in self.__queue:
+                if job.key == key:
+                    logging.info('Merging {} into queued job {}.'.format(description, job.id))
+                    if scheduler.get_priority_rank(priority) < scheduler.get_priority_rank(job.priority):
+                        job.priority = priority
+                        self.__update_metrics()
+                    return job
+            job = Job(key, description, function, priority)
+            self.__queue.append(job)
+            self.__jobs[job.id] = job
+            self.__forget_finished_jobs()
+            self.__update_metrics()
+            self.__condition.notify_all()
+        logging.info('Queued job {} ({}).'.format(job.id, description))
+        return job
+
+    def get(self, job_id):
+        with self.__condition:
+            return self.__jobs.get(job_id)
+
+    def get_state(self):
+        """Returns summaries of running jobs and of queued ones in order they will be started."""
+        with self.__condition:
+            queue = sorted(self.__queue, key=lambda queued_job: scheduler.get_priority_rank(queued_job.priority))
+            return {
+                'workers': self.workers,
+                'running': [job.get_summary() for job in self.__running_jobs],
+                'queued': [job.get_summary() for job in queue],
+            }
+
+    def __forget_finished_jobs(self):
+        for job_id in list(self.__jobs):
+            if len(self.__jobs) <= MAX_FINISHED_JOBS:
+                break
+            if self.__jobs[job_id].is_finished():
+                del self.__jobs[job_id]
+
+    def __update_metrics(self):
+        for priority in scheduler.PRIORITIES:
+            metrics.JOBS_QUEUED.set(sum(1 for job in self.__queue if job.priority == priority), priority=priority)
+
+    def __take_next_job(self):
+        running_keys = set(job.key for job in self.__running_jobs)
+        running_low_priority = sum(1 for job in self.__running_jobs if job.priority != scheduler.PRIORITY_HIGH)
+        # Stable sort keeps jobs of the same priority in order of submission.
+        for job in sorted(self.__queue, key=lambda queued_job: scheduler.get_priority_rank(queued_job.priority)):
+            if job.key in running_keys:
+                continue
+            if job.priority != scheduler.PRIORITY_HIGH and running_low_priority >= max(1, self.workers - 1):
+                continue
+            self.__queue.remove(job)
+            self.__running_jobs.append(job)
+            self.__update_metrics()
+            metrics.JOB_QUEUE_SECONDS.observe(time.time() - job.created_at, trigger=job.key[0], priority=job.priority)
+            return job
+        return None
+
+    def __work(self):
+        while True:
+            with self.__condition:
+                job = self.__take_next_job()
+                while job is None:
+                    self.__condition.wait()
+                    job = self.__take_next_job()
+            logging.info('Running job {} ({}).'.format(job.id, job.description))
+            try:
+                job.run()
+            finally:
+                with self.__condition:
+                    self.__running_jobs.remove(job)
+                    self.__condition.notify_all()
+            logging.info('Job {} ({}) {}.'.format(job.id, job.description, job.status))
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def _after_fork():
+    global _job_queue, _job_queue_lock
+    # Workers of the queue are threads, which are not forked.
+    _job_queue = None
+    _job_queue_lock = threading.Lock()
+
+
+register_after_fork(_after_fork)
+
+
+def get_job_queue(workers=DEFAULT_WORKERS):
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(workers)
+            _job_queue.start()
+        return _job_queue
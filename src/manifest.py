@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import delivery_state
+from util import register_after_fork
+
+MANIFESTS_DIR_NAME = 'manifests'
+
+
+def _to_native_string(text):
+    return text if isinstance(text, str) else text.encode('utf-8')
+
+
+def compute_manifest(local_path):
+    """Returns {relative_path: [size, sha1]} for all regular files pushed from local_path."""
+    manifest = {}
+    for entry_type, relative_path, path in delivery_state.iterate_pushed_tree(local_path):
+        if entry_type == 'f':
+            manifest[relative_path] = [os.path.getsize(path), delivery_state.get_file_digest(path)]
+    return manifest
+
+
+def diff_manifests(old_manifest, new_manifest):
+    """Returns sorted list of paths that were added, changed or deleted between old_manifest and new_manifest."""
+    changed_paths = set(path for path, entry in new_manifest.items() if old_manifest.get(path) != entry)
+    changed_paths.update(path for path in old_manifest if path not in new_manifest)
+    return sorted(changed_paths)
+
+
+class ManifestStore(object):
+    """Persistent manifests of files delivered to every destination by the last successful push."""
+
+    def __init__(self, state_dir=None):
+        self.state_dir = state_dir
+        self.__lock = threading.Lock()
+        register_after_fork(self.__after_fork)
+
+    def __after_fork(self):
+        self.__lock = threading.Lock()
+
+    @property
+    def manifests_dir(self):
+        return os.path.join(self.state_dir or delivery_state.COURIER_STATE_DIR, MANIFESTS_DIR_NAME)
+
+    def __get_path(self, delivery_key):
+        return os.path.join(self.manifests_dir, hashlib.sha1(delivery_key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, delivery_key):
+        """Returns (manifest, verified_at) or (None, None) if nothing is known about delivery_key."""
+        path = self.__get_path(delivery_key)
+        if not os.path.exists(path):
+            return None, None
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+            files = dict((_to_native_string(file_path), entry) for file_path, entry in stored['files'].items())
+            return files, stored['verified_at']
+        except Exception as e:
+            logging.exception('Could not read manifest {}.'.format(path))
+            return None, None
+
+    def save(self, delivery_key, manifest, verified_at):
+        path = self.__get_path(delivery_key)
+        with self.__lock:
+            if not os.path.exists(self.manifests_dir):
+                os.makedirs(self.manifests_dir)
+        temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'delivery_key': delivery_key, 'verified_at': verified_at, 'files': manifest}, f)
+            os.rename(temp_path, path)
+        except Exception as e:
+            logging.exception('Could not save manifest {}.'.format(path))
+
+    def forget(self, delivery_key):
+        path = self.__get_path(delivery_key)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def is_full_verify_due(verified_at, full_verify_interval):
+    return verified_at is None or time.time() - verified_at >= full_verify_interval
+
+
+_manifest_store = ManifestStore()
+
+
+def get_manifest_store():
+    return _manifest_store
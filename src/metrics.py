@@ -0,0 +1,247 @@
+import threading
+import time
+
+from util import register_after_fork
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names, label_values, extra_labels=()):
+    pairs = list(zip(label_names, label_values)) + list(extra_labels)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape_label_value(value)) for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        register_after_fork(self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _get_label_values(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError('Metric {} expects labels {}, got {}.'.format(self.name, self.label_names,
+                                                                          sorted(labels)))
+        return tuple(labels[label_name] for label_name in self.label_names)
+
+    def _render_samples(self):
+        raise NotImplementedError()
+
+    def _get_values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def _apply_change(self, label_values, old_value, new_value):
+        """Applies change of value from old_value, None if there was none, to new_value made in another process."""
+        raise NotImplementedError()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        lines.extend(self._render_samples())
+        return '\n'.join(lines)
+
+
+class _ValueMetric(_Metric):
+    def _render_samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{}{} {}'.format(self.name, _format_labels(self.label_names, label_values), _format_number(value))
+                for label_values, value in values]
+
+
+class Counter(_ValueMetric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _apply_change(self, label_values, old_value, new_value):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + new_value - (old_value or 0)
+
+
+class Gauge(_ValueMetric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = value
+
+    def _apply_change(self, label_values, old_value, new_value):
+        # Other processes change the value by as much as it has changed there, like of a counter, so changes made by
+        # Courier and by concurrent job processes add up.
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + new_value - (old_value or 0)
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.result = 'success'
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        result = 'failure' if exc_type is not None else self.result
+        self.histogram.observe(time.time() - self.start, result=result, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            bucket_counts, total = self._values.get(label_values, ([0] * len(self.buckets), 0.0))
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    bucket_counts[i] += 1
+            self._values[label_values] = (bucket_counts, total + value)
+
+    def _get_values(self):
+        with self._lock:
+            return dict((label_values, (list(bucket_counts), total))
+                        for label_values, (bucket_counts, total) in self._values.items())
+
+    def _apply_change(self, label_values, old_value, new_value):
+        old_bucket_counts, old_total = old_value or ([0] * len(self.buckets), 0.0)
+        new_bucket_counts, new_total = new_value
+        with self._lock:
+            bucket_counts, total = self._values.get(label_values, ([0] * len(self.buckets), 0.0))
+            self._values[label_values] = ([count + new_count - old_count for count, new_count, old_count
+                                           in zip(bucket_counts, new_bucket_counts, old_bucket_counts)],
+                                          total + new_total - old_total)
+
+    def time(self, **labels):
+        """Returns context manager observing its duration. Label "result" is "success" unless an exception is
+        raised or the timer's result attribute is changed."""
+        return _Timer(self, labels)
+
+    def _render_samples(self):
+        with self._lock:
+            values = sorted((label_values, (list(bucket_counts), total))
+                            for label_values, (bucket_counts, total) in self._values.items())
+        lines = []
+        for label_values, (bucket_counts, total) in values:
+            for bucket, count in zip(self.buckets, bucket_counts):
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.label_names, label_values, [('le', _format_number(bucket))]),
+                    count))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.label_names, label_values),
+                                              _format_number(total)))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(self.label_names, label_values),
+                                                bucket_counts[-1]))
+        return lines
+
+
+_registry = []
+
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render():
+    """Returns all metrics in Prometheus text exposition format."""
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+def get_values():
+    """Returns current values of all metrics, to be compared by get_changes()."""
+    return dict((metric.name, metric._get_values()) for metric in _registry)
+
+
+def get_changes(old_values):
+    """Returns list of changes of metrics since get_values() returned old_values, to be applied in another process
+    with apply_changes()."""
+    changes = []
+    for metric in _registry:
+        metric_old_values = old_values.get(metric.name, {})
+        for label_values, value in metric._get_values().items():
+            old_value = metric_old_values.get(label_values)
+            if value != old_value:
+                changes.append((metric.name, label_values, old_value, value))
+    return changes
+
+
+def apply_changes(changes):
+    """Applies changes of metrics made in another process, e.g. a job process."""
+    metrics_by_name = dict((metric.name, metric) for metric in _registry)
+    for name, label_values, old_value, new_value in changes:
+        metrics_by_name[name]._apply_change(label_values, old_value, new_value)
+
+
+GIT_FETCH_SECONDS = _register(Histogram(
+    'courier_git_fetch_seconds', 'Duration of fetching git repository into its mirror.', ('repository', 'result')))
+GIT_CHECKOUT_SECONDS = _register(Histogram(
+    'courier_git_checkout_seconds', 'Duration of exporting git tree from mirror.', ('repository', 'result')))
+ADDRESS_DISCOVERY_SECONDS = _register(Histogram(
+    'courier_address_discovery_seconds', 'Duration of discovering Hermes-addresses of destination.',
+    ('destination', 'result')))
+TUNNEL_SETUP_SECONDS = _register(Histogram(
+    'courier_tunnel_setup_seconds', 'Duration of opening SSH tunnel.', ('gateway', 'result')))
+TRANSFER_SECONDS = _register(Histogram(
+    'courier_transfer_seconds', 'Duration of transferring source to one Hermes-address.',
+    ('source', 'destination', 'result')))
+TRANSFERRED_BYTES = _register(Counter(
+    'courier_transferred_bytes_total', 'Bytes sent to Hermes-addresses.', ('source', 'destination')))
+TRANSFERRED_FILES = _register(Counter(
+    'courier_transferred_files_total', 'Files sent by rsync to Hermes-addresses because they have changed.',
+    ('source', 'destination')))
+PUSHES = _register(Counter(
+    'courier_pushes_total', 'Pushes of sources to Hermes-addresses.', ('source', 'destination', 'result')))
+SOURCE_UPDATE_SECONDS = _register(Histogram(
+    'courier_source_update_seconds', 'Duration of updating source, from pull to last push.', ('source', 'result')))
+JOB_SECONDS = _register(Histogram(
+    'courier_job_seconds', 'Time from receiving update request to delivering it to all destinations.',
+    ('trigger', 'result')))
+JOBS_QUEUED = _register(Gauge('courier_jobs_queued', 'Update jobs waiting for a worker.', ('priority',)))
+JOB_QUEUE_SECONDS = _register(Histogram(
+    'courier_job_queue_seconds', 'Time update job waited for a worker.', ('trigger', 'priority')))
+JOB_PROCESSES = _register(Counter(
+    'courier_job_processes_total', 'Update jobs run in worker processes, by how their process ended.', ('result',)))
+UPDATE_SLOTS_WAITING = _register(Gauge(
+    'courier_update_slots_waiting', 'Pushes waiting for a slot of the update scheduler.', ('priority',)))
+UPDATE_SLOTS_RUNNING = _register(Gauge(
+    'courier_update_slots_running', 'Pushes holding a slot of the update scheduler.', ('priority',)))
+UPDATE_SLOT_WAIT_SECONDS = _register(Histogram(
+    'courier_update_slot_wait_seconds', 'Time push waited for a slot of the update scheduler.', ('priority',)))
+WORKSPACES = _register(Gauge('courier_workspaces', 'Work directories in use.'))
+WORKSPACE_BYTES = _register(Gauge('courier_workspace_bytes', 'Measured size of work directories in use.'))
+WORKSPACE_WAIT_SECONDS = _register(Histogram(
+    'courier_workspace_wait_seconds', 'Duration of waiting for disk budget to create work directory.', ('result',)))
+CIRCUIT_OPEN = _register(Gauge(
+    'courier_circuit_open', 'Whether pushes to address are suspended after repeated failures.', ('address',)))
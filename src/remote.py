@@ -1,17 +1,55 @@
+import collections
+import errno
+import io
 import logging
 import os
-import random
+import pipes
+import re
 import signal
+import socket
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
 
 import requests
 
+import delivery_state
+import metrics
+from courier_common import get_courier_config
+from util import register_after_fork
+
+HTTP_POOL_SIZE = 64
+DEFAULT_SSH_IDLE_TIMEOUT = 60
+SSH_CONTROL_DIR = '/tmp/courier-ssh-control'
+SSH_CONNECT_TIMEOUT = 5
+# Limit of a whole ssh command checking or opening a connection, including authentication.
+SSH_COMMAND_TIMEOUT = 30
+OUTPUT_TAIL_LINES = 20
+MAX_LINE_LENGTH = 65536
+DEFAULT_RSYNC_OPTIONS = '--checksum --compress'
+
 
 class RemoteException(Exception):
     pass
 
 
+_http_session = None
+
+
+def get_http_session():
+    """Returns requests session shared by all HTTP calls of Courier, so connections are pooled and reused."""
+    global _http_session
+    if _http_session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _http_session = session
+    return _http_session
+
+
 class RemoteConnection(object):
     def get_address(self):
         raise NotImplementedError()
@@ -31,12 +69,201 @@ class DirectConnection(RemoteConnection):
         return self.address
 
 
+def _wait_until(condition, deadline, process=None):
+    """Polls condition with growing intervals until it is true or deadline passes. Returns the last result."""
+    delay = 0.05
+    while True:
+        if condition():
+            return True
+        if process is not None and process.poll() is not None:
+            raise RemoteException('SSH tunnel process exited with code {}.'.format(process.returncode))
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 1)
+
+
+def is_port_open(host, port):
+    try:
+        sock = socket.create_connection((host, port), timeout=0.5)
+    except socket.error:
+        return False
+    sock.close()
+    return True
+
+
+class _SSHTunnel(object):
+    def __init__(self, key, process, host, port):
+        self.key = key
+        self.process = process
+        self.host = host
+        self.port = port
+        self.users = 0
+        self.last_used = time.time()
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait()
+        except Exception as e:
+            logging.exception('Failed while terminating SSH tunnel')
+
+
+class SSHTunnelPool(object):
+    """Keeps SSH tunnels open between uses and shares them between concurrent users.
+
+    Tunnels are keyed by gateway and remote address, and closed after being unused for idle_timeout seconds.
+    Local ports are allocated by the OS and never handed to two tunnels at the same time.
+    """
+
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.__tunnels = {}
+        self.__key_locks = {}
+        self.__reserved_ports = set()
+        self.__lock = threading.Lock()
+        self.__reaper = None
+
+    def __get_key_lock(self, key):
+        with self.__lock:
+            if key not in self.__key_locks:
+                self.__key_locks[key] = threading.Lock()
+            return self.__key_locks[key]
+
+    def __reserve_port(self):
+        while True:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.bind(('127.0.0.1', 0))
+                port = sock.getsockname()[1]
+            finally:
+                sock.close()
+            with self.__lock:
+                if port not in self.__reserved_ports:
+                    self.__reserved_ports.add(port)
+                    return port
+
+    def __discard(self, tunnel):
+        with self.__lock:
+            if self.__tunnels.get(tunnel.key) is tunnel:
+                del self.__tunnels[tunnel.key]
+            self.__reserved_ports.discard(tunnel.port)
+        tunnel.close()
+
+    def acquire(self, key, open_tunnel):
+        """Returns an open tunnel for key. open_tunnel(key, bind_port) is called to open a new one if needed."""
+        with self.__get_key_lock(key):
+            with self.__lock:
+                tunnel = self.__tunnels.get(key)
+            if tunnel is not None and not tunnel.is_alive():
+                logging.info('SSH tunnel {} has died. Opening a new one.'.format(key))
+                self.__discard(tunnel)
+                tunnel = None
+            if tunnel is None:
+                bind_port = self.__reserve_port()
+                try:
+                    tunnel = open_tunnel(key, bind_port)
+                except Exception:
+                    with self.__lock:
+                        self.__reserved_ports.discard(bind_port)
+                    raise
+                with self.__lock:
+                    self.__tunnels[key] = tunnel
+            with self.__lock:
+                tunnel.users += 1
+            self.__start_reaper()
+            return tunnel
+
+    def release(self, tunnel):
+        with self.__lock:
+            tunnel.users -= 1
+            tunnel.last_used = time.time()
+            close_now = tunnel.users <= 0 and (self.idle_timeout <= 0 or not tunnel.is_alive())
+        if close_now:
+            self.__discard(tunnel)
+
+    def close_all(self):
+        with self.__lock:
+            tunnels = list(self.__tunnels.values())
+        for tunnel in tunnels:
+            self.__discard(tunnel)
+
+    def __start_reaper(self):
+        with self.__lock:
+            if self.__reaper is not None or self.idle_timeout <= 0:
+                return
+            self.__reaper = threading.Thread(target=self.__reap, name='ssh-tunnel-reaper')
+            self.__reaper.daemon = True
+            self.__reaper.start()
+
+    def __reap(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 5))
+            now = time.time()
+            with self.__lock:
+                expired = [tunnel for tunnel in self.__tunnels.values()
+                           if tunnel.users <= 0 and (now - tunnel.last_used >= self.idle_timeout or
+                                                     not tunnel.is_alive())]
+            for tunnel in expired:
+                logging.debug('Closing idle SSH tunnel {}.'.format(tunnel.key))
+                self.__discard(tunnel)
+
+
+_tunnel_pool = None
+_tunnel_pool_lock = threading.Lock()
+
+
+def _after_fork():
+    global _http_session, _tunnel_pool_lock
+    # Pooled HTTP connections would be shared with Courier.
+    _http_session = None
+    _tunnel_pool_lock = threading.Lock()
+
+
+register_after_fork(_after_fork)
+
+
+def get_ssh_idle_timeout():
+    return float(get_courier_config().get('ssh_idle_timeout', DEFAULT_SSH_IDLE_TIMEOUT))
+
+
+def get_tunnel_pool():
+    global _tunnel_pool
+    with _tunnel_pool_lock:
+        if _tunnel_pool is None:
+            _tunnel_pool = SSHTunnelPool(get_ssh_idle_timeout())
+        return _tunnel_pool
+
+
+def use_own_connections(control_dir):
+    """Makes a process forked from Courier open its own SSH tunnels, and SSH master connections with control sockets in
+    control_dir, instead of using those of Courier."""
+    global _tunnel_pool, SSH_CONTROL_DIR
+    _tunnel_pool = None
+    SSH_CONTROL_DIR = control_dir
+
+
+def close_connections():
+    """Closes SSH tunnels and SSH master connections of a process set up with use_own_connections."""
+    with _tunnel_pool_lock:
+        tunnel_pool = _tunnel_pool
+    if tunnel_pool is not None:
+        tunnel_pool.close_all()
+    close_ssh_master_connections(SSH_CONTROL_DIR)
+
+
 class SSHTunnelConnection(RemoteConnection):
-    def __init__(self, address, ssh_tunnel):
+    TUNNEL_READY_TIMEOUT = 20
+
+    def __init__(self, address, ssh_tunnel, deadline=None):
         self.address = address
         self.ssh_tunnel = ssh_tunnel
-        self.process = None
-        self.pid = None
+        self.deadline = deadline
+        self.tunnel = None
         self.host = None
         self.port = None
 
@@ -48,105 +275,164 @@ class SSHTunnelConnection(RemoteConnection):
     def __address_to_host_and_port(self):
         return (self.address.split(':', 1) + [80])[:2]
 
-    def _check_tunnel(self):
+    def _check_tunnel(self, deadline):
         pass
 
+    def __get_tunnel_key(self):
+        remote_host, remote_port = self.__address_to_host_and_port()
+        return (self.ssh_tunnel['host'], str(self.ssh_tunnel['port']), self.ssh_tunnel['user'],
+                self.ssh_tunnel['ssh_key_path'], remote_host, str(remote_port))
+
     def start(self):
+        self.tunnel = get_tunnel_pool().acquire(self.__get_tunnel_key(), self.__open_tunnel)
+        self.host = self.tunnel.host
+        self.port = self.tunnel.port
+
+    def __open_tunnel(self, key, bind_port):
         remote_host, remote_port = self.__address_to_host_and_port()
-        self.process = self.__create_ssh_tunnel(
+        process = self.__create_ssh_tunnel(
             self.ssh_tunnel['host'],
             self.ssh_tunnel['port'],
             self.ssh_tunnel['user'],
             self.ssh_tunnel['ssh_key_path'],
             remote_host,
             remote_port,
+            bind_port,
         )
-        self.pid = self.process.pid
+        tunnel = _SSHTunnel(key, process, '127.0.0.1', bind_port)
+        self.host = tunnel.host
+        self.port = tunnel.port
+        deadline = time.time() + self.TUNNEL_READY_TIMEOUT
+        if self.deadline is not None:
+            deadline = min(deadline, self.deadline)
         try:
-            self._check_tunnel()
+            with metrics.TUNNEL_SETUP_SECONDS.time(gateway=self.ssh_tunnel['host']):
+                if not _wait_until(lambda: is_port_open(tunnel.host, tunnel.port), deadline, process):
+                    raise RemoteException('SSH tunnel to {} did not open a port in time.'.format(self.address))
+                self._check_tunnel(deadline)
         except Exception as e:
             logging.exception('Failed checking SSH tunnel')
-            self.terminate()
+            tunnel.close()
             raise e
+        return tunnel
 
     def terminate(self):
-        try:
-            os.killpg(self.pid, signal.SIGTERM)
-        except Exception as e:
-            logging.exception('Failed while terminating SSH tunnel')
+        if self.tunnel is not None:
+            get_tunnel_pool().release(self.tunnel)
+            self.tunnel = None
 
-    def __create_ssh_tunnel(self, host, port, user, ssh_key_path, remote_host, remote_port):
-        bind_port = random.randrange(10000, 65535)
-        self.host = '127.0.0.1'
-        self.port = bind_port
+    @staticmethod
+    def __create_ssh_tunnel(host, port, user, ssh_key_path, remote_host, remote_port, bind_port):
         tunnel_command = ('ssh -i {ssh_key_path} -p {port} {user}@{host} -N -o StrictHostKeyChecking=no '
-                          '-L *:{bind_port}:{remote_host}:{remote_port}').format(**locals())
+                          '-o ExitOnForwardFailure=yes -o ServerAliveInterval=15 '
+                          '-L 127.0.0.1:{bind_port}:{remote_host}:{remote_port}').format(**locals())
         logging.debug('tunnel_command: {}'.format(tunnel_command))
         return _async_execute_local_command(tunnel_command)
 
 
 class SSHOverSSHTunnelConnection(SSHTunnelConnection):
-    TUNNEL_CHECK_RETRIES = 7
-    TUNNEL_CHECK_TIMEOUT = 3
-    SLEEP_BETWEEN_RETRIES = 1
-
-    def __init__(self, address, ssh_tunnel, target_ssh_connection_dict):
-        super(SSHOverSSHTunnelConnection, self).__init__(address, ssh_tunnel)
+    def __init__(self, address, ssh_tunnel, target_ssh_connection_dict, deadline=None):
+        super(SSHOverSSHTunnelConnection, self).__init__(address, ssh_tunnel, deadline)
         self.target_ssh_connection_dict = target_ssh_connection_dict
 
-    def _check_tunnel(self):
+    def _check_tunnel(self, deadline):
         check_tunnel_params = dict(self.target_ssh_connection_dict)
         check_tunnel_params['host'] = self.host
         check_tunnel_params['port'] = self.port
-        check_tunnel_params['tunnel_check_timeout'] = self.TUNNEL_CHECK_TIMEOUT
-        check_tunnel_command = ('ssh -o StrictHostKeyChecking=no -o ConnectTimeout={tunnel_check_timeout} '
-                                '-p {port} -i {ssh_key_path} {user}@{host} true').format(**check_tunnel_params)
-        logging.debug('check_tunnel_command: {}'.format(check_tunnel_command))
-        for i in range(self.TUNNEL_CHECK_RETRIES + 1):
-            check_tunnel_result = execute_local_command(check_tunnel_command)
-            if check_tunnel_result[0] == 0:
-                return
-            time.sleep(self.SLEEP_BETWEEN_RETRIES)
-        raise RemoteException(
-            'Could not set up a SSHOverSSHTunnel to {}, all retries failed.'.format(self.address))
+        # Starting the SSH master connection checks the tunnel and leaves the connection ready for rsync.
+        if not _wait_until(lambda: open_ssh_connection(check_tunnel_params, max(deadline - time.time(), 0)),
+                           deadline):
+            raise RemoteException(
+                'Could not set up a SSHOverSSHTunnel to {}, all retries failed.'.format(self.address))
 
 
 class HTTPOverSSHTunnelConnection(SSHTunnelConnection):
-    TUNNEL_CHECK_RETRIES = 7
     TUNNEL_CHECK_TIMEOUT = 3
-    SLEEP_BETWEEN_RETRIES = 1
 
-    def __init__(self, address, ssh_tunnel, health_check_url=''):
-        super(HTTPOverSSHTunnelConnection, self).__init__(address, ssh_tunnel)
+    def __init__(self, address, ssh_tunnel, health_check_url='', deadline=None):
+        super(HTTPOverSSHTunnelConnection, self).__init__(address, ssh_tunnel, deadline)
         self.health_check_url = health_check_url
 
-    def _check_tunnel(self):
-        for i in range(self.TUNNEL_CHECK_RETRIES + 1):
-            try:
-                headers = {'Host': self.address}
-                url = 'http://{}:{}{}'.format(self.host, self.port, self.health_check_url)
-                response = requests.get(url, headers=headers, timeout=self.TUNNEL_CHECK_TIMEOUT)
-                if response.status_code == requests.codes.ok:
-                    return
-            except Exception as e:
-                pass
-            time.sleep(self.SLEEP_BETWEEN_RETRIES)
-        raise RemoteException(
-            'Could not set up an HTTPOverSSHTunnel to {}, all retries failed.'.format(self.address))
+    def __is_healthy(self):
+        try:
+            headers = {'Host': self.address}
+            url = 'http://{}:{}{}'.format(self.host, self.port, self.health_check_url)
+            response = get_http_session().get(url, headers=headers, timeout=self.TUNNEL_CHECK_TIMEOUT)
+            return response.status_code == requests.codes.ok
+        except Exception as e:
+            return False
+
+    def _check_tunnel(self, deadline):
+        if not _wait_until(self.__is_healthy, deadline):
+            raise RemoteException(
+                'Could not set up an HTTPOverSSHTunnel to {}, all retries failed.'.format(self.address))
 
 
-def create_remote_connection_to_http(address, ssh_tunnel=None, health_check_url=''):
+def create_remote_connection_to_http(address, ssh_tunnel=None, health_check_url='', deadline=None):
     if ssh_tunnel:
-        return HTTPOverSSHTunnelConnection(address, ssh_tunnel, health_check_url)
+        return HTTPOverSSHTunnelConnection(address, ssh_tunnel, health_check_url, deadline)
     return DirectConnection(address)
 
 
-def create_remote_connection_to_ssh(address, ssh_tunnel, target_ssh_connection_dict):
+def create_remote_connection_to_ssh(address, ssh_tunnel, target_ssh_connection_dict, deadline=None):
     if ssh_tunnel:
-        return SSHOverSSHTunnelConnection(address, ssh_tunnel, target_ssh_connection_dict)
+        return SSHOverSSHTunnelConnection(address, ssh_tunnel, target_ssh_connection_dict, deadline)
     return DirectConnection(address)
 
 
+def _get_ssh_control_path():
+    return os.path.join(SSH_CONTROL_DIR, '%r@%h:%p')
+
+
+def get_ssh_command(port, ssh_key_path):
+    """Returns ssh command line that reuses the master connection to the host if there is one."""
+    return ('ssh -o StrictHostKeyChecking=no -o ControlMaster=no -o ControlPath={control_path} '
+            '-p {port} -i {ssh_key_path}').format(control_path=_get_ssh_control_path(), **locals())
+
+
+def open_ssh_connection(ssh_dict, timeout=SSH_COMMAND_TIMEOUT):
+    """Makes sure that SSH connection to ssh_dict host works.
+
+    The connection is kept in background as a master connection for SSH idle timeout, so next ssh and rsync
+    commands to the same host skip the handshake. Returns True if the host is reachable. Every ssh command is killed if
+    it does not finish in timeout seconds.
+    """
+    idle_timeout = int(get_ssh_idle_timeout())
+    control_path = _get_ssh_control_path()
+    ssh_arguments = ['-o', 'StrictHostKeyChecking=no', '-o', 'ControlPath={}'.format(control_path),
+                     '-o', 'ConnectTimeout={}'.format(SSH_CONNECT_TIMEOUT),
+                     '-p', str(ssh_dict['port']), '-i', ssh_dict['ssh_key_path'],
+                     '{}@{}'.format(ssh_dict['user'], ssh_dict['host'])]
+    with open(os.devnull, 'r+') as devnull:
+        def call(command):
+            process = subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, preexec_fn=os.setsid)
+            with KillTimer(process, timeout):
+                return process.wait() == 0
+
+        if idle_timeout <= 0:
+            return call(['ssh', '-o', 'ControlMaster=no'] + ssh_arguments + ['true'])
+        if not os.path.exists(SSH_CONTROL_DIR):
+            try:
+                os.makedirs(SSH_CONTROL_DIR)
+            except OSError:
+                pass
+        if call(['ssh', '-O', 'check'] + ssh_arguments):
+            return True
+        return call(['ssh', '-f', '-N', '-o', 'ControlMaster=yes',
+                     '-o', 'ControlPersist={}'.format(idle_timeout)] + ssh_arguments)
+
+
+def close_ssh_master_connections(control_dir):
+    """Closes SSH master connections with control sockets in control_dir."""
+    if not os.path.isdir(control_dir):
+        return
+    with open(os.devnull, 'r+') as devnull:
+        for control_name in os.listdir(control_dir):
+            # Control path without % tokens is used as it is, so the host argument does not matter.
+            subprocess.call(['ssh', '-o', 'ControlPath={}'.format(os.path.join(control_dir, control_name)),
+                             '-O', 'exit', 'localhost'], stdin=devnull, stdout=devnull, stderr=devnull)
+
+
 def _async_execute_local_command(command):
     p = subprocess.Popen(
         command,
@@ -156,25 +442,284 @@ def _async_execute_local_command(command):
     return p
 
 
-def execute_local_command(command):
+class KillTimer(object):
+    """Kills the process group of process if it is still running after timeout seconds. The process has to be started
+    in a new session."""
+
+    def __init__(self, process, timeout):
+        self.process = process
+        self.timeout = timeout
+        self.timed_out = threading.Event()
+        self.__timer = None
+
+    def __kill(self):
+        self.timed_out.set()
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        if self.timeout is not None:
+            self.__timer = threading.Timer(max(self.timeout, 0), self.__kill)
+            self.__timer.daemon = True
+            self.__timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.__timer is not None:
+            self.__timer.cancel()
+        return False
+
+    def get_message(self):
+        return 'Killed after {} seconds.\n'.format(self.timeout) if self.timed_out.is_set() else ''
+
+
+def _communicate(process, input=None, timeout=None):
+    """Like process.communicate(), but kills the process group of process if it does not finish in timeout seconds."""
+    with KillTimer(process, timeout) as kill_timer:
+        out, err = process.communicate(input)
+    return out, (err or '') + kill_timer.get_message()
+
+
+def execute_local_command(command, timeout=None):
+    """Runs shell command and returns its exit code, stdout and stderr. The command and all processes it has started
+    are killed if it does not finish in timeout seconds."""
     p = subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        shell=True
+        shell=True,
+        preexec_fn=os.setsid
     )
-    out, err = p.communicate()
+    out, err = _communicate(p, timeout=timeout)
     return p.returncode, out, err
 
 
-def push_local_path_to_remote(local_path, rsync_ssh_dict):
-    rsync_ssh_dict['local_path'] = local_path
+def _wait_for_cpu_seconds(process):
+    """Waits for process like process.wait(), and returns CPU time used by it and its children, in seconds."""
+    while True:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def stream_local_command(command, line_handler, timeout=None):
+    """Runs shell command and passes lines it prints to stdout to line_handler as soon as they are printed.
+
+    Output is never kept whole. Only the last OUTPUT_TAIL_LINES lines of stdout and stderr are kept, and returned with
+    the exit code and CPU time used by the command as (return_code, out, err, cpu_seconds). The command is killed if
+    it does not finish in timeout seconds.
+    """
+    p = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=True,
+        preexec_fn=os.setsid
+    )
+    out_tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    err_tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    err_reader = threading.Thread(
+        target=lambda: err_tail.extend(iter(lambda: p.stderr.readline(MAX_LINE_LENGTH), b'')))
+    err_reader.daemon = True
+    with KillTimer(p, timeout) as kill_timer:
+        err_reader.start()
+        for line in iter(lambda: p.stdout.readline(MAX_LINE_LENGTH), b''):
+            out_tail.append(line)
+            line_handler(line.rstrip('\n'))
+        err_reader.join()
+        cpu_seconds = _wait_for_cpu_seconds(p)
+    return p.returncode, ''.join(out_tail), ''.join(err_tail) + kill_timer.get_message(), cpu_seconds
+
+
+class RsyncStats(object):
+    """Numbers of one rsync transfer, collected line by line from output of rsync --itemize-changes --stats."""
+
+    STATS_PATTERN = re.compile(r'^(Number of [\w ]+?|Total [\w ]+?|Literal data|Matched data)(?: \(.*?\))?: ([\d,.]+)')
+    SPEEDUP_PATTERN = re.compile(r'speedup is ([\d,.]+)')
+
+    def __init__(self):
+        self.values = {}
+        self.changed_files = 0
+        self.deleted_files = 0
+        self.speedup = None
+        self.duration = None
+        self.cpu_seconds = None
+
+    @property
+    def sent_bytes(self):
+        return self.values.get('total_bytes_sent', 0)
+
+    def add_line(self, line):
+        if line.startswith('*deleting'):
+            self.deleted_files += 1
+        elif line[:2] in ('<f', '>f'):
+            self.changed_files += 1
+        else:
+            match = self.STATS_PATTERN.match(line)
+            if match:
+                key = match.group(1).lower().replace(' ', '_')
+                try:
+                    self.values[key] = int(match.group(2).replace(',', '').split('.')[0])
+                except ValueError:
+                    pass
+                return
+            match = self.SPEEDUP_PATTERN.search(line)
+            if match:
+                self.speedup = float(match.group(1).replace(',', ''))
+
+    def to_dict(self):
+        return {
+            'changed_files': self.changed_files,
+            'deleted_files': self.deleted_files,
+            'sent_bytes': self.sent_bytes,
+            'speedup': self.speedup,
+        }
+
+
+def _run_rsync(rsync_command, timeout=None):
+    """Runs rsync command and returns its exit code, RsyncStats of the transfer and the last lines of its output."""
+    stats = RsyncStats()
+    started_at = time.time()
+    return_code, out, err, stats.cpu_seconds = stream_local_command(rsync_command, stats.add_line, timeout)
+    stats.duration = time.time() - started_at
+    return return_code, stats, out + err
+
+
+def _set_rsync_options(rsync_ssh_dict, rsync_options):
+    rsync_ssh_dict['rsync_options'] = rsync_options
+    rsync_ssh_dict['ssh_command'] = get_ssh_command(rsync_ssh_dict['port'], rsync_ssh_dict['ssh_key_path'])
     if rsync_ssh_dict.get('sudo'):
         rsync_ssh_dict['sudo'] = "--rsync-path='sudo rsync'"
     else:
         rsync_ssh_dict['sudo'] = ''
-    rsync_command = ('rsync -cvrz --delete --exclude=".git*" '
-                     '--rsh="ssh -o StrictHostKeyChecking=no -p {port} -i {ssh_key_path}" '
-                     '{sudo} {local_path} {user}@{host}:{path} ').format(**rsync_ssh_dict)
-    result = execute_local_command(rsync_command)
+
+
+def push_local_paths_to_remote(local_paths, rsync_ssh_dict, timeout=None, rsync_options=DEFAULT_RSYNC_OPTIONS):
+    """Pushes all local_paths to rsync_ssh_dict['path'] on remote host in one rsync session.
+
+    Every local path becomes a directory of the same name in the remote path. --delete removes extraneous files only
+    inside these directories, so they are synced as if they were pushed one by one. rsync_options set compression,
+    checksums and bandwidth limit. Returns exit code of rsync, RsyncStats of the transfer and the last lines of rsync
+    output.
+    """
+    _set_rsync_options(rsync_ssh_dict, rsync_options)
+    rsync_ssh_dict['local_paths'] = ' '.join(pipes.quote(local_path) for local_path in local_paths)
+    rsync_command = ('rsync -r {rsync_options} --itemize-changes --stats --delete --exclude=".git*" '
+                     '--rsh="{ssh_command}" '
+                     '{sudo} {local_paths} {user}@{host}:{path} ').format(**rsync_ssh_dict)
+    return _run_rsync(rsync_command, timeout)
+
+
+def push_local_path_to_remote(local_path, rsync_ssh_dict, changed_paths=None, remote_name=None, timeout=None,
+                              rsync_options=DEFAULT_RSYNC_OPTIONS):
+    """Pushes local_path to {path}/remote_name on remote host. remote_name defaults to the name of local_path.
+
+    If changed_paths is given, only these paths (relative to local_path) are transferred without checksumming the
+    whole tree, and those of them that do not exist locally are deleted on remote host. rsync_options should not ask
+    for checksums then.
+    """
+    local_name = os.path.basename(local_path.rstrip(os.path.sep))
+    remote_name = remote_name or local_name
+    if changed_paths is None and remote_name == local_name:
+        return push_local_paths_to_remote([local_path], rsync_ssh_dict, timeout, rsync_options)
+
+    _set_rsync_options(rsync_ssh_dict, rsync_options)
+    rsync_ssh_dict['local_path'] = pipes.quote(local_path.rstrip(os.path.sep) + os.path.sep)
+    rsync_ssh_dict['remote_name'] = remote_name
+    if changed_paths is None:
+        # Trailing slash makes rsync sync the contents of local_path into the differently named remote directory.
+        rsync_command = ('rsync -r {rsync_options} --itemize-changes --stats --delete --exclude=".git*" '
+                         '--rsh="{ssh_command}" '
+                         '{sudo} {local_path} {user}@{host}:{path}/{remote_name} ').format(**rsync_ssh_dict)
+        return _run_rsync(rsync_command, timeout)
+
+    with tempfile.NamedTemporaryFile(prefix='courier-files-from-', delete=False) as files_from_file:
+        for changed_path in changed_paths:
+            files_from_file.write(changed_path + '\0')
+    rsync_ssh_dict['files_from'] = files_from_file.name
+    try:
+        rsync_command = ('rsync {rsync_options} --itemize-changes --stats --ignore-times '
+                         '--from0 --files-from={files_from} '
+                         '--delete-missing-args '
+                         '--exclude=".git*" '
+                         '--rsh="{ssh_command}" '
+                         '{sudo} {local_path} {user}@{host}:{path}/{remote_name}/ ').format(**rsync_ssh_dict)
+        result = _run_rsync(rsync_command, timeout)
+    finally:
+        os.remove(files_from_file.name)
     return result
+
+
+def create_tree_archive(local_path):
+    """Returns gzipped tar archive, as bytes, of directories and regular files pushed from local_path."""
+    archive_buffer = io.BytesIO()
+    archive = tarfile.open(fileobj=archive_buffer, mode='w:gz')
+    try:
+        for entry_type, relative_path, path in delivery_state.iterate_pushed_tree(local_path):
+            if relative_path != '.':
+                archive.add(path, arcname=relative_path, recursive=False)
+    finally:
+        archive.close()
+    return archive_buffer.getvalue()
+
+
+def push_archive_to_remote(archive, remote_name, rsync_ssh_dict, timeout=None):
+    """Unpacks archive created by create_tree_archive into {path}/remote_name on remote host.
+
+    The archive is unpacked into a new hidden directory next to the target, and the target is a symbolic link switched
+    to it with a single rename, so the remote host never sees a partially unpacked tree nor a missing target. The
+    directory of the previous push is removed afterwards, and the new one if the push fails.
+    """
+    target_path = '{}/{}'.format(rsync_ssh_dict['path'].rstrip('/'), remote_name.strip('/'))
+    parent = pipes.quote(os.path.dirname(target_path))
+    name = pipes.quote(os.path.basename(target_path))
+    unpack_script = (
+        'set -e; mkdir -p {parent}; cd {parent}; '
+        'cleanup() {{ rm -rf "$stage" "$link"; '
+        'if [ ! -e {name} ] && [ -e "$stage.old" ]; then mv "$stage.old" {name}; fi; }}; '
+        'stage=$(mktemp -d .{name}.courier-XXXXXX); link="$stage.link"; trap cleanup EXIT; '
+        'chmod 755 "$stage"; tar -xzf - -C "$stage"; '
+        'previous=$(readlink {name} || true); '
+        # A directory pushed by rsync is not a link. It is replaced with one in two steps, once.
+        'if [ -e {name} ] && [ ! -L {name} ]; then previous="$stage.old"; mv {name} "$previous"; fi; '
+        'ln -s "$stage" "$link"; mv -T "$link" {name}; trap - EXIT; '
+        'case "$previous" in .{name}.courier-*) rm -rf "$previous";; esac').format(**locals())
+    return _execute_remote_script(unpack_script, rsync_ssh_dict, archive, timeout)
+
+
+def replace_archive_links(remote_names, rsync_ssh_dict, timeout=None):
+    """Turns targets {path}/remote_name left by push_archive_to_remote as symbolic links back into directories, so
+    rsync pushes update a directory of their own. The directory the link points to becomes the target, and other
+    directories of archive pushes are removed. Targets that are not such links are left alone."""
+    scripts = []
+    for remote_name in remote_names:
+        target_path = '{}/{}'.format(rsync_ssh_dict['path'].rstrip('/'), remote_name.strip('/'))
+        parent = pipes.quote(os.path.dirname(target_path))
+        name = pipes.quote(os.path.basename(target_path))
+        scripts.append((
+            '(if cd {parent} 2>/dev/null && [ -L {name} ]; then stage=$(readlink {name}); '
+            'case "$stage" in .{name}.courier-*) rm {name} && mv "$stage" {name} && rm -rf .{name}.courier-*;; '
+            'esac; fi) || failed=1').format(**locals()))
+    return _execute_remote_script('failed=0; {}; exit $failed'.format('; '.join(scripts)), rsync_ssh_dict,
+                                  timeout=timeout)
+
+
+def _execute_remote_script(script, rsync_ssh_dict, input=None, timeout=None):
+    """Runs shell script on the host of rsync_ssh_dict, with sudo if it says so. Returns its exit code, stdout and
+    stderr."""
+    remote_command = 'sh -c {}'.format(pipes.quote(script))
+    if rsync_ssh_dict.get('sudo'):
+        remote_command = 'sudo ' + remote_command
+    ssh_command = '{} {}@{} {}'.format(get_ssh_command(rsync_ssh_dict['port'], rsync_ssh_dict['ssh_key_path']),
+                                       rsync_ssh_dict['user'], rsync_ssh_dict['host'], pipes.quote(remote_command))
+    p = subprocess.Popen(ssh_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         shell=True, preexec_fn=os.setsid)
+    out, err = _communicate(p, input, timeout)
+    return p.returncode, out, err
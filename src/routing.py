@@ -0,0 +1,163 @@
+import copy
+import hashlib
+import logging
+import os
+import threading
+
+from armada import hermes
+
+from util import register_after_fork
+
+
+def _get_file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConfigFingerprint(object):
+    """Computes fingerprints of config files.
+
+    Content of a file is hashed only when its mtime or size has changed, so unchanged configs cost one stat per file.
+    """
+
+    def __init__(self):
+        self.__digests = {}
+        self.__lock = threading.Lock()
+        register_after_fork(self.__after_fork)
+
+    def __after_fork(self):
+        self.__lock = threading.Lock()
+
+    def __get_digest(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        stat_key = (stat.st_mtime, stat.st_size)
+        with self.__lock:
+            cached = self.__digests.get(path)
+        if cached is not None and cached[0] == stat_key:
+            return cached[1]
+        digest = _get_file_digest(path)
+        with self.__lock:
+            self.__digests[path] = (stat_key, digest)
+        return digest
+
+    def get(self, paths):
+        return tuple((path, self.__get_digest(path)) for path in sorted(set(paths)))
+
+
+_fingerprint = ConfigFingerprint()
+
+
+def _get_destinations_config_path():
+    return hermes.get_config_file_path('destinations.json')
+
+
+def _get_sources_config_paths():
+    sources_configs_keys = hermes.get_configs_keys('sources') or []
+    return [hermes.get_config_file_path(key) for key in sources_configs_keys]
+
+
+def _paths_overlap(path, other_path):
+    path = path.strip('/')
+    other_path = other_path.strip('/')
+    return path == other_path or path.startswith(other_path + '/') or other_path.startswith(path + '/')
+
+
+class DestinationsConfig(object):
+    def __init__(self, destination_dicts, destination_config_dir):
+        self.destination_dicts = destination_dicts
+        self.destination_config_dir = destination_config_dir
+
+
+class RoutingTable(object):
+    """Index of sources and destinations compiled from configs.
+
+    Sources are kept as prototypes and every lookup returns fresh copies, as sources keep the state of an update.
+    """
+
+    def __init__(self, sources, were_errors, destinations_config):
+        self.were_errors = were_errors
+        self.destinations_config = destinations_config
+        self.__sources = sources
+        self.__sources_by_git_repo = {}
+        self.__sources_by_hermes_subdirectory = {}
+        for source_instance in sources:
+            if source_instance.source_type == 'git':
+                key = (source_instance.repo_url, source_instance.branch)
+                self.__sources_by_git_repo.setdefault(key, []).append(source_instance)
+            elif source_instance.source_type == 'hermes-directory':
+                key = source_instance.subdirectory
+                self.__sources_by_hermes_subdirectory.setdefault(key, []).append(source_instance)
+
+    @staticmethod
+    def __copy_sources(sources):
+        return [copy.deepcopy(source_instance) for source_instance in sources]
+
+    def get_all_sources(self):
+        return self.__copy_sources(self.__sources)
+
+    def get_sources_for_git_repo(self, repo_url, branch):
+        return self.__copy_sources(self.__sources_by_git_repo.get((repo_url, branch), []))
+
+    def get_sources_for_hermes_directory(self, subdirectory):
+        return self.__copy_sources(self.__sources_by_hermes_subdirectory.get(subdirectory, []))
+
+    def get_sources_for_hermes_directory_paths(self, paths):
+        """Returns hermes-directory sources whose content includes any of paths, relative to Hermes-directory."""
+        result = []
+        for subdirectory, sources in self.__sources_by_hermes_subdirectory.items():
+            if not subdirectory or any(_paths_overlap(subdirectory, path) for path in paths):
+                result.extend(sources)
+        return self.__copy_sources(result)
+
+    def get_destination_dicts(self, destination_alias):
+        return (self.destinations_config.destination_dicts or {}).get(destination_alias)
+
+
+_lock = threading.RLock()
+_destinations_config = None
+_destinations_config_fingerprint = None
+_routing_table = None
+_routing_table_fingerprint = None
+
+
+def _after_fork():
+    global _lock
+    _lock = threading.RLock()
+
+
+register_after_fork(_after_fork)
+
+
+def get_destinations_config():
+    """Returns parsed destinations.json, reading it again only if it has changed."""
+    global _destinations_config, _destinations_config_fingerprint
+    with _lock:
+        destinations_config_path = _get_destinations_config_path()
+        fingerprint = _fingerprint.get([destinations_config_path] if destinations_config_path else [])
+        if _destinations_config is None or fingerprint != _destinations_config_fingerprint:
+            logging.debug('Loading destinations.json.')
+            destination_config_dir = os.path.dirname(destinations_config_path) if destinations_config_path else ''
+            _destinations_config = DestinationsConfig(hermes.get_config('destinations.json'), destination_config_dir)
+            _destinations_config_fingerprint = fingerprint
+        return _destinations_config
+
+
+def get_routing_table(create_all_sources):
+    """Returns the routing table, compiling it with create_all_sources only if sources or destinations configs
+    have changed since it was compiled last time."""
+    global _routing_table, _routing_table_fingerprint
+    with _lock:
+        destinations_config = get_destinations_config()
+        fingerprint = (_fingerprint.get(_get_sources_config_paths()), _destinations_config_fingerprint)
+        if _routing_table is None or fingerprint != _routing_table_fingerprint:
+            logging.info('Compiling routing table.')
+            sources, were_errors = create_all_sources()
+            _routing_table = RoutingTable(sources, were_errors, destinations_config)
+            _routing_table_fingerprint = fingerprint
+        return _routing_table
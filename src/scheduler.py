@@ -0,0 +1,137 @@
+import threading
+import time
+
+import metrics
+from courier_common import get_courier_config
+from util import register_after_fork
+
+PRIORITY_HIGH = 'high'
+PRIORITY_LOW = 'low'
+# Ordered from the most urgent.
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_LOW)
+DEFAULT_SLOTS = 8
+DEFAULT_RESERVED_SLOTS = 1
+
+
+def get_priority_rank(priority):
+    return PRIORITIES.index(priority)
+
+
+class _SlotRequest(object):
+    def __init__(self, scheduler, priority, owner, group):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.owner = owner
+        self.group = group
+        self.requested_at = time.time()
+        self.granted = False
+
+    def __enter__(self):
+        self.scheduler._acquire(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.scheduler._release(self)
+        return False
+
+    def to_dict(self):
+        return {
+            'priority': self.priority,
+            'owner': self.owner,
+            'group': self.group,
+            'requested_at': self.requested_at,
+        }
+
+
+class UpdateScheduler(object):
+    """Shares update_slots slots for pushes among all updates running at the same time.
+
+    Free slots go to high priority requests first. Among requests of the same priority, the one whose group (e.g.
+    destination) and then owner (e.g. update job) hold the fewest slots goes first, so one large update cannot take all
+    slots while others wait. reserved_update_slots slots are kept for high priority requests only, so they never wait
+    for low priority pushes to finish.
+    """
+
+    def __init__(self):
+        self.__waiting = []
+        self.__running = []
+        self.__condition = threading.Condition()
+        register_after_fork(self.__after_fork)
+
+    def __after_fork(self):
+        # Slots are held by threads, which are not forked.
+        self.__waiting = []
+        self.__running = []
+        self.__condition = threading.Condition()
+        self.__update_metrics()
+
+    @property
+    def slots(self):
+        return max(1, int(get_courier_config().get('update_slots', DEFAULT_SLOTS)))
+
+    @property
+    def reserved_slots(self):
+        return int(get_courier_config().get('reserved_update_slots', DEFAULT_RESERVED_SLOTS))
+
+    def slot(self, priority, owner, group):
+        """Returns context manager holding one slot while in it."""
+        if priority not in PRIORITIES:
+            raise ValueError('Unsupported priority: {}'.format(priority))
+        return _SlotRequest(self, priority, owner, group)
+
+    def __count_running(self, attribute, value):
+        return sum(1 for request in self.__running if getattr(request, attribute) == value)
+
+    def __get_order(self, request):
+        return (get_priority_rank(request.priority), self.__count_running('group', request.group),
+                self.__count_running('owner', request.owner), request.requested_at)
+
+    def __grant(self, slots, reserved_slots):
+        low_priority_slots = max(1, slots - reserved_slots)
+        while self.__waiting and len(self.__running) < slots:
+            request = min(self.__waiting, key=self.__get_order)
+            if request.priority != PRIORITY_HIGH and len(self.__running) >= low_priority_slots:
+                break
+            self.__waiting.remove(request)
+            self.__running.append(request)
+            request.granted = True
+        self.__update_metrics()
+        self.__condition.notify_all()
+
+    def __update_metrics(self):
+        for priority in PRIORITIES:
+            metrics.UPDATE_SLOTS_WAITING.set(
+                sum(1 for request in self.__waiting if request.priority == priority), priority=priority)
+            metrics.UPDATE_SLOTS_RUNNING.set(self.__count_running('priority', priority), priority=priority)
+
+    def _acquire(self, request):
+        slots, reserved_slots = self.slots, self.reserved_slots
+        with self.__condition:
+            self.__waiting.append(request)
+            self.__grant(slots, reserved_slots)
+            while not request.granted:
+                self.__condition.wait()
+        metrics.UPDATE_SLOT_WAIT_SECONDS.observe(time.time() - request.requested_at, priority=request.priority)
+
+    def _release(self, request):
+        slots, reserved_slots = self.slots, self.reserved_slots
+        with self.__condition:
+            self.__running.remove(request)
+            self.__grant(slots, reserved_slots)
+
+    def get_state(self):
+        slots, reserved_slots = self.slots, self.reserved_slots
+        with self.__condition:
+            return {
+                'slots': slots,
+                'reserved_slots': reserved_slots,
+                'running': [request.to_dict() for request in self.__running],
+                'waiting': [request.to_dict() for request in sorted(self.__waiting, key=self.__get_order)],
+            }
+
+
+_update_scheduler = UpdateScheduler()
+
+
+def get_update_scheduler():
+    return _update_scheduler
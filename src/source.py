@@ -1,6 +1,8 @@
+import json
 import logging
 import os
 
+import delivery_state
 import destination
 
 
@@ -11,19 +13,29 @@ class Source(object):
         self.destinations = source_dict.get('destinations')
         self.destination_path = source_dict.get('destination_path')
         self.local_path = None
+        self.remote_name = None
+        self.workspace = None
+        self.digest = None
+        self.override_destinations = None
+        self.destination_results = []
         self.were_errors = False
+        # Time by which the update of the source has to finish, set by the update engine.
+        self.deadline = None
 
     def _pull(self):
         raise NotImplementedError()
 
-    def __get_destination_instances(self):
+    def __get_destination_instances_for_aliases(self):
         for destination_alias in self.destinations:
             destination_instances = destination.get_destinations_for_alias(destination_alias)
             for destination_instance in destination_instances:
                 yield destination_instance
 
-    def __rename_directory_if_different_from_destination_directory(self, local_path):
-        """This is used to make local path match destination_path to simplify rsync usage."""
+    def _get_pushed_path_and_remote_name(self, local_path):
+        """Returns path to push from and name of the directory it is pushed into at the destination.
+
+        Local path is renamed to match destination_path to simplify rsync usage.
+        """
         if self.subdirectory:
             pushed_path = os.path.join(local_path, self.subdirectory.strip('/'))
         else:
@@ -35,21 +47,77 @@ class Source(object):
         logging.debug('pushed_path: {}  new_pushed_path: {}'.format(pushed_path, new_pushed_path))
         if pushed_path != new_pushed_path:
             os.rename(pushed_path, new_pushed_path)
-        return new_pushed_path
+        return new_pushed_path, os.path.basename(new_pushed_path.rstrip(os.path.sep))
+
+    def get_destination_instances(self):
+        return self.override_destinations or self.__get_destination_instances_for_aliases()
+
+    def get_state_key(self):
+        """Identifies the source together with configuration of its destinations in persistent state."""
+        return json.dumps([str(self), self.destination_path,
+                           sorted(destination_instance.get_batch_key()
+                                  for destination_instance in self.get_destination_instances())])
+
+    def get_revision(self):
+        """Returns revision of the content prepared by the last prepare()."""
+        return self.digest
+
+    def probe_revision(self):
+        """Returns current revision of the source, comparable with get_revision(), without preparing it. Returns None
+        if it cannot be told cheaply."""
+        return None
+
+    def get_probe_key(self):
+        """Sources with equal probe keys have the same probe_revision(), so it is enough to probe one of them. None
+        means that the source is probed on its own."""
+        return None
+
+    def prepare(self):
+        """Pulls the source and makes it ready to be pushed from self.local_path."""
+        self.local_path, self.remote_name = self._get_pushed_path_and_remote_name(self._pull())
+        self.digest = delivery_state.compute_tree_digest(self.local_path)
+
+    def push_to_destination(self, destination_instance):
+        push_sources_to_destination([self], destination_instance)
+
+    def cleanup(self):
+        if self.workspace is not None:
+            self.workspace.release()
+            self.workspace = None
 
     def update(self, override_destinations=None):
-        self.local_path = self._pull()
-        self.local_path = self.__rename_directory_if_different_from_destination_directory(self.local_path)
-        destination_instances = override_destinations or self.__get_destination_instances()
-        for destination_instance in destination_instances:
-            destination_instance.push(self.local_path)
-            self.were_errors |= destination_instance.were_errors
+        if override_destinations:
+            self.override_destinations = override_destinations
+        try:
+            self.prepare()
+            for destination_instance in self.get_destination_instances():
+                self.push_to_destination(destination_instance)
+        finally:
+            self.cleanup()
 
-    def update_by_ssh(self, ssh_address, hermes_path):
+    def set_ssh_destination(self, ssh_address, hermes_path):
         destination_dict = {
             'type': 'ssh',
             'address': ssh_address,
             'path': hermes_path
         }
-        destination_instance = destination.Destination(destination_dict)
-        self.update(override_destinations=[destination_instance])
+        self.override_destinations = [destination.Destination(destination_dict)]
+
+    def update_by_ssh(self, ssh_address, hermes_path):
+        self.set_ssh_destination(ssh_address, hermes_path)
+        self.update()
+
+
+def push_sources_to_destination(sources, destination_instance):
+    """Pushes prepared sources to destination_instance together, so the destination is discovered and connected to
+    once for all of them."""
+    results = destination_instance.push_many([(source_instance.local_path, source_instance.digest, str(source_instance),
+                                               source_instance.remote_name)
+                                              for source_instance in sources])
+    for source_instance, (were_errors, push_results) in zip(sources, results):
+        source_instance.destination_results.append({
+            'destination': destination_instance.get_key(),
+            'success': not were_errors,
+            'addresses': push_results,
+        })
+        source_instance.were_errors |= were_errors
@@ -0,0 +1,157 @@
+import logging
+import re
+import threading
+
+from util import register_after_fork
+
+COMPRESS_AUTO = 'auto'
+CHECKSUM_ALWAYS = 'always'
+CHECKSUM_SIZE_TIME = 'size-time'
+CHECKSUM_POLICIES = (CHECKSUM_ALWAYS, CHECKSUM_SIZE_TIME)
+BWLIMIT_PATTERN = re.compile(r'^\d+(\.\d+)?[KMGkmg]?$')
+SKIP_COMPRESS_PATTERN = re.compile(r'^\w+$')
+
+# Pushes sending fewer bytes than this say nothing about the link and are not used by auto compression.
+AUTO_MIN_SAMPLE_BYTES = 1024 * 1024
+# Compressed pushes in which rsync is busy for at least this part of their time are limited by compression.
+AUTO_CPU_BOUND_RATIO = 0.5
+# Links slower than this, measured by uncompressed pushes, gain more from compression than they lose.
+AUTO_SLOW_LINK_BYTES_PER_SECOND = 4 * 1024 * 1024
+# Compression level used for slow links when compression is the bottleneck.
+AUTO_LOW_COMPRESS_LEVEL = 1
+# Weight of the newest push in averaged measurements.
+AUTO_SMOOTHING = 0.3
+
+
+class TransferProfileException(Exception):
+    pass
+
+
+class _AddressMeasurements(object):
+    def __init__(self):
+        # Keys are True for compressed pushes and False for uncompressed ones.
+        self.cpu_ratio = {}
+        self.bytes_per_second = {}
+        self.choice = None
+
+
+class TransferHistory(object):
+    """Throughput and CPU time of recent rsync pushes to every Hermes-address, averaged separately for compressed and
+    uncompressed pushes. Used by transfer profiles with "compress": "auto"."""
+
+    def __init__(self):
+        self.__addresses = {}
+        self.__lock = threading.Lock()
+        register_after_fork(self.__after_fork)
+
+    def __after_fork(self):
+        self.__lock = threading.Lock()
+
+    def record(self, address, compressed, stats):
+        """Records push to address described by RsyncStats stats, with its duration and cpu_seconds set."""
+        if not stats.duration or stats.cpu_seconds is None or stats.sent_bytes < AUTO_MIN_SAMPLE_BYTES:
+            return
+        cpu_ratio = stats.cpu_seconds / stats.duration
+        bytes_per_second = stats.sent_bytes / stats.duration
+        with self.__lock:
+            measurements = self.__addresses.setdefault(address, _AddressMeasurements())
+            self.__update_average(measurements.cpu_ratio, compressed, cpu_ratio)
+            self.__update_average(measurements.bytes_per_second, compressed, bytes_per_second)
+
+    @staticmethod
+    def __update_average(averages, compressed, value):
+        previous = averages.get(compressed)
+        averages[compressed] = value if previous is None else AUTO_SMOOTHING * value + (1 - AUTO_SMOOTHING) * previous
+
+    def choose_compression(self, address, compress_level):
+        """Returns compression level to use for address, or 0 if compression should be disabled.
+
+        Compression stays on until compressed pushes turn out to be limited by CPU. Then it is disabled, unless
+        uncompressed pushes to the address have shown that the link is slow, in which case the lowest level is used.
+        """
+        with self.__lock:
+            measurements = self.__addresses.setdefault(address, _AddressMeasurements())
+            if measurements.cpu_ratio.get(True, 0) < AUTO_CPU_BOUND_RATIO:
+                choice = compress_level
+            elif measurements.bytes_per_second.get(False, float('inf')) < AUTO_SLOW_LINK_BYTES_PER_SECOND:
+                choice = AUTO_LOW_COMPRESS_LEVEL
+            else:
+                choice = 0
+            # Nothing is logged until there are measurements to decide on.
+            changed = choice != measurements.choice and bool(measurements.cpu_ratio)
+            measurements.choice = choice
+        if changed:
+            logging.info('Compression of pushes to {} is {}.'.format(
+                address, 'off' if choice == 0 else 'on, level {}'.format(choice or 'default')))
+        return choice
+
+
+_transfer_history = TransferHistory()
+
+
+def get_transfer_history():
+    return _transfer_history
+
+
+class TransferProfile(object):
+    """Settings of rsync transfers to a destination, from its "transfer_profile" dict in destinations.json.
+
+    * compress - true, false or "auto". Default is true.
+    * compress_level - zlib compression level, 1-9. Default is rsync's own.
+    * skip_compress - list of file suffixes that are sent without compression.
+    * checksum - "always" compares files by checksum, "size-time" by size and modification time. Default is "always".
+    * bwlimit - maximum transfer rate per rsync session, in KiB per second or with K, M or G suffix.
+    """
+
+    def __init__(self, profile_dict=None):
+        profile_dict = profile_dict or {}
+        self.compress = profile_dict.get('compress', True)
+        if self.compress not in (True, False, COMPRESS_AUTO):
+            raise TransferProfileException('Unsupported value of "compress": {}'.format(self.compress))
+        self.compress_level = profile_dict.get('compress_level')
+        if self.compress_level is not None:
+            self.compress_level = int(self.compress_level)
+            if not 1 <= self.compress_level <= 9:
+                raise TransferProfileException('"compress_level" has to be between 1 and 9.')
+        self.skip_compress = [suffix.lstrip('.') for suffix in profile_dict.get('skip_compress') or []]
+        for suffix in self.skip_compress:
+            if not SKIP_COMPRESS_PATTERN.match(suffix):
+                raise TransferProfileException('Unsupported suffix in "skip_compress": {}'.format(suffix))
+        self.checksum = profile_dict.get('checksum', CHECKSUM_ALWAYS)
+        if self.checksum not in CHECKSUM_POLICIES:
+            raise TransferProfileException('Unsupported value of "checksum": {}'.format(self.checksum))
+        self.bwlimit = profile_dict.get('bwlimit')
+        if self.bwlimit is not None:
+            self.bwlimit = str(self.bwlimit)
+            if not BWLIMIT_PATTERN.match(self.bwlimit):
+                raise TransferProfileException('Unsupported value of "bwlimit": {}'.format(self.bwlimit))
+
+    def get_compress_level(self, address):
+        """Returns compression level for pushes to address, None for rsync's default, or 0 if there is no
+        compression."""
+        if self.compress == COMPRESS_AUTO:
+            return get_transfer_history().choose_compression(address, self.compress_level)
+        if not self.compress:
+            return 0
+        return self.compress_level
+
+    def get_rsync_options(self, compress_level, checksum=True):
+        """Returns rsync options for a push with compress_level from get_compress_level. checksum=False leaves out
+        the checksum policy, for pushes that list the files to transfer."""
+        options = []
+        if checksum and self.checksum == CHECKSUM_ALWAYS:
+            options.append('--checksum')
+        if compress_level != 0:
+            options.append('--compress')
+            if compress_level is not None:
+                options.append('--compress-level={}'.format(compress_level))
+            if self.skip_compress:
+                options.append('--skip-compress={}'.format('/'.join(self.skip_compress)))
+        if self.bwlimit is not None:
+            options.append('--bwlimit={}'.format(self.bwlimit))
+        return ' '.join(options)
+
+    def record(self, address, compress_level, stats):
+        """Records push to address, so auto compression can adapt to it."""
+        if self.compress == COMPRESS_AUTO:
+            get_transfer_history().record(address, compress_level != 0, stats)
@@ -0,0 +1,169 @@
+import collections
+import logging
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+import metrics
+import scheduler
+import source
+from util import map_concurrently
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_DESTINATION_CONCURRENCY = 2
+DEFAULT_PUSH_BATCH_SIZE = 64
+# A batch that is not full yet is pushed anyway if no other source gets prepared for this many seconds.
+BATCH_FLUSH_INTERVAL = 5
+DEFAULT_UPDATE_TIMEOUT = 1800
+
+
+class UpdateEngine(object):
+    """Updates many sources concurrently.
+
+    Sources are pulled by one pool of workers and pushed by another, so pulling next sources overlaps with pushing
+    the ones that are already prepared. Prepared sources are pushed in batches of up to push_batch_size sources, and
+    every destination gets all sources of a batch at once, so it is discovered and connected to once per batch. At
+    most concurrency sources are pulled and at most concurrency batches are pushed at the same time, and at most
+    destination_concurrency batches are pushed to the same destination. If pulls stall, e.g. waiting for workspaces
+    held by prepared sources, the sources prepared so far are pushed without waiting for the batch to fill up.
+
+    Pushes of a run have to finish within update_timeout seconds from its start. Remote operations are cut short at
+    that deadline, and pushes that have not started by then fail right away.
+
+    Every push to a destination also takes a slot of the update scheduler, shared with all other running updates. The
+    priority decides which of them gets free slots first, and owner names the update in the scheduler's state.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, destination_concurrency=DEFAULT_DESTINATION_CONCURRENCY,
+                 push_batch_size=DEFAULT_PUSH_BATCH_SIZE, update_timeout=DEFAULT_UPDATE_TIMEOUT,
+                 priority=scheduler.PRIORITY_HIGH, owner=None):
+        self.concurrency = max(1, concurrency)
+        self.destination_concurrency = max(1, destination_concurrency)
+        self.push_batch_size = max(1, push_batch_size)
+        self.update_timeout = update_timeout
+        self.priority = priority
+        self.owner = owner
+        self.__destination_semaphores = {}
+        self.__destination_semaphores_lock = threading.Lock()
+        # Limits the number of prepared sources waiting for a push, so pulls do not fill the disk. A whole batch has
+        # to fit in it.
+        self.__prepared_sources_semaphore = threading.BoundedSemaphore(self.push_batch_size + 2 * self.concurrency)
+
+    def __get_destination_semaphore(self, destination_instance):
+        key = destination_instance.get_key()
+        with self.__destination_semaphores_lock:
+            if key not in self.__destination_semaphores:
+                self.__destination_semaphores[key] = threading.BoundedSemaphore(self.destination_concurrency)
+            return self.__destination_semaphores[key]
+
+    def __prepare(self, source_instance):
+        self.__prepared_sources_semaphore.acquire()
+        source_instance.update_started_at = time.time()
+        try:
+            source_instance.prepare()
+            return source_instance, True
+        except Exception as e:
+            logging.exception('Update of source {source_instance} failed.'.format(**locals()))
+            source_instance.were_errors = True
+            self.__observe_source_update(source_instance, False)
+            self.__release_source(source_instance)
+            return source_instance, False
+
+    @staticmethod
+    def __group_by_destination(sources):
+        """Returns list of (destination_instance, sources) pairs."""
+        destinations = collections.OrderedDict()
+        for source_instance in sources:
+            try:
+                for destination_instance in source_instance.get_destination_instances():
+                    batch_key = destination_instance.get_batch_key()
+                    if batch_key not in destinations:
+                        destinations[batch_key] = (destination_instance, [])
+                    destinations[batch_key][1].append(source_instance)
+            except Exception as e:
+                logging.exception('Update of source {source_instance} failed.'.format(**locals()))
+                source_instance.were_errors = True
+        return list(destinations.values())
+
+    def __push_to_destination(self, destination_instance, sources, deadline):
+        destination_instance.deadline = deadline
+        with self.__get_destination_semaphore(destination_instance):
+            with scheduler.get_update_scheduler().slot(self.priority, self.owner, destination_instance.get_key()):
+                source.push_sources_to_destination(sources, destination_instance)
+
+    def __push(self, sources, deadline):
+        success = False
+        try:
+            map_concurrently(lambda destination_group: self.__push_to_destination(destination_group[0],
+                                                                                 destination_group[1], deadline),
+                             self.__group_by_destination(sources), self.concurrency)
+            success = True
+        except Exception as e:
+            logging.exception('Update of sources {sources} failed.'.format(**locals()))
+            for source_instance in sources:
+                source_instance.were_errors = True
+        finally:
+            for source_instance in sources:
+                self.__observe_source_update(source_instance, success and not source_instance.were_errors)
+                self.__release_source(source_instance)
+        return success
+
+    @staticmethod
+    def __observe_source_update(source_instance, success):
+        metrics.SOURCE_UPDATE_SECONDS.observe(time.time() - source_instance.update_started_at,
+                                              source=str(source_instance),
+                                              result='success' if success else 'failure')
+
+    def __release_source(self, source_instance):
+        try:
+            source_instance.cleanup()
+        except Exception as e:
+            logging.exception('Cleanup of source {source_instance} failed.'.format(**locals()))
+        finally:
+            self.__prepared_sources_semaphore.release()
+
+    def run(self, sources):
+        """Updates all sources and returns True if there were any errors."""
+        sources = list(sources)
+        if not sources:
+            return False
+        were_errors = False
+        deadline = time.time() + self.update_timeout
+        for source_instance in sources:
+            source_instance.deadline = deadline
+        pool_size = min(self.concurrency, len(sources))
+        pull_pool = ThreadPool(pool_size)
+        push_pool = ThreadPool(pool_size)
+        try:
+            pushes = []
+            batch = []
+            prepared_sources = pull_pool.imap_unordered(self.__prepare, sources)
+            remaining = len(sources)
+            while remaining:
+                try:
+                    source_instance, prepared = prepared_sources.next(BATCH_FLUSH_INTERVAL if batch else None)
+                except TimeoutError:
+                    pushes.append(push_pool.apply_async(self.__push, (batch, deadline)))
+                    batch = []
+                    continue
+                remaining -= 1
+                if not prepared:
+                    were_errors = True
+                    continue
+                batch.append(source_instance)
+                if len(batch) >= self.push_batch_size:
+                    pushes.append(push_pool.apply_async(self.__push, (batch, deadline)))
+                    batch = []
+            if batch:
+                pushes.append(push_pool.apply_async(self.__push, (batch, deadline)))
+            for push in pushes:
+                were_errors |= not push.get()
+        finally:
+            pull_pool.close()
+            push_pool.close()
+            pull_pool.join()
+            push_pool.join()
+        for source_instance in sources:
+            were_errors |= source_instance.were_errors
+        return were_errors
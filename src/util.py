@@ -1,11 +1,96 @@
+import errno
+import fcntl
 import os
+from multiprocessing.pool import ThreadPool
 
-import time
+_before_fork_functions = []
+_after_fork_functions = []
 
-COURIER_TEMP_DIR = '/tmp/courier-temp'
 
+def register_before_fork(function):
+    """Registers function to be called in Courier right before a job process is forked from it, e.g. to prepare state
+    the job process inherits."""
+    _before_fork_functions.append(function)
 
-def create_temp_directory():
-    unique_dir_name = '{0:.6f}'.format(time.time())
-    local_path = os.path.join(COURIER_TEMP_DIR, unique_dir_name, '')
-    return local_path
+
+def run_before_fork():
+    for function in _before_fork_functions:
+        function()
+
+
+def register_after_fork(function):
+    """Registers function to be called in job processes right after they are forked from Courier. Locks have to be
+    created anew there, because other threads of Courier could have held them at the time of the fork."""
+    _after_fork_functions.append(function)
+
+
+def run_after_fork():
+    for function in _after_fork_functions:
+        function()
+
+
+def get_directory_size(path):
+    total_size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total_size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total_size
+
+
+class FileLock(object):
+    """Exclusive lock held on file at path, which excludes other processes, e.g. job processes, and other threads
+    holding their own FileLock of the same path. It is not reentrant. A shared lock only excludes exclusive ones."""
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self.__file = None
+
+    def acquire(self, blocking=True):
+        """Returns False if blocking is False and the lock is held by someone else."""
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.__file = open(self.path, 'a')
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(self.__file, operation if blocking else operation | fcntl.LOCK_NB)
+        except IOError as e:
+            self.__file.close()
+            self.__file = None
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+
+    def release(self):
+        fcntl.flock(self.__file, fcntl.LOCK_UN)
+        self.__file.close()
+        self.__file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+def map_concurrently(function, items, concurrency):
+    """Calls function on every item using at most concurrency threads and returns results in order of items."""
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    pool = ThreadPool(min(concurrency, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,157 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import metrics
+from courier_common import get_courier_config
+from util import get_directory_size, register_after_fork
+
+WORKSPACES_DIR = '/tmp/courier-temp'
+DEFAULT_MAX_SIZE_MB = 4096
+DEFAULT_WAIT_TIMEOUT = 600
+
+
+class WorkspaceException(Exception):
+    pass
+
+
+class Workspace(object):
+    """Unique work directory, removed when the last reference to it is released."""
+
+    def __init__(self, manager, path):
+        self.manager = manager
+        self.path = path
+        self.size = 0
+        self.references = 1
+
+    def acquire(self):
+        self.manager._acquire(self)
+        return self
+
+    def release(self):
+        self.manager._release(self)
+
+    def measure(self):
+        """Records current size of the workspace, which counts towards the disk budget."""
+        self.manager._measure(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+class WorkspaceManager(object):
+    """Hands out unique work directories and keeps their total size within a disk budget.
+
+    Workspaces are reference counted and removed as soon as the last reference is released, also when the work in them
+    failed. Creating a workspace while the measured size of the others exceeds workspace_max_size_mb waits until enough
+    of them are released, for up to workspace_wait_timeout seconds.
+    """
+
+    def __init__(self, workspaces_dir=None):
+        self.__workspaces_dir = workspaces_dir
+        self.__workspaces = {}
+        self.__condition = threading.Condition()
+        register_after_fork(self.__after_fork)
+
+    def __after_fork(self):
+        # Workspaces of Courier are not counted in the budget of a job process.
+        self.__workspaces = {}
+        self.__condition = threading.Condition()
+
+    @property
+    def workspaces_dir(self):
+        return self.__workspaces_dir or WORKSPACES_DIR
+
+    @workspaces_dir.setter
+    def workspaces_dir(self, workspaces_dir):
+        self.__workspaces_dir = workspaces_dir
+
+    @property
+    def max_size_bytes(self):
+        return int(get_courier_config().get('workspace_max_size_mb', DEFAULT_MAX_SIZE_MB)) * 1024 * 1024
+
+    @property
+    def wait_timeout(self):
+        return float(get_courier_config().get('workspace_wait_timeout', DEFAULT_WAIT_TIMEOUT))
+
+    def __get_size(self):
+        return sum(workspace.size for workspace in self.__workspaces.values())
+
+    def __update_metrics(self):
+        metrics.WORKSPACES.set(len(self.__workspaces))
+        metrics.WORKSPACE_BYTES.set(self.__get_size())
+
+    def create(self):
+        max_size_bytes = self.max_size_bytes
+        deadline = time.time() + self.wait_timeout
+        with metrics.WORKSPACE_WAIT_SECONDS.time():
+            with self.__condition:
+                # A single workspace is allowed to exceed the budget, otherwise it could never be created.
+                while self.__workspaces and self.__get_size() >= max_size_bytes:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise WorkspaceException(
+                            'Workspaces take {} bytes, over the limit of {} bytes. Could not create a new one.'.format(
+                                self.__get_size(), max_size_bytes))
+                    self.__condition.wait(remaining)
+                if not os.path.exists(self.workspaces_dir):
+                    os.makedirs(self.workspaces_dir)
+                path = tempfile.mkdtemp(prefix='{:.0f}-'.format(time.time()), dir=self.workspaces_dir)
+                workspace = Workspace(self, path)
+                self.__workspaces[path] = workspace
+                self.__update_metrics()
+        return workspace
+
+    def _acquire(self, workspace):
+        with self.__condition:
+            if workspace.references <= 0:
+                raise WorkspaceException('Workspace {} has already been removed.'.format(workspace.path))
+            workspace.references += 1
+
+    def _release(self, workspace):
+        with self.__condition:
+            if workspace.references <= 0:
+                return
+            workspace.references -= 1
+            if workspace.references > 0:
+                return
+        shutil.rmtree(workspace.path, ignore_errors=True)
+        with self.__condition:
+            self.__workspaces.pop(workspace.path, None)
+            self.__update_metrics()
+            self.__condition.notify_all()
+
+    def _measure(self, workspace):
+        size = get_directory_size(workspace.path)
+        with self.__condition:
+            workspace.size = size
+            self.__update_metrics()
+
+    def remove_stale(self):
+        """Removes directories left in workspaces_dir by previous runs of Courier."""
+        if not os.path.isdir(self.workspaces_dir):
+            return
+        with self.__condition:
+            live_paths = set(self.__workspaces)
+        for name in os.listdir(self.workspaces_dir):
+            path = os.path.join(self.workspaces_dir, name)
+            if path not in live_paths:
+                logging.info('Removing stale workspace {}.'.format(path))
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+
+
+_workspace_manager = WorkspaceManager()
+
+
+def get_workspace_manager():
+    return _workspace_manager